@@ -0,0 +1,39 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+sys.path.append('../lib')
+from configparser import RawConfigParser
+from busMultiplexer import RtuMaster, BusMultiplexer
+from rtuTransport import AdaptiveTiming
+from instruments import MetricsEndpoint
+from startupState import waitForPath
+
+# owns the RS485 bus and shares it with solarmon, metermon and the tools,
+# which set bus in their [query] section to use it.
+
+if __name__ == '__main__':
+
+    settings = RawConfigParser()
+    settings.read(os.path.dirname(os.path.realpath(__file__)) + '/bus.cfg')
+
+    port = settings.get('bus', 'port', fallback='/dev/ttyUSB0')
+    waitForPath(port)
+
+    print(f'Setup Serial Connection {port}... ', end='')
+    timeout = settings.getfloat('bus', 'timeout', fallback=1)
+    timing = None
+    if settings.has_section('timing'):
+        # timeouts learned per unit and a circuit breaker for units that don't answer
+        timing = AdaptiveTiming(settings, timeout)
+    master = RtuMaster(port,
+        baudrate=settings.getint('bus', 'baudrate', fallback=9600),
+        timeout=timeout, timing=timing,
+        slack=settings.getfloat('timing', 'slack', fallback=0.05))
+    master.connect()
+    print('Done!')
+
+    if settings.has_section('metrics'):
+        MetricsEndpoint(settings).start()
+
+    BusMultiplexer(settings, master).run()
@@ -8,9 +8,21 @@ from configparser import RawConfigParser
 from modbusRegister import ModbusRegister
 from modbusMetrics import ModbusMetrics
 from sdm230 import Sdm230
-from metricsRecorder import MetricsRecorder
+from modbusSniffer import ModbusSniffer
+from snifferSdm230 import SnifferSdm230
+from binarySeries import BinarySeriesWriter
+from eventLoop import EventLoop
+from instruments import MetricsEndpoint
+from recorderChain import recorderChain
+from cycleProfiler import CycleProfiler
+from busCapture import CaptureWriter, readCapture
+from pollScheduler import nextDeadline
+from registerSnapshot import SnapshotWriter
+from registerMaps import SDM230_INPUT
 
 # snoops on a RS485 interface connected to a network with an active controller talking to a SDM230
+# usage: modbusGateway.py [replay|parse <capture files or directories>]
+#   replay feeds a capture through the ring sniffer and the configured sinks, parse only parses it
 
 
 
@@ -23,15 +35,29 @@ if __name__ == '__main__':
 
     error_interval = settings.getint('gateway', 'error_interval', fallback=60)
     debug = settings.getint('gateway', 'debug', fallback=0)
+    sniffer = settings.get('gateway', 'sniffer', fallback='ring')
+    mode = sys.argv[1] if len(sys.argv) > 1 else 'live'
+    if mode != 'live':
+        # captures are replayed through the ring sniffer, the register sniffer reads the port itself
+        sniffer = 'ring'
 
 
 
     metrics = ModbusMetrics(settings)
-    recorder = MetricsRecorder(settings, metrics)
+    recorder, store = recorderChain(settings, metrics)
+    profile = CycleProfiler(settings, 'gateway')
 
 
-    modbus = ModbusRegister(settings, metrics)
-    modbus.connect()
+    if sniffer == 'ring':
+        modbus = ModbusSniffer(settings, metrics)
+    else:
+        modbus = ModbusRegister(settings, metrics)
+    if mode == 'live':
+        modbus.connect()
+        if settings.has_section('capture') and sniffer == 'ring':
+            modbus.capture = CaptureWriter(settings)
+        if settings.has_section('metrics'):
+            MetricsEndpoint(settings, store=store).start()
 
 
     print('Loading devices... ')
@@ -48,7 +74,15 @@ if __name__ == '__main__':
         logFields = settings.get(section, 'logFields', fallback='').split(',')
         sampleInterval = settings.getint(section, 'sampleInterval', fallback=5)
         updateInterval = settings.getint(section, 'updateInterval', fallback=60)
-        if deviceType == 'sdm230':
+        series = None
+        if settings.has_section('binary'):
+            series = BinarySeriesWriter(settings.get('binary', 'pathPrefix', fallback='./gatewayData'),
+                measurement, [f for f in logFields if f != ''],
+                maxFileSize=settings.getint('binary', 'maxFileSize', fallback=256000),
+                nfiles=settings.getint('binary', 'nfiles', fallback=10))
+        if deviceType == 'sdm230' and sniffer == 'ring':
+            deviceProcessor = SnifferSdm230(modbus, device, logFields)
+        elif deviceType == 'sdm230':
             deviceProcessor = Sdm230(modbus, device, logFields)
         else:
             continue
@@ -59,6 +93,7 @@ if __name__ == '__main__':
             'name': name,
             'deviceProcessor': deviceProcessor,
             'measurement': measurement,
+            'series': series,
             'nextUpdate': now + updateInterval,
             'nextSample': now + sampleInterval,
             'updateInterval': updateInterval,
@@ -67,39 +102,208 @@ if __name__ == '__main__':
 
     print('Done!')
 
+    snapshot = None
+    if settings.has_section('snapshot') and mode == 'live':
+        # latest values in shared memory for other processes
+        snapshot = SnapshotWriter(settings.get('snapshot', 'path', fallback='/dev/shm/modbusgw.snapshot'),
+            [(d['name'], d['device'], d['measurement'], [f.name for f in SDM230_INPUT.fields]) for d in devices])
+        print(f'Snapshot in {snapshot.path}')
 
-     # main loop
-    lastRead = time.time()
-    while True:
+    def publishSnapshot(device):
+        if snapshot is not None:
+            snapshot.update(device['name'], device['deviceProcessor'].read(), time.time())
+
+    def refreshSnapshot():
+        # devices the ring sniffer has just decoded registers for
+        for device in devices:
+            seen = modbus.devices.get(device['device'])
+            if seen is not None and seen.updated != device.get('snapshotUpdated'):
+                device['snapshotUpdated'] = seen.updated
+                device['deviceProcessor'].update()
+                publishSnapshot(device)
+
+
+    def replay(paths, parseOnly):
+        # as fast as the bytes parse, with samples and updates at the times in
+        # the capture rather than the wall clock, so every run is the same
+        clock = [0]
+        modbus.clock = lambda: clock[0]
+        chunks = 0
+        size = 0
+        updates = 0
+        first = None
+        now = None
+        started = time.perf_counter()
+        for now, data in readCapture(paths):
+            if first is None:
+                first = now
+                for device in devices:
+                    device['nextSample'] = now + device['sampleInterval']
+                    device['nextUpdate'] = now + device['updateInterval']
+            tosend = False
+            for device in devices if not parseOnly else []:
+                if now >= device['nextSample']:
+                    clock[0] = device['nextSample']
+                    device['deviceProcessor'].update()
+                    device['nextSample'] = nextDeadline(device['nextSample'], device['sampleInterval'], now)
+                if now >= device['nextUpdate']:
+                    at = device['nextUpdate']
+                    info = device['deviceProcessor'].read()
+                    recorder.add(at, device['measurement'], info, device['updateInterval'],[])
+                    if device['series'] is not None:
+                        device['series'].append(at, info)
+                    device['nextUpdate'] = nextDeadline(at, device['updateInterval'], now)
+                    updates += 1
+                    tosend = True
+            if tosend:
+                recorder.send()
+            clock[0] = now
+            modbus.feed(data)
+            chunks += 1
+            size += len(data)
+        elapsed = time.perf_counter() - started
+        if first is None:
+            print('Nothing to replay')
+            return
+        print(f'Replayed {now - first:.0f}s of traffic, {chunks} chunks {size} bytes, {modbus.frames} frames, '
+              f'{modbus.crcErrors} crc errors, {modbus.resyncs} resyncs, {updates} updates in {elapsed:.2f}s, '
+              f'{(now - first) / max(elapsed, 1e-9):.0f}x real time, {size / max(elapsed, 1e-9) / 1e6:.1f}MB/s')
+
+
+    if mode in ('replay', 'parse'):
+        replay(sys.argv[2:], mode == 'parse')
+        if mode == 'replay':
+            recorder.send()
+            if settings.has_section('rollup'):
+                recorder.persist()
+        sys.exit(0)
+
+
+    def sample(device):
+        device['nextSample'] += device['sampleInterval']
+        if device['nextSample'] < time.time():
+            device['nextSample'] = time.time() + device['sampleInterval']
+        loop.callAt(device['nextSample'], sample, device)
+        with profile.cycle('sample', device['name'], device['sampleInterval']):
+            with profile.phase('decode'):
+                device['deviceProcessor'].update()
+            with profile.phase('snapshot'):
+                publishSnapshot(device)
+
+    def update(device):
         now = time.time()
-        if modbus.read():
+        device['nextUpdate'] = now + device['updateInterval']
+        loop.callAt(device['nextUpdate'], update, device)
+        with profile.cycle('update', device['name'], device['updateInterval']):
+            with profile.phase('decode'):
+                info = device['deviceProcessor'].read()
+            with profile.phase('add'):
+                recorder.add(now, device['measurement'], info, device['updateInterval'],[])
+            if device['series'] is not None:
+                with profile.phase('series'):
+                    device['series'].append(now, info)
+            with profile.phase('send'):
+                recorder.send()
+            if debug == 1:
+                print(device['name'])
+                print(info)
+            with profile.phase('report'):
+                metrics.report(recorder)
+
+    def busReadable():
+        global lastRead
+        with profile.cycle('bus'):
+            with profile.phase('read'):
+                read = modbus.read()
+            if read:
+                lastRead = time.time()
+                if snapshot is not None:
+                    with profile.phase('snapshot'):
+                        refreshSnapshot()
+
+    def sendRequests():
+        if modbus.sendRequests():
+            loop.callLater(0.1, sendRequests)
+
+    def quiet():
+        global lastRead
+        now = time.time()
+        asleep = now > lastRead + 30
+        if asleep:
             lastRead = now
-        if now > lastRead + 30:
-            # nothing read for 60s, inverter is in deep sleep
+        # rescheduled first so a failed request doesn't stop the checks
+        loop.callAt(lastRead + 30, quiet)
+        if asleep:
+            # nothing read for 30s, inverter is in deep sleep
             # Trigger getting the data.
             for device in devices:
                 device['deviceProcessor'].request()
-            now = time.time()
-            lastRead = now
+            sendRequests()
 
 
-        tosend = False
+    lastRead = time.time()
+    if hasattr(modbus, 'fileno'):
+        # event driven, sleeps until the bus has data or a device is due
+        loop = EventLoop()
+        loop.addReader(modbus.fileno(), busReadable)
         for device in devices:
-            if now > device['nextSample']:
-                device['nextSample'] = now + device['sampleInterval']
-                device['deviceProcessor'].update()
-            if now > device['nextUpdate']:
-                device['nextUpdate'] = now + device['updateInterval']
-                info = device['deviceProcessor'].read()
-                recorder.add(now, device['measurement'], info, device['updateInterval'],[])
-                tosend = True
+            loop.callAt(device['nextSample'], sample, device)
+            loop.callAt(device['nextUpdate'], update, device)
+        loop.callAt(lastRead + 30, quiet)
+        loop.run()
 
-        if tosend:
-            recorder.send()
-            if debug == '1':
-                print(points)
+     # main loop
+    while True:
+        with profile.cycle('loop'):
+            now = time.time()
+            with profile.phase('read'):
+                read = modbus.read()
+            busy = read
+            if read:
+                lastRead = now
+            if now > lastRead + 30:
+                busy = True
+                # nothing read for 60s, inverter is in deep sleep
+                # Trigger getting the data.
+                for device in devices:
+                    device['deviceProcessor'].request()
+                now = time.time()
+                lastRead = now
+
+
+            tosend = False
+            for device in devices:
+                if now > device['nextSample']:
+                    device['nextSample'] = now + device['sampleInterval']
+                    busy = True
+                    with profile.phase('decode'):
+                        device['deviceProcessor'].update()
+                    with profile.phase('snapshot'):
+                        publishSnapshot(device)
+                if now > device['nextUpdate']:
+                    device['nextUpdate'] = now + device['updateInterval']
+                    with profile.phase('decode'):
+                        info = device['deviceProcessor'].read()
+                    with profile.phase('add'):
+                        recorder.add(now, device['measurement'], info, device['updateInterval'],[])
+                    if device['series'] is not None:
+                        with profile.phase('series'):
+                            device['series'].append(now, info)
+                    tosend = True
+
+            if tosend:
+                with profile.phase('send'):
+                    recorder.send()
+                if debug == '1':
+                    print(points)
 
-        metrics.report(recorder)
+            with profile.phase('report'):
+                metrics.report(recorder)
+            if not (busy or tosend):
+                # the register sniffer can't be waited on, so an idle pass
+                # sleeps rather than spins and isn't profiled
+                profile.skip()
+                time.sleep(0.01)
 
 
 
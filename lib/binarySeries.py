@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+
+import bisect
+import glob
+import json
+import math
+import mmap
+import os
+import re
+import struct
+
+# Compact time series segments for the gateway's logged fields.
+# Each segment file has a fixed 512 byte header followed by fixed width
+# records, a uint32 epoch second and one column per logged field. The header
+# holds the first and last time in the segment, so a range query skips whole
+# segments without opening them, and records are in time order so the start
+# of a range is found by bisecting the time column of the memory mapped file.
+# Only the records in range are decoded.
+#
+# header: magic, version, field count, record size, first time, last time,
+# then JSON {measurement, fields, types} padded to HEADER_SIZE.
+
+MAGIC = b'SBTS'
+VERSION = 1
+HEADER_SIZE = 512
+FIXED = struct.Struct('<4sHHIdd')
+SUFFIX = '.sts'
+
+
+def recordFormat(types):
+    return struct.Struct('<I' + ''.join(types))
+
+
+def fieldType(field):
+    # cumulative energy counters need doubles, a float keeps only 7 digits
+    # so a kWh counter would lose the steps the export calculation subtracts
+    name = field.lower()
+    return 'd' if 'energy' in name or 'total' in name else 'f'
+
+
+class Segment:
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            header = f.read(HEADER_SIZE)
+        magic, version, fieldCount, recordSize, self.firstTime, self.lastTime = FIXED.unpack_from(header)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f'{path} is not a time series segment')
+        meta = json.loads(header[FIXED.size:].rstrip(b'\0'))
+        self.measurement = meta['measurement']
+        self.fields = meta['fields']
+        self.record = recordFormat(meta['types'])
+
+    def count(self):
+        return (os.path.getsize(self.path) - HEADER_SIZE) // self.record.size
+
+    def read(self, start=None, end=None, fromRecord=0):
+        # returns [(time, {field: value})] for start <= time < end
+        count = self.count()
+        if count <= fromRecord:
+            return []
+        with open(self.path, 'rb') as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                times = _TimeColumn(m, self.record, count)
+                first = fromRecord
+                last = count
+                if start is not None:
+                    first = max(first, bisect.bisect_left(times, start))
+                if end is not None:
+                    last = bisect.bisect_left(times, end)
+                if first >= last:
+                    return []
+                size = self.record.size
+                view = memoryview(m)[HEADER_SIZE + first * size:HEADER_SIZE + last * size]
+                rows = [(row[0], {f: v for f, v in zip(self.fields, row[1:]) if not math.isnan(v)})
+                        for row in self.record.iter_unpack(view)]
+                view.release()
+                return rows
+
+
+class _TimeColumn:
+    # sequence view of the time column for bisect, decoding only what is probed
+
+    def __init__(self, m, record, count):
+        self.m = m
+        self.size = record.size
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        return struct.unpack_from('<I', self.m, HEADER_SIZE + i * self.size)[0]
+
+
+def segmentPaths(pathPrefix):
+    # only <pathPrefix>-<seq>, not the segments of a measurement whose name
+    # starts with this one's, eg sdm230-b
+    pattern = re.compile(re.escape(pathPrefix) + r'-[0-9]+' + re.escape(SUFFIX))
+    return sorted(p for p in glob.glob(glob.escape(pathPrefix) + '-*' + SUFFIX) if pattern.fullmatch(p))
+
+
+class BinarySeriesWriter:
+
+    def __init__(self, pathPrefix, measurement, fields, maxFileSize=256000, nfiles=10, types=None):
+        self.pathPrefix = f'{pathPrefix}-{measurement}'
+        self.measurement = measurement
+        self.fields = list(fields)
+        self.types = types or [fieldType(f) for f in self.fields]
+        self.record = recordFormat(self.types)
+        self.maxFileSize = maxFileSize
+        self.nfiles = nfiles
+        dirName = os.path.dirname(self.pathPrefix)
+        if dirName != '':
+            os.makedirs(dirName, exist_ok=True)
+        self.file = None
+        self.seq = -1
+        paths = segmentPaths(self.pathPrefix)
+        if len(paths) > 0:
+            self.seq = int(paths[-1][len(self.pathPrefix) + 1:-len(SUFFIX)])
+            self._open(paths[-1])
+
+    def _path(self, seq):
+        return f'{self.pathPrefix}-{seq:06d}{SUFFIX}'
+
+    def _open(self, path):
+        try:
+            segment = Segment(path)
+        except ValueError:
+            return
+        if segment.fields != self.fields or segment.record.format != self.record.format:
+            # the logged fields changed, start a new segment
+            return
+        self.file = open(path, 'r+b')
+        # drop any partial record left by a crash
+        self.file.truncate(HEADER_SIZE + segment.count() * self.record.size)
+        self.firstTime = segment.firstTime
+        self.lastTime = segment.lastTime
+        self.file.seek(0, os.SEEK_END)
+
+    def _create(self):
+        if self.file is not None:
+            self.file.close()
+        self.seq += 1
+        meta = json.dumps({'measurement': self.measurement, 'fields': self.fields, 'types': self.types}).encode('utf-8')
+        if FIXED.size + len(meta) > HEADER_SIZE:
+            raise ValueError('Too many fields for a time series segment header')
+        self.firstTime = 0.0
+        self.lastTime = 0.0
+        self.file = open(self._path(self.seq), 'w+b')
+        self.file.write(self._header() + meta + bytes(HEADER_SIZE - FIXED.size - len(meta)))
+        paths = segmentPaths(self.pathPrefix)
+        for path in paths[:max(0, len(paths) - self.nfiles)]:
+            os.remove(path)
+
+    def _header(self):
+        return FIXED.pack(MAGIC, VERSION, len(self.fields), self.record.size, self.firstTime, self.lastTime)
+
+    def append(self, t, info):
+        if self.file is None or self.file.tell() + self.record.size > self.maxFileSize:
+            self._create()
+        values = [info.get(f) for f in self.fields]
+        self.file.write(self.record.pack(int(t), *[math.nan if v is None else float(v) for v in values]))
+        if self.firstTime == 0:
+            self.firstTime = int(t)
+        self.lastTime = int(t)
+        self.file.flush()
+        os.pwrite(self.file.fileno(), self._header(), 0)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+class BinarySeriesReader:
+
+    def __init__(self, pathPrefix, measurement):
+        self.pathPrefix = f'{pathPrefix}-{measurement}'
+
+    def read(self, start=None, end=None):
+        rows = []
+        for path in segmentPaths(self.pathPrefix):
+            try:
+                segment = Segment(path)
+            except (OSError, ValueError):
+                continue
+            if start is not None and segment.lastTime < start:
+                continue
+            if end is not None and segment.firstTime >= end:
+                continue
+            rows.extend(segment.read(start, end))
+        return rows
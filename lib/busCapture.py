@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+
+import glob
+import os
+import struct
+
+# Raw capture of the bytes seen on the bus, for reproducing what the gateway
+# decoded. Each chunk read from the port is appended as a 6 byte record
+# header, the microseconds since the previous chunk and the length, followed
+# by the bytes, through a buffered file so a chunk costs one pack and one
+# buffered write. Files rotate at maxFileSize bytes and the last nfiles are
+# kept. Gaps too long for the delta are written as a marker and an absolute
+# time. A record torn by a crash reads as the end of the file.
+#
+# file: MAGIC, start time as a double, then records.
+
+MAGIC = b'RTUC'
+START = struct.Struct('<4sd')
+RECORD = struct.Struct('<IH')
+ABSOLUTE = struct.Struct('<d')
+GAP = 0xFFFFFFFF
+MAX_CHUNK = 0xFFFF
+SUFFIX = '.rtuc'
+
+
+class CaptureWriter:
+
+    def __init__(self, settings):
+        self.path = settings.get('capture', 'path', fallback='./capture')
+        self.maxFileSize = settings.getint('capture', 'maxFileSize', fallback=16777216)
+        self.nfiles = settings.getint('capture', 'nfiles', fallback=20)
+        self.flushInterval = settings.getfloat('capture', 'flushInterval', fallback=1)
+        os.makedirs(self.path, exist_ok=True)
+        self.file = None
+        self.size = 0
+        self.last = 0
+        self.lastFlush = 0
+
+    def _open(self, now):
+        if self.file is not None:
+            self.file.close()
+        name = os.path.join(self.path, f'{int(now * 1000):015d}{SUFFIX}')
+        self.file = open(name, 'wb', buffering=65536)
+        self.file.write(START.pack(MAGIC, now))
+        self.size = START.size
+        self.last = now
+        files = captureFiles(self.path)
+        for old in files[:max(0, len(files) - self.nfiles)]:
+            os.remove(old)
+
+    def write(self, now, data):
+        if self.file is None or self.size >= self.maxFileSize:
+            self._open(now)
+        while len(data) > MAX_CHUNK:
+            self.write(now, data[:MAX_CHUNK])
+            data = data[MAX_CHUNK:]
+        # the time is rebuilt from the deltas as the reader will, so it doesn't drift
+        delta = int((now - self.last) * 1000000)
+        if delta < 0:
+            delta = 0
+        if delta >= GAP:
+            self.file.write(RECORD.pack(GAP, 0))
+            self.file.write(ABSOLUTE.pack(now))
+            self.size += RECORD.size + ABSOLUTE.size
+            self.last = now
+            delta = 0
+        self.last += delta / 1000000
+        self.file.write(RECORD.pack(delta, len(data)))
+        self.file.write(data)
+        self.size += RECORD.size + len(data)
+        if now > self.lastFlush + self.flushInterval:
+            self.file.flush()
+            self.lastFlush = now
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+def captureFiles(path):
+    # the capture files in a directory, oldest first
+    return sorted(glob.glob(os.path.join(path, '*' + SUFFIX)))
+
+
+def readCapture(paths):
+    # yields (time, bytes) for every chunk in the files, in order. Directories
+    # are expanded to the capture files in them.
+    files = []
+    for path in paths:
+        files.extend(captureFiles(path) if os.path.isdir(path) else [path])
+    for name in files:
+        with open(name, 'rb') as f:
+            data = f.read()
+        if len(data) < START.size:
+            continue
+        magic, now = START.unpack_from(data)
+        if magic != MAGIC:
+            raise ValueError(f'{name} is not a capture file')
+        offset = START.size
+        view = memoryview(data)
+        while offset + RECORD.size <= len(data):
+            delta, length = RECORD.unpack_from(data, offset)
+            offset += RECORD.size
+            if delta == GAP:
+                if offset + ABSOLUTE.size > len(data):
+                    break
+                now = ABSOLUTE.unpack_from(data, offset)[0]
+                offset += ABSOLUTE.size
+                continue
+            if offset + length > len(data):
+                break
+            now += delta / 1000000
+            yield now, view[offset:offset + length]
+            offset += length
@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+
+import socket
+import time
+from instruments import instruments
+
+# Client side of the bus multiplexer. With bus set in [query], eg
+#   bus = tcp:127.0.0.1:5020
+#   bus = unix:/run/modbusbus/bus.sock
+# programs talk to the multiplexer instead of opening the serial port, so
+# several can share the bus. Without it they open the port as before.
+#
+# A port may also be an Ethernet to RS485 gateway, eg
+#   port = tcp://192.168.1.50:502        Modbus TCP, the gateway converts to RTU
+#   port = rtu+tcp://192.168.1.51:8899   RTU frames passed through a TCP socket
+# anything else is a serial port. Gateways are reached directly, the
+# multiplexer only stands in for local serial ports.
+
+
+def unixModbusClient(path, **kwargs):
+    # Modbus TCP framing over a Unix socket. pymodbus is imported when the
+    # first client is made rather than when this module loads.
+    from pymodbus.client.sync import ModbusTcpClient
+
+    class UnixModbusClient(ModbusTcpClient):
+
+        def __init__(self, path, **kwargs):
+            ModbusTcpClient.__init__(self, host=path, **kwargs)
+            self.path = path
+
+        def connect(self):
+            if self.socket:
+                return True
+            try:
+                self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                self.socket.settimeout(self.timeout)
+                self.socket.connect(self.path)
+            except socket.error as msg:
+                print(f'Connection to {self.path} failed: {msg}')
+                self.close()
+            return self.socket is not None
+
+    return UnixModbusClient(path, **kwargs)
+
+
+def transport(port):
+    # (kind, host, tcp port) for a gateway, (serial, path, None) otherwise
+    for kind in ('tcp', 'rtu+tcp'):
+        if port.startswith(kind + '://'):
+            host, _, tcpPort = port[len(kind) + 3:].rstrip('/').partition(':')
+            return kind, host, int(tcpPort) if tcpPort != '' else 502
+    return 'serial', port, None
+
+
+def isSerial(port):
+    return transport(port)[0] == 'serial'
+
+
+def modbusClient(settings, port, option='bus', timeout=1, baudrate=9600):
+    # a connected client for the port, or for the multiplexer if one is configured
+    from pymodbus.client.sync import ModbusSerialClient, ModbusTcpClient
+    kind, host, tcpPort = transport(port)
+    if kind == 'tcp':
+        client = ModbusTcpClient(host, port=tcpPort, timeout=timeout)
+        client.connect()
+        return client
+    if kind == 'rtu+tcp':
+        from pymodbus.transaction import ModbusRtuFramer
+        client = ModbusTcpClient(host, port=tcpPort, framer=ModbusRtuFramer, timeout=timeout)
+        client.connect()
+        return client
+    bus = settings.get('query', option, fallback=settings.get('query', 'bus', fallback=''))
+    if bus == '' and settings.has_section('timing'):
+        # our own RTU master, with timeouts learned per unit
+        from busMultiplexer import RtuMaster
+        from rtuTransport import AdaptiveTiming, RtuClient
+        timing = AdaptiveTiming(settings, timeout)
+        client = RtuClient(RtuMaster(port, baudrate, timeout, timing, settings.getfloat('timing', 'slack', fallback=0.05)))
+        client.connect()
+        return client
+    if bus != '':
+        # requests may queue behind others, and the multiplexer has its own bus timeout
+        timeout = settings.getfloat('query', 'bus_timeout', fallback=5)
+    if bus.startswith('tcp:'):
+        host, tcpPort = bus[4:].rsplit(':', 1)
+        client = ModbusTcpClient(host, port=int(tcpPort), timeout=timeout)
+    elif bus.startswith('unix:'):
+        client = unixModbusClient(bus[5:], timeout=timeout)
+    else:
+        client = ModbusSerialClient(method='rtu', port=port, baudrate=baudrate, stopbits=1, parity='N', bytesize=8, timeout=timeout)
+    client.connect()
+    return client
+
+
+def usesBus(settings):
+    return settings.get('query', 'bus', fallback='') != ''
+
+
+class PooledClient:
+
+    # a port's client that is reopened when its connection fails. A refused
+    # or dropped connection backs off, doubling from backoff to maxBackoff
+    # seconds, and while backing off requests fail at once without touching
+    # the network, so a gateway that is down costs its inverters nothing but
+    # the offline interval. A gateway's connection is also reopened after a
+    # request goes unanswered, pymodbus doesn't notice a half open socket and
+    # a late RTU reply would otherwise be taken as the answer to the next
+    # request.
+
+    def __init__(self, factory, port, backoff=1, maxBackoff=60):
+        self.factory = factory
+        self.port = port
+        self.network = not isSerial(port)
+        self.minBackoff = backoff
+        self.maxBackoff = maxBackoff
+        self.backoff = backoff
+        self.retryAt = 0
+        self.client = None
+
+    def __getattr__(self, name):
+        return getattr(self._get(), name)
+
+    def _get(self):
+        if self.client is None:
+            self.client = self.factory()
+            instruments.inc('transport_connects_total', port=self.port)
+        return self.client
+
+    def _close(self):
+        if self.client is not None:
+            try:
+                self.client.close()
+            except Exception:
+                pass
+            self.client = None
+
+    def _failed(self, err):
+        self._close()
+        self.retryAt = time.time() + self.backoff
+        print(f'{self.port} connection failed, retry in {self.backoff}s {err}')
+        self.backoff = min(self.backoff * 2, self.maxBackoff)
+        instruments.inc('transport_connection_failures_total', port=self.port)
+        instruments.gauge('transport_connected', 0, port=self.port)
+
+    def _call(self, name, args, kwargs):
+        from pymodbus.exceptions import ModbusException, ModbusIOException
+        if time.time() < self.retryAt:
+            instruments.inc('transport_fast_failures_total', port=self.port)
+            return ModbusIOException(f'{self.port} is backing off')
+        try:
+            client = self._get()
+            if not client.connect():
+                raise ConnectionError(f'{self.port} connect failed')
+            response = getattr(client, name)(*args, **kwargs)
+        except (ModbusException, OSError) as err:
+            self._failed(err)
+            return ModbusIOException(str(err))
+        self.backoff = self.minBackoff
+        instruments.gauge('transport_connected', 1, port=self.port)
+        if self.network and isinstance(response, ModbusIOException):
+            self._close()
+        return response
+
+    def close(self):
+        self._close()
+
+    def read_holding_registers(self, address, count=1, unit=0, **kwargs):
+        return self._call('read_holding_registers', (address,), dict(kwargs, count=count, unit=unit))
+
+    def read_input_registers(self, address, count=1, unit=0, **kwargs):
+        return self._call('read_input_registers', (address,), dict(kwargs, count=count, unit=unit))
+
+    def write_register(self, address, value, unit=0, **kwargs):
+        return self._call('write_register', (address, value), dict(kwargs, unit=unit))
+
+    def write_registers(self, address, values, unit=0, **kwargs):
+        return self._call('write_registers', (address, values), dict(kwargs, unit=unit))
+
+
+class ConnectionPool:
+
+    # one pooled client per port, a serial port or a gateway. Each inverter
+    # section may set its own port, and for a port the first section using it
+    # may set baudrate and timeout, falling back to [query].
+
+    def __init__(self, settings, wrap=None):
+        self.settings = settings
+        self.wrap = wrap
+        self.backoff = settings.getfloat('query', 'reconnect_backoff', fallback=1)
+        self.maxBackoff = settings.getfloat('query', 'reconnect_max_backoff', fallback=60)
+        self.clients = {}
+
+    def _option(self, section, name, fallback):
+        return self.settings.get(section, name, fallback=self.settings.get('query', name, fallback=fallback))
+
+    def client(self, port, section='query'):
+        if port not in self.clients:
+            baudrate = int(self._option(section, 'baudrate', 9600))
+            timeout = float(self._option(section, 'timeout', 1))
+
+            def factory():
+                client = modbusClient(self.settings, port, timeout=timeout, baudrate=baudrate)
+                return client if self.wrap is None else self.wrap(client, port)
+            self.clients[port] = PooledClient(factory, port, self.backoff, self.maxBackoff)
+        return self.clients[port]
+
+    def close(self):
+        for client in self.clients.values():
+            client.close()
@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+
+import asyncio
+import itertools
+import struct
+import time
+import serial
+from concurrent.futures import ThreadPoolExecutor
+from modbusFrame import READ_HOLDING, READ_INPUT, WRITE_SINGLE, WRITE_MULTIPLE, EXCEPTION, checkCrc, withCrc
+from instruments import instruments
+from rtuTransport import characterTime, frameGap, waitUntil
+
+# Shares one RTU bus between programs. The multiplexer owns the serial port
+# and serves Modbus TCP framed requests on localhost TCP ports and a Unix
+# socket. Requests go through one priority queue, writes first, then reads
+# from the normal listeners, then reads from the bulk listener used by scans
+# and dumps. A read identical to one already queued or on the wire is not
+# sent again, it shares the first one's response.
+
+CONTROL = 0
+NORMAL = 1
+BULK = 2
+
+READ_COILS = 1
+READ_DISCRETE = 2
+WRITE_COIL = 5
+WRITE_COILS = 15
+READS = (READ_COILS, READ_DISCRETE, READ_HOLDING, READ_INPUT)
+WRITES = (WRITE_COIL, WRITE_SINGLE, WRITE_COILS, WRITE_MULTIPLE)
+# gateway target device failed to respond
+TARGET_FAILED = 0x0B
+
+
+class RtuMaster:
+
+    def __init__(self, port, baudrate=9600, timeout=1, timing=None, slack=0.05):
+        self.port = port
+        self.timeout = timeout
+        # AdaptiveTiming, or None for a fixed timeout for every unit
+        self.timing = timing
+        # allowed for USB adapter latency and scheduling once a response has started
+        self.slack = slack
+        self.serial = None
+        self.setBaudrate(baudrate)
+        # the speed to fall back to when no probe unit answers
+        self.configured = baudrate
+        self.lastFrame = 0
+        self.nextProbe = None
+
+    def setBaudrate(self, baudrate):
+        self.baudrate = baudrate
+        self.character = characterTime(baudrate)
+        # the 3.5 character silence between frames
+        self.gap = frameGap(baudrate)
+        if self.serial is not None:
+            self.serial.baudrate = baudrate
+        instruments.gauge('rtu_baudrate', baudrate, port=self.port)
+
+    def connect(self):
+        self.serial = serial.Serial(self.port, self.baudrate, bytesize=8, parity='N', stopbits=1, timeout=self.timeout)
+        if self.timing is not None and len(self.timing.baudrates) > 0:
+            self.probe()
+
+    def close(self):
+        if self.serial is not None:
+            self.serial.close()
+            self.serial = None
+
+    def probe(self):
+        # uses the fastest of the timing's baudrates one of its probeUnits
+        # answers at, any response will do, even an exception. If none answer,
+        # eg the inverters are asleep, the configured speed is kept and the
+        # probe is tried again later.
+        for baudrate in self.timing.baudrates:
+            self.setBaudrate(baudrate)
+            for unit in self.timing.probeUnits:
+                if self._transact(unit, struct.pack('>BHH', READ_HOLDING, 0, 1), self.timeout)[0] is not None:
+                    print(f'{self.port} unit {unit} answers at {baudrate} baud')
+                    self.nextProbe = None
+                    return baudrate
+        self.setBaudrate(self.configured)
+        self.nextProbe = time.time() + self.timing.maxProbeInterval
+        return None
+
+    def _read(self, count, deadline):
+        data = b''
+        while len(data) < count:
+            self.serial.timeout = max(0.001, deadline - time.perf_counter())
+            chunk = self.serial.read(count - len(data))
+            if len(chunk) == 0:
+                return None
+            data += chunk
+        return data
+
+    def transact(self, unit, pdu):
+        # sends one request, returns the response pdu or None on timeout, a
+        # bad frame or while the unit's circuit is open
+        if self.timing is None:
+            return self._transact(unit, pdu, self.timeout)[0]
+        now = time.time()
+        if self.nextProbe is not None and now > self.nextProbe:
+            self.probe()
+        if not self.timing.allow(unit, now):
+            return None
+        response, latency = self._transact(unit, pdu, self.timing.timeout(unit))
+        if response is not None:
+            self.timing.success(unit, latency)
+        else:
+            self.timing.failure(unit, now, latency is None)
+        return response
+
+    def _transact(self, unit, pdu, timeout):
+        # returns the response pdu and the time the unit took to start
+        # answering, (None, latency) for a bad frame, (None, None) on timeout
+        waitUntil(self.lastFrame + self.gap)
+        self.serial.reset_input_buffer()
+        request = withCrc(bytes([unit]) + pdu)
+        self.serial.write(request)
+        # write returns once the adapter has the request, it is on the wire
+        # for its length in characters
+        sent = time.perf_counter() + len(request) * self.character
+        try:
+            first = self._read(1, sent + timeout)
+            if first is None:
+                return None, None
+            latency = time.perf_counter() - sent
+            rest = self._read(2, time.perf_counter() + 2 * self.character + self.slack)
+            if rest is None:
+                return None, latency
+            header = first + rest
+            function = header[1]
+            if function & EXCEPTION:
+                length = 5
+            elif function in READS:
+                length = 5 + header[2]
+            elif function in WRITES:
+                length = 8
+            else:
+                return None, latency
+            rest = self._read(length - 3, time.perf_counter() + (length - 3) * self.character + self.slack)
+            if rest is None:
+                return None, latency
+            frame = header + rest
+            if frame[0] != unit or not checkCrc(frame, 0, length):
+                instruments.inc('bus_bad_frames_total')
+                return None, latency
+            return frame[1:-2], latency
+        finally:
+            self.lastFrame = time.perf_counter()
+
+
+class BusMultiplexer:
+
+    def __init__(self, settings, master):
+        self.master = master
+        self.listeners = []
+        tcp = settings.get('bus', 'tcp', fallback='127.0.0.1:5020')
+        if tcp != '':
+            self.listeners.append(('tcp', tcp, NORMAL))
+        bulkTcp = settings.get('bus', 'bulkTcp', fallback='127.0.0.1:5021')
+        if bulkTcp != '':
+            self.listeners.append(('tcp', bulkTcp, BULK))
+        unix = settings.get('bus', 'unix', fallback='')
+        if unix != '':
+            self.listeners.append(('unix', unix, NORMAL))
+        self.debug = settings.get('bus', 'debug', fallback='0')
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='bus')
+        self.sequence = itertools.count()
+        self.inflight = {}
+        self.queue = None
+
+    def run(self):
+        asyncio.run(self._main())
+
+    async def _main(self):
+        self.queue = asyncio.PriorityQueue()
+        servers = []
+        for kind, address, priority in self.listeners:
+            handler = lambda reader, writer, priority=priority: self._client(reader, writer, priority)
+            if kind == 'unix':
+                servers.append(await asyncio.start_unix_server(handler, path=address))
+            else:
+                host, port = address.rsplit(':', 1)
+                servers.append(await asyncio.start_server(handler, host, int(port)))
+            print(f'Listening on {kind} {address}')
+        await self._worker()
+
+    async def _client(self, reader, writer, priority):
+        pending = set()
+        try:
+            while True:
+                header = await reader.readexactly(7)
+                transaction, protocol, length, unit = struct.unpack('>HHHB', header)
+                pdu = await reader.readexactly(length - 1)
+                # clients may pipeline, each request is answered when its turn comes
+                task = asyncio.create_task(self._answer(writer, transaction, unit, pdu, priority))
+                pending.add(task)
+                task.add_done_callback(pending.discard)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            for task in pending:
+                task.cancel()
+            writer.close()
+
+    async def _answer(self, writer, transaction, unit, pdu, priority):
+        response = await self.submit(unit, pdu, priority)
+        writer.write(struct.pack('>HHHB', transaction, 0, len(response) + 1, unit) + response)
+        await writer.drain()
+
+    def submit(self, unit, pdu, priority=NORMAL):
+        # returns a future of the response pdu
+        function = pdu[0]
+        if function in WRITES:
+            priority = CONTROL
+        key = (unit, bytes(pdu)) if function in READS else None
+        if key is not None and key in self.inflight:
+            instruments.inc('bus_merged_total')
+            return asyncio.shield(self.inflight[key])
+        future = asyncio.get_running_loop().create_future()
+        if key is not None:
+            self.inflight[key] = future
+        self.queue.put_nowait((priority, next(self.sequence), unit, bytes(pdu), key, future))
+        instruments.inc('bus_requests_total', priority=priority)
+        instruments.gauge('bus_queue_depth', self.queue.qsize())
+        return asyncio.shield(future)
+
+    async def _worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            priority, sequence, unit, pdu, key, future = await self.queue.get()
+            started = time.perf_counter()
+            try:
+                response = await loop.run_in_executor(self.executor, self.master.transact, unit, pdu)
+            except Exception as err:
+                print(f'Bus error {err}')
+                response = None
+            if response is None:
+                instruments.inc('bus_timeouts_total', unit=unit)
+                response = bytes([pdu[0] | EXCEPTION, TARGET_FAILED])
+            instruments.observe('bus_transaction_seconds', time.perf_counter() - started, unit=unit, function=pdu[0])
+            if self.debug == '1':
+                print(f'unit {unit} priority {priority} request {pdu.hex()} response {response.hex()}')
+            if key is not None:
+                self.inflight.pop(key, None)
+            if not future.cancelled():
+                future.set_result(response)
+            instruments.gauge('bus_queue_depth', self.queue.qsize())
@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+
+import array
+import atexit
+import os
+import threading
+import time
+from instruments import instruments
+
+# Times the phases of every cycle, a poll, a publish or an export evaluation
+# in solarmon, a sample or update in the gateway, so an overrun can be put
+# down to the serial wait, decoding, the recorder or the export analysis.
+# Phases nest, each is timed with perf_counter_ns and the time not spent in
+# its children is its self time. Enabled by a [profile] section, or PROFILE=1
+# in the environment as DEBUG is, otherwise cycle() and phase() return a
+# shared context that does nothing.
+#
+# Every dumpInterval seconds it writes to path:
+#   <name>.folded      self time of every phase stack in microseconds, in the
+#                      collapsed stack format of flamegraph.pl and speedscope
+#   <name>.percentiles p50, p90, p99 and max of each phase over its last
+#                      window cycles, also served on the [metrics] endpoint
+# and with csv = 1 appends a row per phase of every cycle to <name>.csv.
+# A cycle longer than its budget is counted and, with debug, printed.
+#
+#   with profile.cycle('poll', inverter['name'], interval):
+#       with profile.phase('read'):
+#           ...
+
+NS = 1000000000
+
+
+class _Null:
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+NULL = _Null()
+
+
+class _Phase:
+
+    # reused for every phase on a thread, phase() sets the name to push
+
+    def __init__(self, profiler, local):
+        self.profiler = profiler
+        self.local = local
+        self.name = None
+
+    def __enter__(self):
+        local = self.local
+        parent = local.stack[-1][0] if local.stack else self.profiler.name
+        local.stack.append([parent + ';' + self.name, time.perf_counter_ns(), 0])
+        return self
+
+    def __exit__(self, *args):
+        local = self.local
+        path, started, children = local.stack.pop()
+        total = time.perf_counter_ns() - started
+        local.records.append((path, total - children, total))
+        if local.stack:
+            local.stack[-1][2] += total
+        elif local.skip:
+            local.skip = False
+            local.records = []
+        else:
+            self.profiler._finish(local, path, total)
+        return False
+
+
+class Series:
+
+    # the last window totals of a phase, for percentiles
+
+    def __init__(self, window):
+        self.totals = array.array('q', bytes(8 * window))
+        self.count = 0
+
+    def add(self, total):
+        self.totals[self.count % len(self.totals)] = total
+        self.count += 1
+
+    def percentiles(self):
+        values = sorted(self.totals[:min(self.count, len(self.totals))])
+        if len(values) == 0:
+            return None
+        pick = lambda p: values[min(len(values) - 1, int(len(values) * p))]
+        return pick(0.5), pick(0.9), pick(0.99), values[-1]
+
+
+class CycleProfiler:
+
+    def __init__(self, settings, name):
+        self.name = name
+        self.enabled = settings.has_section('profile') or os.environ.get('PROFILE', '0') not in ('', '0')
+        self.path = settings.get('profile', 'path', fallback='./profile')
+        self.window = settings.getint('profile', 'window', fallback=1000)
+        self.dumpInterval = settings.getfloat('profile', 'dumpInterval', fallback=300)
+        self.csv = settings.getint('profile', 'csv', fallback=0) == 1
+        self.debug = settings.getint('profile', 'debug', fallback=0) == 1
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.folded = {}
+        self.series = {}
+        self.cycles = 0
+        self.csvFile = None
+        self.lastDump = time.time()
+        if self.enabled:
+            os.makedirs(self.path, exist_ok=True)
+            atexit.register(self.dump)
+            print(f'Profiling cycles to {self.path}')
+
+    def _thread(self):
+        local = self.local
+        if not hasattr(local, 'stack'):
+            local.stack = []
+            local.records = []
+            local.phase = _Phase(self, local)
+            local.label = ''
+            local.budget = None
+            local.started = 0
+            local.skip = False
+        return local
+
+    def cycle(self, name, label='', budget=None):
+        # a cycle is the outermost phase, budget is the seconds it should take
+        if not self.enabled:
+            return NULL
+        local = self._thread()
+        if local.stack:
+            # inside another cycle it is just a phase of it
+            local.phase.name = name
+            return local.phase
+        local.label = label
+        local.budget = budget
+        local.started = time.time()
+        local.phase.name = name
+        return local.phase
+
+    def skip(self):
+        # drops the current cycle when it ends, for an idle pass of a polling
+        # loop that would otherwise fill the profile with empty cycles
+        if not self.enabled:
+            return
+        self._thread().skip = True
+
+    def phase(self, name):
+        if not self.enabled:
+            return NULL
+        local = self._thread()
+        if not local.stack:
+            # outside a cycle, nothing to add it to
+            return NULL
+        local.phase.name = name
+        return local.phase
+
+    def _finish(self, local, path, total):
+        records = local.records
+        local.records = []
+        with self.lock:
+            self.cycles += 1
+            for phase, own, phaseTotal in records:
+                self.folded[phase] = self.folded.get(phase, 0) + own
+                series = self.series.get(phase)
+                if series is None:
+                    series = Series(self.window)
+                    self.series[phase] = series
+                series.add(phaseTotal)
+            if self.csv:
+                self._writeCsv(local, records)
+            due = time.time() > self.lastDump + self.dumpInterval
+            if due:
+                # only one thread dumps
+                self.lastDump = time.time()
+        if local.budget is not None and total > local.budget * NS:
+            instruments.inc('profile_overruns_total', cycle=path)
+            if self.debug:
+                print(f'{path} {local.label} took {total / 1e6:.1f}ms, ' +
+                      ', '.join(f'{phase[len(path) + 1:]} {own / 1e6:.1f}ms' for phase, own, t in records if phase != path))
+        if due:
+            self.dump()
+
+    def _writeCsv(self, local, records):
+        if self.csvFile is None:
+            name = os.path.join(self.path, f'{self.name}.csv')
+            exists = os.path.exists(name)
+            self.csvFile = open(name, 'a', buffering=65536)
+            if not exists:
+                self.csvFile.write('cycle,time,label,phase,self_us,total_us\n')
+        for phase, own, total in records:
+            self.csvFile.write(f'{self.cycles},{local.started:.6f},{local.label},{phase},{own // 1000},{total // 1000}\n')
+
+    def dump(self):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.lastDump = time.time()
+            folded = sorted(self.folded.items())
+            percentiles = [(phase, series.percentiles(), series.count) for phase, series in sorted(self.series.items())]
+            if self.csvFile is not None:
+                self.csvFile.flush()
+        tmp = os.path.join(self.path, f'{self.name}.folded.tmp')
+        with open(tmp, 'w') as f:
+            for phase, own in folded:
+                f.write(f'{phase} {own // 1000}\n')
+        os.replace(tmp, os.path.join(self.path, f'{self.name}.folded'))
+        tmp = os.path.join(self.path, f'{self.name}.percentiles.tmp')
+        with open(tmp, 'w') as f:
+            f.write(f'{"phase":<40} {"count":>8} {"p50 ms":>9} {"p90 ms":>9} {"p99 ms":>9} {"max ms":>9}\n')
+            for phase, result, count in percentiles:
+                if result is None:
+                    continue
+                f.write(f'{phase:<40} {count:>8} ' + ' '.join(f'{value / 1e6:>9.3f}' for value in result) + '\n')
+                for quantile, value in zip(('0.5', '0.9', '0.99', '1'), result):
+                    instruments.gauge('profile_phase_seconds', value / NS, phase=phase, quantile=quantile)
+        os.replace(tmp, os.path.join(self.path, f'{self.name}.percentiles'))
+
+
+class ProfiledClient:
+
+    # times every transaction on a client as a serial phase of the cycle
+
+    def __init__(self, client, profiler):
+        self.client = client
+        self.profiler = profiler
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+    def read_holding_registers(self, *args, **kwargs):
+        with self.profiler.phase('serial'):
+            return self.client.read_holding_registers(*args, **kwargs)
+
+    def read_input_registers(self, *args, **kwargs):
+        with self.profiler.phase('serial'):
+            return self.client.read_input_registers(*args, **kwargs)
+
+    def write_register(self, *args, **kwargs):
+        with self.profiler.phase('serial'):
+            return self.client.write_register(*args, **kwargs)
+
+    def write_registers(self, *args, **kwargs):
+        with self.profiler.phase('serial'):
+            return self.client.write_registers(*args, **kwargs)
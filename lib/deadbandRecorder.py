@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+
+# Change only publishing in front of a MetricsRecorder.
+# A field is only sent when it has moved outside its deadband since it was
+# last sent. Fields without a deadband are sent when they change. Every
+# keyframeInterval seconds a measurement is sent in full so dashboards always
+# have a recent value for every field. Deadbands are set per field in the
+# [deadband] section, absolute or relative to the last sent value, eg
+#   Ppv = 5
+#   Vpv1 = 1%
+
+
+class DeadbandRecorder:
+
+    def __init__(self, recorder, settings, metrics):
+        self.recorder = recorder
+        self.metrics = metrics
+        self.keyframeInterval = settings.getfloat('deadband', 'keyframeInterval', fallback=60)
+        self.bands = {}
+        for name, value in settings.items('deadband'):
+            if name == 'keyframeinterval':
+                continue
+            if value.endswith('%'):
+                self.bands[name] = (0, float(value[:-1]) / 100)
+            else:
+                self.bands[name] = (float(value), 0)
+        # last sent values and keyframe time per measurement and tags
+        self.sent = {}
+
+    def __getattr__(self, name):
+        return getattr(self.recorder, name)
+
+    def changed(self, name, value, last):
+        if isinstance(value, bool) or not isinstance(value, (int, float)) \
+                or not isinstance(last, (int, float)):
+            return value != last
+        # config keys are lower case
+        band = self.bands.get(name.lower())
+        if band is None:
+            return value != last
+        absolute, relative = band
+        return abs(value - last) > max(absolute, relative * abs(last))
+
+    def add(self, now, measurement, info, interval, tags):
+        if info is None:
+            return
+        key = (measurement, repr(tags))
+        state = self.sent.get(key)
+        if state is None or now - state['keyframe'] >= self.keyframeInterval:
+            self.sent[key] = {'keyframe': now, 'values': dict(info)}
+            self.metrics.inc('deadband.keyframes')
+            self.recorder.add(now, measurement, info, interval, tags)
+            return
+        values = state['values']
+        changes = {}
+        for name, value in info.items():
+            if name not in values or self.changed(name, value, values[name]):
+                changes[name] = value
+                values[name] = value
+                self.metrics.inc('deadband.fieldsSent')
+            else:
+                self.metrics.inc('deadband.fieldsSuppressed')
+        if len(changes) == 0:
+            self.metrics.inc('deadband.pointsSuppressed')
+            return
+        self.recorder.add(now, measurement, changes, interval, tags)
+
+    def send(self):
+        self.recorder.send()
@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+
+import heapq
+import itertools
+import selectors
+import time
+import traceback
+from instruments import instruments
+
+# Minimal single threaded event loop, readers on file descriptors with
+# selectors (epoll on Linux) and a heap of timers. The loop sleeps in select()
+# until a descriptor is readable or the earliest timer is due, so an idle bus
+# costs no CPU. A callback that raises is printed and counted, and the loop
+# carries on.
+
+
+class EventLoop:
+
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+        self.timers = []
+        self.counter = itertools.count()
+        self.running = False
+
+    def addReader(self, fileobj, callback):
+        self.selector.register(fileobj, selectors.EVENT_READ, callback)
+
+    def removeReader(self, fileobj):
+        self.selector.unregister(fileobj)
+
+    def callAt(self, when, callback, *args):
+        heapq.heappush(self.timers, (when, next(self.counter), callback, args))
+
+    def callLater(self, delay, callback, *args):
+        self.callAt(time.time() + delay, callback, *args)
+
+    def stop(self):
+        self.running = False
+
+    def run(self):
+        self.running = True
+        while self.running:
+            timeout = None
+            if len(self.timers) > 0:
+                timeout = max(0, self.timers[0][0] - time.time())
+            for key, events in self.selector.select(timeout):
+                self._call(key.data)
+            now = time.time()
+            while len(self.timers) > 0 and self.timers[0][0] <= now:
+                when, _, callback, args = heapq.heappop(self.timers)
+                self._call(callback, *args)
+
+    def _call(self, callback, *args):
+        try:
+            callback(*args)
+        except Exception as err:
+            instruments.inc('event_loop_exceptions_total', callback=callback.__name__)
+            traceback.print_exc()
+            print(err)
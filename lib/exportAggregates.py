@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+
+import glob
+import json
+import os
+import time
+from binarySeries import Segment, HEADER_SIZE, SUFFIX
+
+# Rolling export/import energy aggregates built incrementally from the files
+# the gateway writes.
+# Each file is tracked by inode and read offset, so a refresh only parses what
+# was appended since the last one. Readings of the meter's cumulative energy
+# counters are folded into fixed width buckets holding the min and max reading
+# seen, which makes re-reading a rotated file harmless. A query over a window
+# is then O(buckets) rather than O(samples). The state is persisted so a
+# restart does not re-read the whole history. Both the JSON files and the
+# binary time series segments the gateway can write are understood.
+
+EXPORT = 0
+IMPORT = 1
+
+
+def pointsFrom(obj):
+    # accepts influx style points, lists of them or flat records with a time
+    if isinstance(obj, list):
+        for o in obj:
+            yield from pointsFrom(o)
+    elif isinstance(obj, dict):
+        if 'fields' in obj:
+            yield obj.get('time'), obj.get('measurement'), obj['fields']
+        elif 'time' in obj:
+            yield obj['time'], obj.get('measurement'), obj
+
+
+def toSeconds(t):
+    if t is None:
+        return None
+    t = float(t)
+    if t > 1e15:
+        return t / 1e9
+    if t > 1e12:
+        return t / 1e3
+    return t
+
+
+class ExportAggregates:
+
+    def __init__(self, settings):
+        # solarmon runs beside the gateway directory the gateway writes into
+        self.dataPath = settings.get('export', 'dataPath', fallback='gateway/gatewayData')
+        self.statePath = settings.get('export', 'statePath', fallback='exportAggregates.json')
+        self.measurement = settings.get('export', 'measurement', fallback=None)
+        self.exportField = settings.get('export', 'exportField', fallback='ExportActiveEnergy')
+        self.importField = settings.get('export', 'importField', fallback='ImportActiveEnergy')
+        self.bucketInterval = settings.getint('export', 'bucketInterval', fallback=900)
+        self.retention = settings.getint('export', 'retention', fallback=8*24*3600)
+        self.refreshInterval = settings.getint('export', 'refreshInterval', fallback=60)
+        self.lastRefresh = 0
+        self.files = {}
+        self.buckets = {}
+        self._loadState()
+
+    def _loadState(self):
+        try:
+            with open(self.statePath) as f:
+                state = json.load(f)
+            self.files = state['files']
+            self.buckets = {int(k): v for k, v in state['buckets'].items()}
+        except (OSError, ValueError, KeyError):
+            self.files = {}
+            self.buckets = {}
+
+    def _saveState(self):
+        with open(self.statePath + '.tmp', 'w') as f:
+            json.dump({'files': self.files, 'buckets': self.buckets}, f)
+        os.replace(self.statePath + '.tmp', self.statePath)
+
+    def _dataFiles(self):
+        # files starting with dataPath, and the files in directories that do,
+        # where the binary series go
+        paths = []
+        for path in glob.glob(glob.escape(self.dataPath) + '*'):
+            if os.path.isdir(path):
+                paths.extend(os.path.join(path, f) for f in os.listdir(path))
+            else:
+                paths.append(path)
+        return paths
+
+    def refresh(self, force=False):
+        # reads anything new in the gateway files, at most every refreshInterval
+        now = time.time()
+        if not force and now < self.lastRefresh + self.refreshInterval:
+            return
+        self.lastRefresh = now
+        changed = False
+        seen = {}
+        paths = self._dataFiles()
+        if len(paths) == 0:
+            print(f'No gateway data files at {self.dataPath}')
+        for path in paths:
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            tracked = self.files.get(path)
+            if tracked is None or tracked['inode'] != st.st_ino or st.st_size < tracked['offset']:
+                tracked = {'inode': st.st_ino, 'offset': 0, 'mtime': 0, 'document': False}
+            if tracked.get('document') and (st.st_size != tracked['offset'] or st.st_mtime != tracked['mtime']):
+                # a single JSON document can't be read from the middle
+                tracked['offset'] = 0
+            if st.st_size > tracked['offset']:
+                tracked['offset'], tracked['document'] = self._readFrom(path, tracked['offset'])
+                tracked['mtime'] = st.st_mtime
+                changed = True
+            seen[path] = tracked
+        self.files = seen
+
+        oldest = now - self.retention
+        for start in [b for b in self.buckets if b < oldest]:
+            del self.buckets[start]
+            changed = True
+        if changed:
+            self._saveState()
+
+    def _readFrom(self, path, offset):
+        # returns the offset to read from next and whether the file is a
+        # single JSON document rather than one per line
+        if path.endswith(SUFFIX):
+            return self._readSegment(path, offset), False
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            data = f.read()
+        if offset == 0:
+            try:
+                document = json.loads(data)
+            except ValueError:
+                document = None
+            if document is not None:
+                self.addRecord(document)
+                return len(data), True
+        end = data.rfind(b'\n') + 1
+        lines = data[:end].splitlines()
+        for line in lines:
+            if len(line.strip()) == 0:
+                continue
+            try:
+                self.addRecord(json.loads(line))
+            except ValueError:
+                continue
+        return offset + end, False
+
+    def _readSegment(self, path, offset):
+        try:
+            segment = Segment(path)
+        except ValueError:
+            return offset
+        fromRecord = max(0, offset - HEADER_SIZE) // segment.record.size
+        rows = segment.read(fromRecord=fromRecord)
+        if self.measurement is None or segment.measurement == self.measurement:
+            for t, fields in rows:
+                self.addReading(t, fields.get(self.exportField), fields.get(self.importField))
+        return HEADER_SIZE + (fromRecord + len(rows)) * segment.record.size
+
+    def addRecord(self, obj):
+        for t, measurement, fields in pointsFrom(obj):
+            if self.measurement is not None and measurement is not None and measurement != self.measurement:
+                continue
+            self.addReading(toSeconds(t), fields.get(self.exportField), fields.get(self.importField))
+
+    def addReading(self, t, exportKwh, importKwh):
+        if t is None:
+            return
+        start = int(t // self.bucketInterval) * self.bucketInterval
+        bucket = self.buckets.get(start)
+        if bucket is None:
+            bucket = self.buckets[start] = [None, None, None, None]
+        for i, value in ((EXPORT, exportKwh), (IMPORT, importKwh)):
+            if value is None:
+                continue
+            value = float(value)
+            if bucket[i*2] is None or value < bucket[i*2]:
+                bucket[i*2] = value
+            if bucket[i*2+1] is None or value > bucket[i*2+1]:
+                bucket[i*2+1] = value
+
+    def _energy(self, buckets, i):
+        # energy counted within each bucket plus the step between buckets,
+        # ignoring steps down where the meter counter was reset.
+        total = 0
+        last = None
+        for bucket in buckets:
+            low, high = bucket[i*2], bucket[i*2+1]
+            if low is None:
+                continue
+            total += high - low
+            if last is not None and low > last:
+                total += low - last
+            last = high
+        return total
+
+    def analyse(self, start, end):
+        # None when there are no readings in the window, rather than 0 kWh
+        buckets = [self.buckets[b] for b in sorted(self.buckets) if start <= b < end]
+        if len(buckets) == 0:
+            print(f'No export readings from {self.dataPath} between {start:.0f} and {end:.0f}')
+            return None
+        exportKwh = self._energy(buckets, EXPORT)
+        return {
+            'start': start,
+            'end': end,
+            'kwh': exportKwh,
+            'exportKwh': exportKwh,
+            'importKwh': self._energy(buckets, IMPORT),
+            'buckets': len(buckets)
+        }
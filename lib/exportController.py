@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+
+import time
+from registerSnapshot import SnapshotReader
+from instruments import instruments
+
+# Closed loop export limit control from the meter's live power. The gateway
+# publishes the SDM230 ActivePower to its shared memory snapshot every
+# sampleInterval, and on every inverter poll the controller sets the export
+# limit so grid export stays within band watts of the target. The target
+# starts at targetExport and is then the limit the export table gives for the
+# week's export. The limit is the inverter's output less the excess export,
+# scaled by gain, so export above the band pulls the limit down and export
+# below it lets it rise.
+# Inside the band nothing is written. Each change is limited to maxStep watts,
+# writes are at least minInterval seconds apart and limited to writeBudget an
+# hour, so the inverter's EEPROM is not worn out chasing every cloud. If the
+# meter reading is older than staleAfter seconds the limit falls back to
+# failsafeLimit, the G100 failsafe export power, whatever the budget.
+# Every write attempt costs budget, a failed one may still have reached the
+# EEPROM, and its rollback with it. A write that reads back wrong is tried
+# again minInterval later, the failsafe too. Drivers that don't read back
+# return None, and the limit is taken as applied.
+
+
+class ExportController:
+
+    def __init__(self, settings, ratedPower=4200, name=''):
+        self.name = name
+        self.reader = None
+        self.path = settings.get('snapshot', 'path', fallback='/dev/shm/modbusgw.snapshot')
+        self.device = settings.get('snapshot', 'device', fallback='sdm230')
+        self.ratedPower = ratedPower
+        self.target = settings.getfloat('control', 'targetExport', fallback=0)
+        self.band = settings.getfloat('control', 'band', fallback=100)
+        self.gain = settings.getfloat('control', 'gain', fallback=0.7)
+        # the meter reads export as negative power unless wired the other way
+        self.sign = settings.getfloat('control', 'powerSign', fallback=-1)
+        self.minLimit = settings.getfloat('control', 'minLimit', fallback=0)
+        self.maxLimit = settings.getfloat('control', 'maxLimit', fallback=ratedPower)
+        self.maxStep = settings.getfloat('control', 'maxStep', fallback=500)
+        self.minInterval = settings.getfloat('control', 'minInterval', fallback=10)
+        self.writeBudget = settings.getfloat('control', 'writeBudget', fallback=60)
+        self.staleAfter = settings.getfloat('control', 'staleAfter', fallback=30)
+        self.failsafeLimit = settings.getfloat('control', 'failsafeLimit', fallback=self.target)
+        self.limit = None
+        self.output = None
+        self.failsafe = False
+        self.lastWrite = 0
+        # failed writes are retried minInterval apart too
+        self.lastAttempt = 0
+        self.failed = False
+        self.tokens = self.writeBudget
+        self.lastRefill = time.time()
+
+    def setTarget(self, target):
+        # from the export table, evaluated every exportEvaluatePeriod
+        if target != self.target:
+            print(f'{self.name} export target {target}W')
+        self.target = target
+
+    def _reading(self):
+        # (export watts, time read) from the gateway's snapshot, or None
+        try:
+            if self.reader is None:
+                self.reader = SnapshotReader(self.path)
+            else:
+                self.reader.reopen()
+            values, updated, sequence = self.reader.get(self.device)
+        except (OSError, ValueError, KeyError):
+            self.reader = None
+            return None
+        power = values.get('ActivePower')
+        if power is None:
+            return None
+        return self.sign * power, updated
+
+    def _refill(self, now):
+        self.tokens = min(self.writeBudget, self.tokens + (now - self.lastRefill) * self.writeBudget / 3600)
+        self.lastRefill = now
+
+    def _quantize(self, limit):
+        # the inverter takes the limit in 0.1% of its rated power
+        step = self.ratedPower / 1000
+        return round(limit / step) * step
+
+    def step(self, now, info, write):
+        # write(limit) sets the inverter's limit and returns True once it has
+        # read back, False if it failed or None if it can't tell. Returns the
+        # limit applied now, or None.
+        if info is not None and 'Pac' in info:
+            self.output = info['Pac']
+        self._refill(now)
+        reading = self._reading()
+        if reading is None or now - reading[1] > self.staleAfter:
+            if self.failsafe:
+                return None
+            if self.failed and now - self.lastAttempt < self.minInterval:
+                return None
+            print(f'{self.name} meter reading stale, export limit to failsafe {self.failsafeLimit}W')
+            limit = self._write(now, self._quantize(self.failsafeLimit), write)
+            if limit is not None:
+                self.failsafe = True
+                instruments.inc('export_control_failsafe_total', inverter=self.name)
+            return limit
+        export = reading[0]
+        instruments.gauge('export_control_export_watts', export, inverter=self.name)
+        error = export - self.target
+        if not self.failsafe and self.limit is not None and abs(error) <= self.band:
+            return None
+        if self.output is None:
+            return None
+        desired = self.output - self.gain * error
+        current = self.limit if self.limit is not None else self.output
+        desired = min(max(desired, current - self.maxStep), current + self.maxStep)
+        desired = min(max(desired, self.minLimit), self.maxLimit)
+        desired = self._quantize(desired)
+        if self.limit is not None and desired == self.limit:
+            self.failsafe = False
+            return None
+        # leaving the failsafe doesn't wait, unless that write failed
+        if now - self.lastAttempt < self.minInterval and (self.failed or not self.failsafe):
+            return None
+        if self.tokens < 1:
+            instruments.inc('export_control_budget_exhausted_total', inverter=self.name)
+            return None
+        limit = self._write(now, desired, write)
+        if limit is not None:
+            self.failsafe = False
+        return limit
+
+    def _write(self, now, limit, write):
+        self.lastAttempt = now
+        self.tokens = max(0, self.tokens - 1)
+        result = write(limit)
+        self.failed = result is False
+        if self.failed:
+            instruments.inc('export_control_write_failures_total', inverter=self.name)
+            return None
+        if result is None:
+            instruments.inc('export_control_unverified_writes_total', inverter=self.name)
+        self.lastWrite = now
+        self.limit = limit
+        instruments.inc('export_control_writes_total', inverter=self.name)
+        instruments.gauge('export_control_limit_watts', limit, inverter=self.name)
+        return limit
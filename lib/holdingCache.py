@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+
+import time
+from readPlanner import ReadPlanner, HOLDING
+from instruments import instruments
+
+# A cached image of a device's holding registers for the control path.
+# Writes of values the image already holds are skipped, so re-applying an
+# unchanged export limit costs no bus time and no EEPROM write. Changed
+# registers that are adjacent go out together as one write multiple
+# registers (FC16) transaction, and everything written is verified with one
+# planned read back. If a write fails or does not read back the registers
+# already written are put back to their previous values.
+# The image is reloaded after maxAge seconds in case the registers were
+# changed by something else, eg the inverter's own app.
+
+# registers in one write multiple request
+MAX_WRITE = 123
+
+
+def runs(addresses):
+    # sorted addresses grouped into (address, count) runs of adjacent registers
+    result = []
+    for address in sorted(addresses):
+        if len(result) > 0 and result[-1][0] + result[-1][1] == address and result[-1][1] < MAX_WRITE:
+            result[-1][1] += 1
+        else:
+            result.append([address, 1])
+    return [tuple(r) for r in result]
+
+
+class HoldingCache:
+
+    def __init__(self, client, unit, planner=None, maxAge=3600):
+        self.client = client
+        self.unit = unit
+        self.planner = planner if planner is not None else ReadPlanner(maxGap=8)
+        self.maxAge = maxAge
+        self.image = {}
+        self.loaded = 0
+
+    def seed(self, image):
+        # registers already read elsewhere, eg by an info dump
+        self.image.update(image)
+        self.loaded = time.time()
+
+    def load(self, addresses):
+        image, transactions = self.planner.read(self.client, HOLDING, addresses, self.unit)
+        self.image.update(image)
+        return image
+
+    def get(self, address):
+        return self.image.get(address)
+
+    def _writeRun(self, address, values):
+        if len(values) == 1:
+            response = self.client.write_register(address, value=values[0], unit=self.unit)
+        else:
+            response = self.client.write_registers(address, values, unit=self.unit)
+        instruments.inc('holding_write_transactions_total', unit=self.unit)
+        return response is not None and not response.isError()
+
+    def _apply(self, values):
+        # writes each run, returns the runs attempted and whether they all succeeded
+        attempted = []
+        for address, count in runs(values.keys()):
+            attempted.append((address, count))
+            try:
+                ok = self._writeRun(address, [values[a] for a in range(address, address + count)])
+            except Exception as err:
+                print(f'Write to unit {self.unit} register {address} failed {err}')
+                ok = False
+            if not ok:
+                return attempted, False
+        return attempted, True
+
+    def write(self, values):
+        # values is a dict of address to register value, returns True when
+        # the device holds them all
+        if time.time() - self.loaded > self.maxAge:
+            self.image = {}
+            self.loaded = time.time()
+        missing = [a for a in values if a not in self.image]
+        if len(missing) > 0:
+            self.load(missing)
+        changed = {a: v for a, v in values.items() if self.image.get(a) != v}
+        skipped = len(values) - len(changed)
+        if skipped > 0:
+            instruments.inc('holding_writes_skipped_total', skipped, unit=self.unit)
+        if len(changed) == 0:
+            return True
+        previous = {a: self.image.get(a) for a in changed}
+        attempted, ok = self._apply(changed)
+        if ok:
+            readBack = self.load(list(changed.keys()))
+            ok = all(readBack.get(a) == v for a, v in changed.items())
+        if ok:
+            return True
+        self._rollback(previous, attempted)
+        return False
+
+    def _rollback(self, previous, attempted):
+        # the last run attempted may have been partly applied
+        written = {a for address, count in attempted for a in range(address, address + count)}
+        restore = {a: v for a, v in previous.items() if a in written and v is not None}
+        instruments.inc('holding_rollbacks_total', unit=self.unit)
+        print(f'Rolling back unit {self.unit} registers {sorted(restore)}')
+        self._apply(restore)
+        # what the device now holds is uncertain, read it again before the next write
+        for a in written:
+            self.image.pop(a, None)
@@ -0,0 +1,300 @@
+#!/usr/bin/env python3
+
+import atexit
+import base64
+import collections
+import gzip
+import http.client
+import threading
+import time
+import traceback
+from urllib.parse import urlsplit
+from configparser import RawConfigParser
+from instruments import instruments
+
+# Pushes influx line protocol to the Grafana metricsUrlP8S endpoint in
+# batches. Points from every measurement are queued as lines and a flusher
+# thread posts them once batchPoints lines or batchBytes bytes are queued, or
+# flushInterval seconds after the first line of a batch was queued. Bodies are
+# gzip compressed and sent over persistent keep-alive connections, one per
+# flusher, so a point costs a few bytes on the uplink instead of a request and
+# a TLS handshake. The queue holds at most queueSize lines, when the uplink
+# can't keep up the oldest are dropped and counted. The flushers are daemon
+# threads, so what is still queued when the process exits is sent then, for at
+# most exitTimeout seconds.
+
+# nanoseconds per second, the line protocol's default precision
+NS = 1000000000
+
+
+def escapeKey(value):
+    return str(value).replace('\\', '\\\\').replace(',', '\\,').replace('=', '\\=').replace(' ', '\\ ')
+
+
+def fieldValue(value):
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, int):
+        # integer fields as MetricsRecorder sends them
+        return f'{value}i'
+    if isinstance(value, float):
+        return repr(value)
+    return '"' + str(value).replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+def toLine(now, measurement, info, tags):
+    # one line of influx line protocol, None if there are no fields
+    fields = ','.join(f'{escapeKey(k)}={fieldValue(v)}' for k, v in info.items() if v is not None)
+    if fields == '':
+        return None
+    if isinstance(tags, dict):
+        tags = tags.items()
+    tagText = ''.join(f',{escapeKey(k)}={escapeKey(v)}' for k, v in sorted(tags))
+    return f'{escapeKey(measurement)}{tagText} {fields} {int(now * NS)}'
+
+
+class HttpSink:
+
+    def __init__(self, settings, section='push', background=True):
+        url = settings.get(section, 'url', fallback=settings.get('grafana', 'metricsUrlP8S', fallback=''))
+        parts = urlsplit(url)
+        self.https = parts.scheme == 'https'
+        self.host = parts.hostname
+        self.port = parts.port
+        self.path = parts.path + ('?' + parts.query if parts.query != '' else '')
+        self.headers = {'Content-Type': 'text/plain; charset=utf-8'}
+        username = settings.get(section, 'username', fallback=settings.get('grafana', 'username', fallback=''))
+        password = settings.get(section, 'password', fallback=settings.get('grafana', 'password', fallback=''))
+        if username != '':
+            token = base64.b64encode(f'{username}:{password}'.encode('utf-8')).decode('ascii')
+            self.headers['Authorization'] = f'Basic {token}'
+        self.compress = settings.getint(section, 'compress', fallback=1) == 1
+        if self.compress:
+            self.headers['Content-Encoding'] = 'gzip'
+        self.timeout = settings.getfloat(section, 'timeout', fallback=10)
+        self.batchPoints = settings.getint(section, 'batchPoints', fallback=1000)
+        self.batchBytes = settings.getint(section, 'batchBytes', fallback=262144)
+        self.flushInterval = settings.getfloat(section, 'flushInterval', fallback=5)
+        self.maxRetryInterval = settings.getfloat(section, 'maxRetryInterval', fallback=300)
+        self.queueSize = settings.getint(section, 'queueSize', fallback=100000)
+        self.exitTimeout = settings.getfloat(section, 'exitTimeout', fallback=5)
+        self.debug = settings.get(section, 'debug', fallback='0')
+        self.lines = collections.deque()
+        self.queuedBytes = 0
+        self.firstQueued = None
+        self.condition = threading.Condition()
+        self.flushers = []
+        if background:
+            for i in range(settings.getint(section, 'connections', fallback=1)):
+                flusher = threading.Thread(target=self._flush, name=f'push{i}', daemon=True)
+                flusher.start()
+                self.flushers.append(flusher)
+            atexit.register(self.flushAtExit)
+
+    def add(self, line):
+        if line is None:
+            return
+        with self.condition:
+            if len(self.lines) >= self.queueSize:
+                dropped = self.lines.popleft()
+                self.queuedBytes -= len(dropped) + 1
+                instruments.inc('push_dropped_points_total')
+            if len(self.lines) == 0:
+                self.firstQueued = time.time()
+            self.lines.append(line)
+            self.queuedBytes += len(line) + 1
+            if len(self.lines) >= self.batchPoints or self.queuedBytes >= self.batchBytes:
+                self.condition.notify()
+        instruments.gauge('push_queue_depth', len(self.lines))
+
+    def addPoint(self, now, measurement, info, tags=()):
+        self.add(toLine(now, measurement, info, tags))
+
+    def _ready(self):
+        if len(self.lines) == 0:
+            return False
+        return len(self.lines) >= self.batchPoints or self.queuedBytes >= self.batchBytes \
+            or time.time() - self.firstQueued >= self.flushInterval
+
+    def _take(self):
+        # removes up to a batch of lines from the front of the queue
+        batch = []
+        size = 0
+        while len(self.lines) > 0 and len(batch) < self.batchPoints and size < self.batchBytes:
+            line = self.lines.popleft()
+            batch.append(line)
+            size += len(line) + 1
+        self.queuedBytes -= size
+        self.firstQueued = time.time() if len(self.lines) > 0 else None
+        instruments.gauge('push_queue_depth', len(self.lines))
+        return batch
+
+    def _requeue(self, batch):
+        # a failed batch goes back to the front, behind the queue limit
+        with self.condition:
+            room = self.queueSize - len(self.lines)
+            if room < len(batch):
+                instruments.inc('push_dropped_points_total', len(batch) - max(0, room))
+                batch = batch[len(batch) - max(0, room):]
+            for line in reversed(batch):
+                self.lines.appendleft(line)
+                self.queuedBytes += len(line) + 1
+            if self.firstQueued is None and len(self.lines) > 0:
+                self.firstQueued = time.time()
+
+    def _connect(self):
+        if self.https:
+            return http.client.HTTPSConnection(self.host, self.port, timeout=self.timeout)
+        return http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+
+    def post(self, batch, connection=None):
+        # sends one batch, returns the connection to reuse. Raises on failure.
+        body = ('\n'.join(batch) + '\n').encode('utf-8')
+        instruments.inc('push_bytes_total', len(body), encoding='identity')
+        if self.compress:
+            body = gzip.compress(body, compresslevel=6)
+        instruments.inc('push_bytes_total', len(body), encoding='wire')
+        started = time.perf_counter()
+        for attempt in range(2):
+            if connection is None:
+                connection = self._connect()
+            try:
+                connection.request('POST', self.path, body, self.headers)
+                response = connection.getresponse()
+                # the body must be read before the connection can be reused
+                text = response.read()
+                break
+            except (http.client.HTTPException, OSError):
+                connection.close()
+                connection = None
+                if attempt == 1:
+                    raise
+                # the server may have closed an idle keep-alive connection
+        instruments.observe('push_request_seconds', time.perf_counter() - started)
+        instruments.inc('push_requests_total', status=response.status)
+        if response.will_close:
+            connection.close()
+            connection = None
+        if response.status >= 300:
+            raise Exception(f'Push to {self.host} failed {response.status} {text[:200]}')
+        instruments.inc('push_points_total', len(batch))
+        if self.debug == '1':
+            print(f'Pushed {len(batch)} points {len(body)} bytes')
+        return connection
+
+    def flush(self, requeue=True):
+        # sends everything queued now, on the calling thread. On failure the
+        # batch goes back on the queue, or with requeue False the queue is
+        # emptied for the caller to resend.
+        connection = None
+        try:
+            while True:
+                with self.condition:
+                    batch = self._take()
+                if len(batch) == 0:
+                    return
+                try:
+                    connection = self.post(batch, connection)
+                except Exception:
+                    if requeue:
+                        self._requeue(batch)
+                    else:
+                        with self.condition:
+                            self.lines.clear()
+                            self.queuedBytes = 0
+                            self.firstQueued = None
+                    raise
+        finally:
+            if connection is not None:
+                connection.close()
+
+    def flushAtExit(self):
+        if len(self.lines) == 0:
+            return
+
+        def flush():
+            try:
+                self.flush()
+            except Exception as err:
+                print(f'Push at exit failed {err}')
+        # on a thread of its own so a slow uplink can't hold up the exit
+        flusher = threading.Thread(target=flush, name='pushExit', daemon=True)
+        flusher.start()
+        flusher.join(self.exitTimeout)
+        if len(self.lines) > 0 or flusher.is_alive():
+            print(f'{len(self.lines)} points not pushed at exit')
+
+    def _flush(self):
+        connection = None
+        retryInterval = self.flushInterval
+        while True:
+            with self.condition:
+                while not self._ready():
+                    if len(self.lines) == 0:
+                        self.condition.wait()
+                    else:
+                        self.condition.wait(max(0.01, self.firstQueued + self.flushInterval - time.time()))
+                batch = self._take()
+            try:
+                connection = self.post(batch, connection)
+                retryInterval = self.flushInterval
+            except Exception as err:
+                instruments.inc('push_failures_total')
+                print(err)
+                if self.debug == '1':
+                    traceback.print_exc()
+                connection = None
+                self._requeue(batch)
+                time.sleep(retryInterval)
+                retryInterval = min(retryInterval * 2, self.maxRetryInterval)
+
+
+def withoutSection(settings, section):
+    # a copy of the settings without a section, so another sink ignores it
+    copy = RawConfigParser()
+    copy.read_dict({s: dict(settings.items(s)) for s in settings.sections() if s != section})
+    return copy
+
+
+# Stands in front of a MetricsRecorder, which then only writes to InfluxDB,
+# and sends the Grafana points through an HttpSink. Behind a spool the sink
+# posts on send() and raises if the push fails so the spool keeps the batch,
+# otherwise the flushers send when a batch is full or due.
+class PushRecorder:
+
+    def __init__(self, recorder, settings, background=True):
+        self.recorder = recorder
+        self.sink = HttpSink(settings, background=background)
+        self.background = background
+        source = settings.get('grafana', 'source', fallback='')
+        self.tags = [('source', source)] if source != '' else []
+
+    def __getattr__(self, name):
+        return getattr(self.recorder, name)
+
+    def add(self, now, measurement, info, interval, tags):
+        if info is not None:
+            if isinstance(tags, dict):
+                tags = list(tags.items())
+            self.sink.addPoint(now, measurement, info, list(tags) + self.tags)
+        self.recorder.add(now, measurement, info, interval, tags)
+
+    def send(self):
+        result = self.recorder.send()
+        if not self.background and result is not False:
+            # the spool resends the whole batch if this fails. InfluxDB goes
+            # first, it overwrites points it already has, so a failed send
+            # there doesn't push the batch to Grafana twice.
+            self.sink.flush(requeue=False)
+        return result
+
+    def discard(self):
+        # the spool is about to resend, drop what is still queued of the batch
+        if not self.background:
+            with self.sink.condition:
+                self.sink.lines.clear()
+                self.sink.queuedBytes = 0
+                self.sink.firstQueued = None
+        discard = getattr(self.recorder, 'discard', None)
+        if discard is not None:
+            discard()
@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+
+import bisect
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+# Local instrumentation kept in memory and served as Prometheus text on a
+# small HTTP endpoint, so the bus and uplink can be watched without sending
+# anything more over the uplink. Latencies go into fixed bucket histograms,
+# an observation is a bisect and two additions, cheap enough for every
+# Modbus transaction. The endpoint is started when a [metrics] section sets
+# a port.
+
+# seconds, a register read at 9600 baud is 20 to 300ms
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.075, 0.1, 0.15, 0.2, 0.3, 0.5, 0.75, 1.0, 2.5, 5.0)
+
+
+class Histogram:
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+def labelText(labels):
+    if len(labels) == 0:
+        return ''
+    return '{' + ','.join(f'{k}="{v}"' for k, v in labels) + '}'
+
+
+class Instruments:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def gauge(self, name, value, **labels):
+        self.gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = Histogram()
+                self.histograms[key] = histogram
+            histogram.observe(value)
+
+    def render(self):
+        lines = []
+        with self.lock:
+            counters = sorted(self.counters.items())
+            gauges = sorted(self.gauges.items())
+            histograms = [(key, list(h.counts), h.sum, h.count, h.buckets) for key, h in sorted(self.histograms.items())]
+        typed = set()
+        for (name, labels), value in counters:
+            if name not in typed:
+                lines.append(f'# TYPE {name} counter')
+                typed.add(name)
+            lines.append(f'{name}{labelText(labels)} {value}')
+        for (name, labels), value in gauges:
+            if name not in typed:
+                lines.append(f'# TYPE {name} gauge')
+                typed.add(name)
+            lines.append(f'{name}{labelText(labels)} {value}')
+        for (name, labels), counts, total, count, buckets in histograms:
+            if name not in typed:
+                lines.append(f'# TYPE {name} histogram')
+                typed.add(name)
+            cumulative = 0
+            for bound, n in zip(buckets, counts):
+                cumulative += n
+                lines.append(f'{name}_bucket{labelText(labels + (("le", bound),))} {cumulative}')
+            lines.append(f'{name}_bucket{labelText(labels + (("le", "+Inf"),))} {count}')
+            lines.append(f'{name}_sum{labelText(labels)} {total}')
+            lines.append(f'{name}_count{labelText(labels)} {count}')
+        return '\n'.join(lines) + '\n'
+
+
+# shared by everything in the process
+instruments = Instruments()
+
+
+class MetricsEndpoint:
+
+    def __init__(self, settings, registry=instruments, store=None):
+        # with a SampleStore, /recent?measurement=inverter&field=Pac&seconds=300
+        # gives the field's count, mean, min, max and last over the window as JSON
+        self.registry = registry
+        self.store = store
+        self.bind = settings.get('metrics', 'bind', fallback='127.0.0.1')
+        self.port = settings.getint('metrics', 'port', fallback=9108)
+        self.server = None
+
+    def start(self):
+        registry = self.registry
+        store = self.store
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                path, _, query = self.path.partition('?')
+                if path == '/recent' and store is not None:
+                    self._recent(parse_qs(query))
+                    return
+                if path != '/metrics':
+                    self.send_error(404)
+                    return
+                self._reply(registry.render().encode('utf-8'), 'text/plain; version=0.0.4')
+
+            def _recent(self, query):
+                if 'field' not in query:
+                    data = [{'measurement': m, 'tags': dict(t), 'fields': f} for m, t, f in store.names()]
+                else:
+                    tags = [(k, v[0]) for k, v in query.items() if k not in ('measurement', 'field', 'seconds')]
+                    data = store.stats(query.get('measurement', [''])[0], query['field'][0],
+                        float(query.get('seconds', ['300'])[0]), tags=tags)
+                self._reply(json.dumps(data).encode('utf-8'), 'application/json')
+
+            def _reply(self, data, contentType):
+                self.send_response(200)
+                self.send_header('Content-Type', contentType)
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((self.bind, self.port), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, name='metrics', daemon=True).start()
+        print(f'Metrics on http://{self.bind}:{self.server.server_address[1]}/metrics')
+
+
+def outcome(response):
+    # classifies a pymodbus response or the exception raised
+    if response is None:
+        return 'timeout'
+    if isinstance(response, Exception) or response.isError():
+        code = getattr(response, 'exception_code', None)
+        if code == 2:
+            return 'illegalAddress'
+        if code is not None:
+            return 'exception'
+        text = str(response)
+        if 'CRC' in text or 'crc' in text:
+            return 'crcError'
+        if 'No Response' in text or 'timeout' in text.lower() or 'IOException' in type(response).__name__:
+            return 'timeout'
+        return 'error'
+    return 'ok'
+
+
+class InstrumentedClient:
+
+    # times every transaction on a pymodbus client, by unit, function code and
+    # start address, and counts the ones that fail by reason
+
+    def __init__(self, client, port, registry=instruments):
+        self.client = client
+        self.port = port
+        self.registry = registry
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+    def _transaction(self, function, address, unit, call, args, kwargs):
+        started = time.perf_counter()
+        try:
+            response = call(*args, **kwargs)
+        except Exception as err:
+            self.registry.inc('modbus_transaction_failures_total', port=self.port, unit=unit, function=function, reason=outcome(err))
+            raise
+        elapsed = time.perf_counter() - started
+        self.registry.observe('modbus_transaction_seconds', elapsed, port=self.port, unit=unit, function=function, address=address)
+        result = outcome(response)
+        if result != 'ok':
+            self.registry.inc('modbus_transaction_failures_total', port=self.port, unit=unit, function=function, reason=result)
+        return response
+
+    def read_holding_registers(self, address, count=1, unit=0, **kwargs):
+        return self._transaction(3, address, unit, self.client.read_holding_registers, (address,), dict(kwargs, count=count, unit=unit))
+
+    def read_input_registers(self, address, count=1, unit=0, **kwargs):
+        return self._transaction(4, address, unit, self.client.read_input_registers, (address,), dict(kwargs, count=count, unit=unit))
+
+    def write_register(self, address, value, unit=0, **kwargs):
+        return self._transaction(6, address, unit, self.client.write_register, (address, value), dict(kwargs, unit=unit))
+
+    def write_registers(self, address, values, unit=0, **kwargs):
+        return self._transaction(16, address, unit, self.client.write_registers, (address, values), dict(kwargs, unit=unit))
+
+
+class TimedRecorder:
+
+    # times MetricsRecorder.send(), which is the flush to InfluxDB or Grafana
+
+    def __init__(self, recorder, registry=instruments):
+        self.recorder = recorder
+        self.registry = registry
+
+    def __getattr__(self, name):
+        return getattr(self.recorder, name)
+
+    def add(self, now, measurement, info, interval, tags):
+        self.recorder.add(now, measurement, info, interval, tags)
+
+    def send(self):
+        started = time.perf_counter()
+        try:
+            return self.recorder.send()
+        except Exception:
+            self.registry.inc('recorder_send_failures_total')
+            raise
+        finally:
+            self.registry.observe('recorder_send_seconds', time.perf_counter() - started)
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+
+import time
+from readPlanner import INPUT, HOLDING, readRegisters, isValid
+from registerMaps import GROWATT_INPUT, GROWATT_INFO, SDM230_INPUT
+from holdingCache import HoldingCache
+
+# Polled devices decoded with a compiled register map, one read and one
+# unpack per block. Used in place of the hand decoding device drivers when
+# an inverter or meter section sets driver = map.
+
+
+class MappedDevice:
+
+    def __init__(self, client, name, unit, registerMap, infoMap=None, kind=INPUT):
+        self.client = client
+        self.name = name
+        self.unit = unit
+        self.registerMap = registerMap
+        self.infoMap = infoMap
+        self.kind = kind
+        # optional FieldRates, reads only the field groups that are due
+        self.rates = None
+
+    def readMap(self, registerMap, kind):
+        info = {}
+        for block in registerMap.blocks:
+            row = readRegisters(self.client, kind, block.address, block.count, self.unit)
+            if not isValid(row):
+                return None
+            block.decodeRegisters(row.registers, info)
+        return info
+
+    def read(self):
+        if self.rates is None:
+            return self.readMap(self.registerMap, self.kind)
+        registerMap = self.rates.due(time.time())
+        if registerMap is None:
+            return {}
+        info = self.readMap(registerMap, self.kind)
+        if info is None:
+            # offline, read everything once it is back
+            self.rates.reset()
+        return info
+
+    def readInfo(self):
+        if self.infoMap is None:
+            return None
+        return self.readMap(self.infoMap, HOLDING)
+
+    def print_info(self, info=None):
+        # prints info already read, eg cached, or reads it
+        print(f'{self.name} unit {self.unit}')
+        if self.infoMap is None:
+            return
+        if info is None:
+            info = self.readInfo()
+        if info is None:
+            print('    info not available')
+            return
+        for name, value in info.items():
+            print(f'    {name:<24}: {value}')
+
+
+class MappedGrowatt(MappedDevice):
+
+    def __init__(self, client, name, unit, ratedPower=4200):
+        MappedDevice.__init__(self, client, name, unit, GROWATT_INPUT, GROWATT_INFO)
+        self.ratedPower = ratedPower
+        self.holding = HoldingCache(client, unit)
+
+    def setExportLimit(self, limit):
+        # the limit is set in 0.1% of the rated power, an unchanged limit is not
+        # written. Returns True when the inverter reads back the limit.
+        rate = int(round(limit * 1000 / self.ratedPower))
+        if not self.holding.write({123: rate}):
+            print(f'{self.name} export limit {limit}W not set')
+            return False
+        return True
+
+
+class MappedSdm230(MappedDevice):
+
+    def __init__(self, client, name, unit):
+        MappedDevice.__init__(self, client, name, unit, SDM230_INPUT)
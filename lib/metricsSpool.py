@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+import traceback
+from instruments import instruments
+
+# Disk backed write ahead spool for points heading to a MetricsRecorder.
+# Points are appended to fixed size memory mapped segment files, each record
+# is a 4 byte length followed by the JSON encoded add() arguments. The length
+# is written after the payload so a torn write reads as the end of the segment.
+# The read position is kept in a cursor file and only advanced once a batch has
+# been sent, so points survive an outage of the uplink or a restart. When the
+# spool exceeds its disk budget the oldest segment is dropped.
+
+HEADER = struct.Struct('<I')
+
+
+class Segment:
+
+    def __init__(self, path, size=0):
+        if not os.path.exists(path):
+            with open(path, 'wb') as f:
+                f.truncate(size)
+        self.path = path
+        self.file = open(path, 'r+b')
+        self.map = mmap.mmap(self.file.fileno(), 0)
+        self.size = len(self.map)
+
+    def end(self):
+        # offset after the last complete record
+        offset = 0
+        while offset + HEADER.size <= self.size:
+            length = HEADER.unpack_from(self.map, offset)[0]
+            if length == 0 or offset + HEADER.size + length > self.size:
+                break
+            offset += HEADER.size + length
+        return offset
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+
+class MetricsSpool:
+
+    def __init__(self, settings, metrics):
+        self.metrics = metrics
+        self.path = settings.get('spool', 'path', fallback='./spool')
+        self.segmentSize = settings.getint('spool', 'segmentSize', fallback=1048576)
+        self.maxSize = settings.getint('spool', 'maxSize', fallback=64*1048576)
+        self.lock = threading.Lock()
+        self.available = threading.Event()
+        os.makedirs(self.path, exist_ok=True)
+
+        sequences = self._sequences()
+        if len(sequences) == 0:
+            sequences = [0]
+        self.writeSeq = sequences[-1]
+        self.writer = Segment(self._segmentPath(self.writeSeq), self.segmentSize)
+        self.writeOffset = self.writer.end()
+        self.readSeq, self.readOffset = self._loadCursor(sequences[0])
+        self.reader = None
+
+    def _segmentPath(self, seq):
+        return os.path.join(self.path, f'{seq:010d}.spool')
+
+    def _sequences(self):
+        return sorted(int(f[:-6]) for f in os.listdir(self.path) if f.endswith('.spool'))
+
+    def _loadCursor(self, firstSeq):
+        try:
+            with open(os.path.join(self.path, 'cursor')) as f:
+                seq, offset = (int(x) for x in f.read().split())
+            if seq >= firstSeq:
+                return seq, offset
+        except (OSError, ValueError):
+            pass
+        return firstSeq, 0
+
+    def _saveCursor(self):
+        cursorPath = os.path.join(self.path, 'cursor')
+        with open(cursorPath + '.tmp', 'w') as f:
+            f.write(f'{self.readSeq} {self.readOffset}')
+        os.replace(cursorPath + '.tmp', cursorPath)
+
+    def append(self, record):
+        payload = json.dumps(record, separators=(',', ':')).encode('utf-8')
+        length = len(payload)
+        if HEADER.size + length > self.segmentSize:
+            self.metrics.inc('spool.oversize')
+            return
+        with self.lock:
+            if self.writeOffset + HEADER.size + length > self.writer.size:
+                self._rotate()
+            offset = self.writeOffset + HEADER.size
+            self.writer.map[offset:offset + length] = payload
+            HEADER.pack_into(self.writer.map, self.writeOffset, length)
+            self.writeOffset = offset + length
+        self.available.set()
+
+    def _rotate(self):
+        self.writer.close()
+        self.writeSeq += 1
+        self.writer = Segment(self._segmentPath(self.writeSeq), self.segmentSize)
+        self.writeOffset = 0
+        # keep within the disk budget by dropping the oldest unsent segments
+        sequences = self._sequences()
+        while len(sequences) * self.segmentSize > self.maxSize and len(sequences) > 1:
+            oldest = sequences.pop(0)
+            if self.reader is not None and self.reader[0] == oldest:
+                self.reader[1].close()
+                self.reader = None
+            os.remove(self._segmentPath(oldest))
+            self.metrics.inc('spool.droppedSegments')
+            if self.readSeq <= oldest:
+                self.readSeq, self.readOffset = oldest + 1, 0
+                self._saveCursor()
+
+    def _readSegment(self, seq):
+        if seq == self.writeSeq:
+            return self.writer
+        if self.reader is None or self.reader[0] != seq:
+            if self.reader is not None:
+                self.reader[1].close()
+            self.reader = (seq, Segment(self._segmentPath(seq)))
+        return self.reader[1]
+
+    def peek(self, maxRecords):
+        # returns up to maxRecords unsent records and the position after them,
+        # nothing is consumed until commit() is called with that position.
+        records = []
+        with self.lock:
+            seq, offset = self.readSeq, self.readOffset
+            while len(records) < maxRecords:
+                segment = self._readSegment(seq)
+                end = self.writeOffset if seq == self.writeSeq else segment.size
+                length = 0
+                if offset + HEADER.size <= end:
+                    length = HEADER.unpack_from(segment.map, offset)[0]
+                if length == 0 or offset + HEADER.size + length > end:
+                    if seq == self.writeSeq:
+                        break
+                    seq, offset = seq + 1, 0
+                    continue
+                start = offset + HEADER.size
+                records.append(json.loads(segment.map[start:start + length]))
+                offset = start + length
+        return records, (seq, offset)
+
+    def commit(self, position):
+        with self.lock:
+            if position < (self.readSeq, self.readOffset):
+                # the budget dropped these while they were being sent
+                return
+            self.readSeq, self.readOffset = position
+            if self.reader is not None and self.reader[0] < self.readSeq:
+                self.reader[1].close()
+                self.reader = None
+            for seq in self._sequences():
+                if seq < self.readSeq:
+                    os.remove(self._segmentPath(seq))
+            self._saveCursor()
+
+    def backlog(self):
+        with self.lock:
+            if self.readSeq == self.writeSeq:
+                return self.writeOffset - self.readOffset
+            return (self.writeSeq - self.readSeq) * self.segmentSize + self.writeOffset - self.readOffset
+
+    def sync(self):
+        with self.lock:
+            self.writer.map.flush()
+
+
+# Stands in for a MetricsRecorder. add() appends to the spool and returns,
+# send() only wakes the flusher. A background thread drains the spool into
+# the real recorder in large batches, backing off while the uplink is down
+# and limiting the replay rate while catching up afterwards. A batch has
+# failed when send() raises or returns False, the recorder is then asked to
+# discard() what it still holds of it, so the retry doesn't send it twice.
+class SpooledRecorder:
+
+    def __init__(self, recorder, spool, settings, metrics):
+        self.recorder = recorder
+        self.spool = spool
+        self.metrics = metrics
+        self.batchSize = settings.getint('spool', 'batchSize', fallback=500)
+        self.replayRate = settings.getint('spool', 'replayRate', fallback=1000)
+        self.flushInterval = settings.getfloat('spool', 'flushInterval', fallback=1)
+        self.maxRetryInterval = settings.getfloat('spool', 'maxRetryInterval', fallback=300)
+        self.flusher = threading.Thread(target=self._flush, name='spool', daemon=True)
+        self.flusher.start()
+
+    def __getattr__(self, name):
+        return getattr(self.recorder, name)
+
+    def add(self, now, measurement, info, interval, tags):
+        self.spool.append([now, measurement, info, interval, tags])
+
+    def send(self):
+        self.spool.available.set()
+
+    def _flush(self):
+        retryInterval = self.flushInterval
+        while True:
+            self.spool.available.wait(self.flushInterval)
+            self.spool.available.clear()
+            while True:
+                records, position = self.spool.peek(self.batchSize)
+                if len(records) == 0:
+                    break
+                started = time.time()
+                try:
+                    for record in records:
+                        self.recorder.add(*record)
+                    if self.recorder.send() is False:
+                        raise Exception(f'Sending {len(records)} spooled points failed')
+                except Exception as err:
+                    # leave the batch in the spool and try again later
+                    self.metrics.inc('spool.sendFailed')
+                    traceback.print_exc()
+                    print(err)
+                    self._discard()
+                    time.sleep(retryInterval)
+                    retryInterval = min(retryInterval * 2, self.maxRetryInterval)
+                    continue
+                retryInterval = self.flushInterval
+                self.spool.commit(position)
+                instruments.gauge('spool_backlog_bytes', self.spool.backlog())
+                self.metrics.inc('spool.batches')
+                if len(records) == self.batchSize:
+                    # catching up after an outage, don't flood the uplink
+                    time.sleep(max(0, len(records) / self.replayRate - (time.time() - started)))
+            self.spool.sync()
+
+    def _discard(self):
+        discard = getattr(self.recorder, 'discard', None)
+        if discard is None:
+            return
+        try:
+            discard()
+        except Exception as err:
+            print(f'Discarding the failed batch failed {err}')
@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+
+import struct
+
+# Modbus RTU framing helpers. The CRC is table driven and works over any
+# buffer slice, so frames can be checked in place without copying them.
+
+READ_HOLDING = 3
+READ_INPUT = 4
+WRITE_SINGLE = 6
+WRITE_MULTIPLE = 16
+EXCEPTION = 0x80
+
+ILLEGAL_ADDRESS = 2
+
+
+def _crcTable():
+    table = []
+    for i in range(256):
+        crc = i
+        for _ in range(8):
+            if crc & 1:
+                crc = (crc >> 1) ^ 0xA001
+            else:
+                crc >>= 1
+        table.append(crc)
+    return table
+
+
+CRC_TABLE = _crcTable()
+
+
+def crc16(data, start=0, end=None):
+    if end is None:
+        end = len(data)
+    crc = 0xFFFF
+    table = CRC_TABLE
+    for b in memoryview(data)[start:end]:
+        crc = (crc >> 8) ^ table[(crc ^ b) & 0xFF]
+    return crc
+
+
+def checkCrc(data, start, length):
+    # the CRC is sent low byte first after the frame
+    end = start + length - 2
+    return crc16(data, start, end) == (data[end] | (data[end + 1] << 8))
+
+
+def withCrc(frame):
+    crc = crc16(frame)
+    return bytes(frame) + bytes((crc & 0xFF, crc >> 8))
+
+
+def readRequest(unit, function, address, count):
+    return withCrc(struct.pack('>BBHH', unit, function, address, count))
@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+
+import struct
+import time
+import serial
+from modbusFrame import READ_HOLDING, READ_INPUT, WRITE_SINGLE, WRITE_MULTIPLE, EXCEPTION, ILLEGAL_ADDRESS, checkCrc, readRequest
+from instruments import instruments
+
+# Passive sniffer for a Modbus RTU bus driven by another controller.
+# Bytes are read straight into a preallocated linear buffer, not a ring, and
+# frames are found in place, checking the CRC over the buffer without slicing
+# copies. A frame is always contiguous so the parser never handles a
+# wraparound. When the unparsed tail reaches the end of the buffer it is moved
+# back to the start within the buffer, without a temporary copy, and is never
+# more than one partial frame.
+# Read requests are remembered by (unit, function) with their start address,
+# so each response is paired with its request in O(1) and its register bytes
+# are written directly into that device's bytemap, one per function table.
+# A frame that fails its CRC, or a byte that cannot start a frame, drops the
+# parser out of sync and it skips forward a byte at a time until the next
+# valid frame.
+
+BUFFER_SIZE = 4096
+REGISTERS = 65536
+REQUEST_TIMEOUT = 0.5
+SEEN = memoryview(b'\x01' * REGISTERS)
+
+
+class Device:
+
+    def __init__(self, unit):
+        self.unit = unit
+        # register bytes and a per register seen flag for each table
+        self.tables = {READ_HOLDING: bytearray(REGISTERS * 2), READ_INPUT: bytearray(REGISTERS * 2)}
+        self.seen = {READ_HOLDING: bytearray(REGISTERS), READ_INPUT: bytearray(REGISTERS)}
+        self.updated = 0
+
+
+class ModbusSniffer:
+
+    def __init__(self, settings, metrics):
+        self.metrics = metrics
+        self.port = settings.get('gateway', 'port', fallback='/dev/ttyUSB0')
+        self.baudrate = settings.getint('gateway', 'baudrate', fallback=9600)
+        self.serial = None
+        self.buffer = bytearray(BUFFER_SIZE)
+        self.view = memoryview(self.buffer)
+        self.start = 0
+        self.end = 0
+        self.pending = {}
+        self.outgoing = []
+        self.awaiting = None
+        self.lastSent = 0
+        self.devices = {}
+        self.sequence = 0
+        self.synced = True
+        self.frames = 0
+        self.crcErrors = 0
+        self.resyncs = 0
+        # optional CaptureWriter recording the raw bytes
+        self.capture = None
+        # replay sets this to the capture's time
+        self.clock = time.time
+
+    def connect(self):
+        self.serial = serial.Serial(self.port, self.baudrate, bytesize=8, parity='N', stopbits=1, timeout=0.05)
+
+    def close(self):
+        if self.serial is not None:
+            self.serial.close()
+            self.serial = None
+        if self.capture is not None:
+            self.capture.close()
+
+    def fileno(self):
+        return self.serial.fileno()
+
+    def read(self):
+        # reads what has arrived, returns True if any response was decoded
+        if self.end == BUFFER_SIZE:
+            self._compact()
+        # only what is waiting, so this never blocks for the serial timeout
+        waiting = min(self.serial.in_waiting, BUFFER_SIZE - self.end)
+        if waiting > 0:
+            n = self.serial.readinto(self.view[self.end:self.end + waiting])
+            if self.capture is not None and n > 0:
+                self.capture.write(time.time(), self.view[self.end:self.end + n])
+            self.end += n
+        found = self.parse()
+        self.sendRequests()
+        return found
+
+    def feed(self, data):
+        # parses bytes that did not come from the serial port
+        found = False
+        data = memoryview(data)
+        while len(data) > 0:
+            if self.end == BUFFER_SIZE:
+                self._compact()
+            n = min(len(data), BUFFER_SIZE - self.end)
+            self.buffer[self.end:self.end + n] = data[:n]
+            self.end += n
+            data = data[n:]
+            found = self.parse() or found
+        return found
+
+    def request(self, unit, function, address, count):
+        # asks the device directly, used when the controller has gone quiet.
+        # Requests are sent one at a time once the last has been answered.
+        self.outgoing.append((unit, function, address, count))
+
+    def sendRequests(self):
+        # sends the next queued request, returns True while any are queued
+        if len(self.outgoing) == 0:
+            return False
+        if self.awaiting in self.pending and time.time() < self.lastSent + REQUEST_TIMEOUT:
+            return True
+        unit, function, address, count = self.outgoing.pop(0)
+        frame = readRequest(unit, function, address, count)
+        self.serial.write(frame)
+        if self.capture is not None:
+            self.capture.write(time.time(), frame)
+        self.pending[(unit, function)] = (address, count, time.perf_counter())
+        self.awaiting = (unit, function)
+        self.lastSent = time.time()
+        return len(self.outgoing) > 0
+
+    def _compact(self):
+        # memoryview to memoryview is a memmove, safe if the ranges overlap
+        remaining = self.end - self.start
+        self.view[0:remaining] = self.view[self.start:self.end]
+        self.start = 0
+        self.end = remaining
+
+    def _skip(self):
+        if self.synced:
+            self.synced = False
+            self.resyncs += 1
+            self.metrics.inc('sniffer.resyncs')
+            instruments.inc('sniffer_resyncs_total')
+        self.start += 1
+
+    def parse(self):
+        found = False
+        buf = self.buffer
+        while self.end - self.start >= 5:
+            p = self.start
+            unit = buf[p]
+            function = buf[p + 1]
+            available = self.end - p
+            if unit == 0 or unit > 247:
+                self._skip()
+                continue
+            if function & EXCEPTION:
+                candidates = (5,)
+            elif function == READ_HOLDING or function == READ_INPUT:
+                response = 5 + buf[p + 2]
+                if (unit, function) in self.pending:
+                    candidates = (response, 8)
+                else:
+                    candidates = (8, response)
+            elif function == WRITE_SINGLE:
+                candidates = (8,)
+            elif function == WRITE_MULTIPLE:
+                if available < 7:
+                    break
+                candidates = (8, 9 + buf[p + 6])
+            else:
+                self._skip()
+                continue
+
+            length = 0
+            waiting = False
+            for candidate in candidates:
+                if candidate > available:
+                    waiting = True
+                elif checkCrc(buf, p, candidate):
+                    length = candidate
+                    break
+            if length == 0:
+                if waiting:
+                    break
+                if self.synced:
+                    self.crcErrors += 1
+                    self.metrics.inc('sniffer.crcErrors')
+                    instruments.inc('sniffer_crc_errors_total')
+                self._skip()
+                continue
+
+            self.synced = True
+            self.frames += 1
+            found = self._frame(p, unit, function, length) or found
+            self.start = p + length
+        if self.start == self.end:
+            self.start = self.end = 0
+        return found
+
+    def _frame(self, p, unit, function, length):
+        buf = self.buffer
+        if function & EXCEPTION:
+            self.pending.pop((unit, function & ~EXCEPTION), None)
+            self.metrics.inc('sniffer.exceptions')
+            instruments.inc('modbus_transaction_failures_total', port='bus', unit=unit, function=function & ~EXCEPTION,
+                reason='illegalAddress' if buf[p + 2] == ILLEGAL_ADDRESS else 'exception')
+        elif function == READ_HOLDING or function == READ_INPUT:
+            if length == 8:
+                self.pending[(unit, function)] = struct.unpack_from('>HH', buf, p + 2) + (time.perf_counter(),)
+                return False
+            request = self.pending.pop((unit, function), None)
+            if request is None or request[1] * 2 != buf[p + 2]:
+                self.metrics.inc('sniffer.unmatched')
+                return False
+            # the controller's round trip, as seen on the bus
+            instruments.observe('modbus_transaction_seconds', time.perf_counter() - request[2],
+                port='bus', unit=unit, function=function, address=request[0])
+            self._store(unit, function, request[0], p + 3, request[1])
+            return True
+        elif function == WRITE_SINGLE:
+            self._store(unit, READ_HOLDING, struct.unpack_from('>H', buf, p + 2)[0], p + 4, 1)
+        elif length > 8:
+            address, count = struct.unpack_from('>HH', buf, p + 2)
+            self._store(unit, READ_HOLDING, address, p + 7, count)
+        return False
+
+    def _store(self, unit, function, address, offset, count):
+        device = self.devices.get(unit)
+        if device is None:
+            device = self.devices[unit] = Device(unit)
+        count = min(count, REGISTERS - address)
+        device.tables[function][address * 2:(address + count) * 2] = self.view[offset:offset + count * 2]
+        device.seen[function][address:address + count] = SEEN[:count]
+        device.updated = self.clock()
+        self.sequence += 1
+
+    def isSeen(self, unit, function, address, count):
+        device = self.devices.get(unit)
+        return device is not None and device.seen[function].find(0, address, address + count) < 0
+
+    def getBytes(self, unit, function, address, count):
+        # register bytes as a memoryview, or None until all have been seen
+        if not self.isSeen(unit, function, address, count):
+            return None
+        return memoryview(self.devices[unit].tables[function])[address * 2:(address + count) * 2]
+
+    def table(self, unit, function):
+        # the whole bytemap of a table, indexed by register address * 2
+        device = self.devices.get(unit)
+        if device is None:
+            return None
+        return device.tables[function]
@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+
+import asyncio
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from instruments import instruments
+
+# asyncio scheduler for solarmon.
+# Each serial port gets its own poll task and a single worker thread, so reads
+# on one port are serialized while other ports carry on. Every device has its
+# own deadline that advances by interval from the previous deadline, so the
+# sample cadence does not drift with the time taken to read or publish.
+# Samples and export evaluations are handed on through bounded queues to
+# separate publish and export tasks, so a slow sink never delays a poll.
+#
+# The callbacks are plain blocking functions, run in worker threads:
+#   poll(device) -> info or None, runs on the device's port thread
+#   publish(samples), samples is a list of (time, device, info), runs on the publish thread
+#   evaluate(device) -> limit or None, runs on the export thread
+#   control(device, limit), runs on the device's port thread
+
+
+class Port:
+
+    def __init__(self, name, client):
+        self.name = name
+        self.client = client
+        self.devices = []
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f'port{name}')
+
+
+def nextDeadline(deadline, interval, now):
+    # keep the cadence anchored to the previous deadline, unless we have
+    # fallen more than a whole interval behind.
+    deadline += interval
+    if deadline < now:
+        deadline = now + interval
+    return deadline
+
+
+class PollScheduler:
+
+    def __init__(self, metrics, interval=1, offlineInterval=60, errorInterval=60, queueSize=100):
+        self.metrics = metrics
+        self.interval = interval
+        self.offlineInterval = offlineInterval
+        self.errorInterval = errorInterval
+        self.queueSize = queueSize
+        self.ports = {}
+        self.publishExecutor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='publish')
+        self.exportExecutor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='export')
+
+    def addPort(self, name, client):
+        self.ports[name] = Port(name, client)
+        return self.ports[name]
+
+    def addDevice(self, portName, device):
+        device['port'] = portName
+        device['nextPoll'] = time.time()
+        self.ports[portName].devices.append(device)
+
+    def run(self, poll, publish, evaluate, control):
+        self.poll = poll
+        self.publish = publish
+        self.evaluate = evaluate
+        self.control = control
+        asyncio.run(self._main())
+
+    async def _main(self):
+        self.samples = asyncio.Queue(maxsize=self.queueSize)
+        self.exports = asyncio.Queue(maxsize=self.queueSize)
+        tasks = [asyncio.create_task(self._pollPort(port)) for port in self.ports.values() if len(port.devices) > 0]
+        tasks.append(asyncio.create_task(self._publish()))
+        tasks.append(asyncio.create_task(self._export()))
+        await asyncio.gather(*tasks)
+
+    def _offer(self, queue, item, name):
+        # bounded queues drop the oldest item rather than block the poll
+        if queue.full():
+            queue.get_nowait()
+            self.metrics.inc(f'main.{name}Dropped')
+        queue.put_nowait(item)
+        instruments.gauge('scheduler_queue_depth', queue.qsize(), queue=name)
+
+    async def _pollPort(self, port):
+        loop = asyncio.get_running_loop()
+        while True:
+            device = min(port.devices, key=lambda d: d['nextPoll'])
+            delay = device['nextPoll'] - time.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            now = time.time()
+            try:
+                info = await loop.run_in_executor(port.executor, self.poll, device)
+            except Exception as err:
+                self.metrics.inc('main.exceptions')
+                traceback.print_exc()
+                print(device['name'])
+                print(err)
+                device['nextPoll'] = now + self.errorInterval
+                continue
+
+            if 'schedule' in device:
+                # the device decides, eg a SolarSchedule
+                device['nextPoll'] = device['schedule'].next(now, info, device['nextPoll'])
+            elif info is None:
+                device['nextPoll'] = now + self.offlineInterval
+            else:
+                device['nextPoll'] = nextDeadline(device['nextPoll'], self.interval, now)
+            if info is None:
+                # no power being generated, check again later
+                continue
+            if len(info) == 0:
+                # nothing was due
+                continue
+
+            self._offer(self.samples, (now, device, info), 'sample')
+            if now > device['lastExportEvaluate'] + device['exportEvaluatePeriod']:
+                device['lastExportEvaluate'] = now
+                self._offer(self.exports, device, 'export')
+
+    async def _publish(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            samples = [await self.samples.get()]
+            # anything that queued while the last publish was running goes in one batch
+            while not self.samples.empty():
+                samples.append(self.samples.get_nowait())
+            instruments.gauge('scheduler_queue_depth', 0, queue='sample')
+            started = time.perf_counter()
+            try:
+                await loop.run_in_executor(self.publishExecutor, self.publish, samples)
+                instruments.observe('scheduler_publish_seconds', time.perf_counter() - started)
+            except Exception as err:
+                self.metrics.inc('main.publishExceptions')
+                traceback.print_exc()
+                print(err)
+
+    async def _export(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            device = await self.exports.get()
+            try:
+                limit = await loop.run_in_executor(self.exportExecutor, self.evaluate, device)
+                if limit is not None:
+                    port = self.ports[device['port']]
+                    await loop.run_in_executor(port.executor, self.control, device, limit)
+            except Exception as err:
+                self.metrics.inc('main.exceptions')
+                traceback.print_exc()
+                print(device['name'])
+                print(err)
@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+
+import time
+
+# Merges the registers a device needs into the fewest contiguous Modbus reads.
+# Every request/response round trip at 9600 baud costs tens of ms, so a few
+# large reads are much cheaper than many small ones. Reads are limited to the
+# 125 registers the protocol allows and may read through holes of up to
+# maxGap registers, except across addresses the device has refused.
+
+MAX_COUNT = 125
+ILLEGAL_ADDRESS = 2
+
+INPUT = 'input'
+HOLDING = 'holding'
+
+
+def readRegisters(client, kind, address, count, unit):
+    if kind == INPUT:
+        return client.read_input_registers(address, count=count, unit=unit)
+    return client.read_holding_registers(address, count=count, unit=unit)
+
+
+def isValid(response):
+    return response is not None and not response.isError() and hasattr(response, 'registers')
+
+
+def isIllegalAddress(response):
+    return getattr(response, 'exception_code', None) == ILLEGAL_ADDRESS
+
+
+class ReadPlanner:
+
+    def __init__(self, maxCount=MAX_COUNT, maxGap=0):
+        self.maxCount = max(1, min(maxCount, MAX_COUNT))
+        self.maxGap = maxGap
+        # addresses that must never be read through as part of a hole
+        self.barriers = set()
+
+    @staticmethod
+    def fromSettings(settings, section='query'):
+        return ReadPlanner(maxCount=settings.getint(section, 'planner_max_count', fallback=MAX_COUNT),
+                           maxGap=settings.getint(section, 'planner_max_gap', fallback=8))
+
+    def _canBridge(self, start, end):
+        for address in range(start, end):
+            if address in self.barriers:
+                return False
+        return True
+
+    def plan(self, ranges):
+        # ranges are (address, count) tuples or bare addresses,
+        # returns a sorted list of (address, count) blocks.
+        spans = []
+        for r in ranges:
+            if isinstance(r, int):
+                r = (r, 1)
+            if r[1] > 0:
+                spans.append((r[0], r[0] + r[1]))
+        spans.sort()
+
+        blocks = []
+        for start, end in spans:
+            if blocks:
+                blockStart, blockEnd = blocks[-1]
+                if end <= blockEnd:
+                    continue
+                if start - blockEnd <= self.maxGap and end - blockStart <= self.maxCount \
+                        and self._canBridge(blockEnd, start):
+                    blocks[-1][1] = end
+                    continue
+                start = max(start, blockEnd)
+            while end - start > self.maxCount:
+                blocks.append([start, start + self.maxCount])
+                start += self.maxCount
+            blocks.append([start, end])
+        return [(start, end - start) for start, end in blocks]
+
+    def markIllegal(self, block, ranges):
+        # A merged block was refused, so the holes inside it must not be
+        # bridged again. Only the holes are marked, the wanted ranges are kept.
+        wanted = set()
+        for r in ranges:
+            if isinstance(r, int):
+                r = (r, 1)
+            wanted.update(range(r[0], r[0] + r[1]))
+        for address in range(block[0], block[0] + block[1]):
+            if address not in wanted:
+                self.barriers.add(address)
+
+    def read(self, client, kind, ranges, unit=1):
+        # Reads all the ranges with as few transactions as possible, returns
+        # a dict of address to register value and the number of transactions.
+        ranges = list(ranges)
+        image = {}
+        transactions = 0
+        pending = self.plan(ranges)
+        while len(pending) > 0:
+            block = pending.pop(0)
+            response = readRegisters(client, kind, block[0], block[1], unit)
+            transactions += 1
+            if isValid(response):
+                for i, value in enumerate(response.registers):
+                    image[block[0] + i] = value
+            elif isIllegalAddress(response):
+                inside = [r for r in ranges if _within(r, block)]
+                before = len(self.barriers)
+                self.markIllegal(block, inside)
+                if len(self.barriers) > before:
+                    pending = self.plan(inside) + pending
+        return image, transactions
+
+
+def _within(r, block):
+    if isinstance(r, int):
+        r = (r, 1)
+    return r[0] >= block[0] and r[0] + r[1] <= block[0] + block[1]
+
+
+def registersFrom(image, address, count=1):
+    # returns the registers as a list, or None if any are missing
+    try:
+        return [image[a] for a in range(address, address + count)]
+    except KeyError:
+        return None
+
+
+# Wraps a ModbusSerialClient so that a device driver which issues many small
+# reads per poll is served from a few planned block reads.
+# The first poll of a unit passes through and records which ranges the driver
+# reads. Later polls prefetch the planned blocks in startPoll() and serve the
+# driver's reads from that image. Reads outside the image pass through and are
+# added to the plan for the next poll.
+class PlannedClient:
+
+    def __init__(self, client, planner, debug=0):
+        self.client = client
+        self.planner = planner
+        self.debug = debug
+        self.wanted = {}
+        self.plans = {}
+        self.images = {}
+        self.polling = None
+        self.requested = 0
+        self.issued = 0
+        self.lastPoll = {}
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+    def startPoll(self, unit):
+        self.polling = unit
+        self.requested = 0
+        self.issued = 0
+        self.images[unit] = {INPUT: {}, HOLDING: {}}
+        plans = self.plans.get(unit)
+        if plans is None:
+            return
+        for kind in (INPUT, HOLDING):
+            if len(plans[kind]) == 0:
+                continue
+            image, transactions = self.planner.read(self.client, kind, self.wanted[unit][kind], unit)
+            self.images[unit][kind] = image
+            self.issued += transactions
+
+    def endPoll(self, unit):
+        self.lastPoll[unit] = {
+            'requested': self.requested,
+            'issued': self.issued,
+            'time': time.time()
+        }
+        wanted = self.wanted.get(unit)
+        if wanted is not None:
+            plans = {kind: self.planner.plan(wanted[kind]) for kind in (INPUT, HOLDING)}
+            if plans != self.plans.get(unit):
+                self.plans[unit] = plans
+                print(f'Read plan for unit {unit}: {self.requested} reads per poll planned as '
+                      f'{len(plans[INPUT]) + len(plans[HOLDING])} transactions {plans}')
+        if str(self.debug) == '1':
+            print(f'Unit {unit} poll: {self.requested} reads, {self.issued} transactions')
+        self.polling = None
+        return self.lastPoll[unit]
+
+    def _read(self, kind, address, count, unit):
+        self.requested += 1
+        if unit != self.polling:
+            self.issued += 1
+            return readRegisters(self.client, kind, address, count, unit)
+        registers = registersFrom(self.images[unit][kind], address, count)
+        if registers is not None:
+            # imported here so the planner itself loads without pymodbus
+            from pymodbus.register_read_message import ReadHoldingRegistersResponse, ReadInputRegistersResponse
+            if kind == INPUT:
+                return ReadInputRegistersResponse(registers, unit=unit)
+            return ReadHoldingRegistersResponse(registers, unit=unit)
+        wanted = self.wanted.setdefault(unit, {INPUT: set(), HOLDING: set()})
+        wanted[kind].add((address, count))
+        self.issued += 1
+        return readRegisters(self.client, kind, address, count, unit)
+
+    def read_input_registers(self, address, count=1, unit=0, **kwargs):
+        return self._read(INPUT, address, count, unit)
+
+    def read_holding_registers(self, address, count=1, unit=0, **kwargs):
+        return self._read(HOLDING, address, count, unit)
@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+
+from metricsSpool import MetricsSpool, SpooledRecorder
+from deadbandRecorder import DeadbandRecorder
+from rollupRecorder import RollupRecorder
+from httpPush import PushRecorder, withoutSection
+from instruments import TimedRecorder
+from sampleStore import SampleStore, StoreRecorder
+from startupState import LazyRecorder, exitOnTerm
+
+# The recorders solarmon and the gateway publish through, built from the
+# sections present. A sample goes
+#   StoreRecorder [store] -> RollupRecorder [rollup] -> DeadbandRecorder [deadband]
+#   -> SpooledRecorder [spool] -> TimedRecorder -> PushRecorder [push]
+#   -> MetricsRecorder
+# MetricsRecorder imports influxdb, so it is built on the first publish rather
+# than holding up the first poll, and the spool can have it rebuilt with
+# nothing buffered after a failed send.
+
+
+def recorderChain(settings, metrics):
+    # returns the recorder to add samples to and the SampleStore, or None
+    def metricsRecorder():
+        from metricsRecorder import MetricsRecorder
+        if settings.has_section('push'):
+            # Grafana points go through the batched sink, MetricsRecorder only writes to InfluxDB
+            return MetricsRecorder(withoutSection(settings, 'grafana'), metrics)
+        return MetricsRecorder(settings, metrics)
+    recorder = LazyRecorder(metricsRecorder)
+    if settings.has_section('push'):
+        recorder = PushRecorder(recorder, settings, not settings.has_section('spool'))
+        # so the points still queued are pushed when systemd stops the service
+        exitOnTerm()
+    recorder = TimedRecorder(recorder)
+    if settings.has_section('spool'):
+        recorder = SpooledRecorder(recorder, MetricsSpool(settings, metrics), settings, metrics)
+    output = recorder
+    if settings.has_section('deadband'):
+        recorder = DeadbandRecorder(recorder, settings, metrics)
+    if settings.has_section('rollup'):
+        recorder = RollupRecorder(recorder, settings, metrics, output)
+    store = None
+    if settings.has_section('store'):
+        # the last few thousand samples of every device in memory
+        store = SampleStore(settings)
+        recorder = StoreRecorder(recorder, store)
+    return recorder, store
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+
+import struct
+from collections import namedtuple
+from readPlanner import ReadPlanner
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Declarative register maps compiled into block decoders.
+# A map is a list of fields (name, address, width, type, scale, unit) where
+# width is in registers and type is 'u' unsigned, 's' signed, 'f' IEEE754
+# float or 'a' ASCII. Fields are planned into contiguous read blocks and each
+# block compiles once into a struct format, holes becoming pad bytes, so a
+# whole block decodes with one unpack_from() call. For batches of the same
+# block from many devices or samples a NumPy dtype decodes all of them at once.
+
+Field = namedtuple('Field', 'name address width type scale unit')
+
+CODES = {
+    ('u', 1): ('H', '>u2'),
+    ('s', 1): ('h', '>i2'),
+    ('u', 2): ('I', '>u4'),
+    ('s', 2): ('i', '>i4'),
+    ('f', 2): ('f', '>f4'),
+}
+
+
+def fieldCode(field):
+    if field.type == 'a':
+        return f'{field.width * 2}s', f'S{field.width * 2}'
+    return CODES[(field.type, field.width)]
+
+
+class BlockDecoder:
+
+    def __init__(self, address, count, fields):
+        self.address = address
+        self.count = count
+        self.fields = sorted(fields, key=lambda f: f.address)
+        fmt = '>'
+        position = address
+        for field in self.fields:
+            if field.address < position:
+                raise ValueError(f'Register field {field.name} overlaps the previous field')
+            fmt += 'x' * ((field.address - position) * 2) + fieldCode(field)[0]
+            position = field.address + field.width
+        fmt += 'x' * ((address + count - position) * 2)
+        self.struct = struct.Struct(fmt)
+        self.names = [f.name for f in self.fields]
+        self.scaled = [(f.name, i, f.scale) for i, f in enumerate(self.fields) if f.type != 'a' and f.scale != 1]
+        self.ascii = [(f.name, i) for i, f in enumerate(self.fields) if f.type == 'a']
+
+    def decode(self, buffer, offset=0, into=None):
+        # decodes the block's register bytes into a dict of field values
+        if into is None:
+            into = {}
+        values = self.struct.unpack_from(buffer, offset)
+        into.update(zip(self.names, values))
+        for name, i, scale in self.scaled:
+            into[name] = values[i] * scale
+        for name, i in self.ascii:
+            into[name] = values[i].decode('ascii', 'replace').strip('\0 ')
+        return into
+
+    def decodeRegisters(self, registers, into=None):
+        # decodes a list of 16 bit registers as returned by pymodbus
+        return self.decode(struct.pack(f'>{len(registers)}H', *registers), 0, into)
+
+    def dtype(self):
+        fields = [f for f in self.fields if f.type != 'a']
+        return numpy.dtype({
+            'names': [f.name for f in fields],
+            'formats': [fieldCode(f)[1] for f in fields],
+            'offsets': [(f.address - self.address) * 2 for f in fields],
+            'itemsize': self.count * 2
+        })
+
+    def decodeBatch(self, buffer):
+        # decodes many copies of the block laid end to end, returns a dict of
+        # field name to a NumPy array of scaled values
+        records = numpy.frombuffer(buffer, dtype=self.dtype())
+        columns = {}
+        for field in self.fields:
+            if field.type == 'a':
+                continue
+            column = records[field.name]
+            if field.scale != 1:
+                column = column * field.scale
+            columns[field.name] = column
+        return columns
+
+
+class RegisterMap:
+
+    def __init__(self, fields, maxGap=8):
+        self.fields = [f if isinstance(f, Field) else Field(*f) for f in fields]
+        self.byName = {f.name: f for f in self.fields}
+        planner = ReadPlanner(maxGap=maxGap)
+        self.blocks = []
+        for address, count in planner.plan([(f.address, f.width) for f in self.fields]):
+            inBlock = [f for f in self.fields if address <= f.address < address + count]
+            self.blocks.append(BlockDecoder(address, count, inBlock))
+
+    def subset(self, names):
+        # a map of just the named fields, unknown names are ignored
+        return RegisterMap([self.byName[n] for n in names if n in self.byName])
+
+    def unknown(self, names):
+        return [n for n in names if n not in self.byName]
+
+    def units(self):
+        return {f.name: f.unit for f in self.fields}
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+
+from registerMap import RegisterMap
+
+# Register maps for the supported devices.
+# (name, address, width, type, scale, unit)
+
+# Growatt PV Inverter Modbus RS485 RTU Protocol v120, input registers.
+GROWATT_INPUT = RegisterMap([
+    ('StatusCode', 0, 1, 'u', 1, ''),
+    ('Ppv', 1, 2, 'u', 0.1, 'W'),
+    ('Vpv1', 3, 1, 'u', 0.1, 'V'),
+    ('PV1Curr', 4, 1, 'u', 0.1, 'A'),
+    ('PV1Watt', 5, 2, 'u', 0.1, 'W'),
+    ('Vpv2', 7, 1, 'u', 0.1, 'V'),
+    ('PV2Curr', 8, 1, 'u', 0.1, 'A'),
+    ('PV2Watt', 9, 2, 'u', 0.1, 'W'),
+    ('Pac', 35, 2, 'u', 0.1, 'W'),
+    ('Fac', 37, 1, 'u', 0.01, 'Hz'),
+    ('Vac1', 38, 1, 'u', 0.1, 'V'),
+    ('Iac1', 39, 1, 'u', 0.1, 'A'),
+    ('Pac1', 40, 2, 'u', 0.1, 'VA'),
+    ('EnergyToday', 53, 2, 'u', 0.1, 'kWh'),
+    ('EnergyTotal', 55, 2, 'u', 0.1, 'kWh'),
+    ('TimeTotal', 57, 2, 'u', 0.5, 's'),
+    ('Epv1_today', 59, 2, 'u', 0.1, 'kWh'),
+    ('Epv1_total', 61, 2, 'u', 0.1, 'kWh'),
+    ('Epv2_today', 63, 2, 'u', 0.1, 'kWh'),
+    ('Epv2_total', 65, 2, 'u', 0.1, 'kWh'),
+    ('Epv_total', 91, 2, 'u', 0.1, 'kWh'),
+    ('TempInverter', 93, 1, 's', 0.1, 'C'),
+    ('TempIpm', 94, 1, 's', 0.1, 'C'),
+    ('TempBoost', 95, 1, 's', 0.1, 'C'),
+    ('PBusVoltage', 98, 1, 'u', 0.1, 'V'),
+    ('NBusVoltage', 99, 1, 'u', 0.1, 'V'),
+    ('IPF', 100, 1, 'u', 1, ''),
+    ('RealOPPercent', 101, 1, 'u', 1, '%'),
+    ('OPFullwatt', 102, 2, 'u', 0.1, 'W'),
+    ('DeratingModeCode', 104, 1, 'u', 1, ''),
+    ('FaultCode', 105, 1, 'u', 1, ''),
+    ('FaultBitCode', 106, 2, 'u', 1, ''),
+    ('Warn', 110, 2, 'u', 1, ''),
+])
+
+# Growatt holding registers identifying the inverter.
+GROWATT_INFO = RegisterMap([
+    ('FirmwareVersion', 9, 3, 'a', 1, ''),
+    ('ControlFirmwareVersion', 12, 3, 'a', 1, ''),
+    ('SerialNumber', 23, 5, 'a', 1, ''),
+    ('ModbusVersion', 88, 1, 'u', 0.01, ''),
+    ('ExportLimitEnable', 122, 1, 'u', 1, ''),
+    ('ExportLimitPowerRate', 123, 1, 'u', 0.1, '%'),
+    ('InverterType', 125, 8, 'a', 1, ''),
+    ('Latitude', 241, 1, 'u', 1, ''),
+    ('Longitude', 242, 1, 'u', 1, ''),
+])
+
+# Eastron SDM230 input registers, IEEE754 floats over 2 registers.
+SDM230_INPUT = RegisterMap([
+    ('Voltage', 0x0000, 2, 'f', 1, 'V'),
+    ('Current', 0x0006, 2, 'f', 1, 'A'),
+    ('ActivePower', 0x000C, 2, 'f', 1, 'W'),
+    ('ApparentPower', 0x0012, 2, 'f', 1, 'VA'),
+    ('ReactivePower', 0x0018, 2, 'f', 1, 'VAr'),
+    ('PowerFactor', 0x001E, 2, 'f', 1, ''),
+    ('PhaseAngle', 0x0024, 2, 'f', 1, 'Degrees'),
+    ('Frequency', 0x0046, 2, 'f', 1, 'Hz'),
+    ('ImportActiveEnergy', 0x0048, 2, 'f', 1, 'kWh'),
+    ('ExportActiveEnergy', 0x004A, 2, 'f', 1, 'kWh'),
+    ('ImportReactiveEnergy', 0x004C, 2, 'f', 1, 'kVArh'),
+    ('ExportReactiveEnergy', 0x004E, 2, 'f', 1, 'kVArh'),
+    ('TotalActiveEnergy', 0x0156, 2, 'f', 1, 'kWh'),
+    ('TotalReactiveEnergy', 0x0158, 2, 'f', 1, 'kVArh'),
+    ('ResetableActiveEnergy', 0x0180, 2, 'f', 1, 'kWh'),
+    ('ResetableReactiveEnergy', 0x0182, 2, 'f', 1, 'kVArh'),
+])
@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+
+import json
+import mmap
+import os
+import shutil
+import struct
+import time
+from readPlanner import MAX_COUNT, readRegisters, isValid, isIllegalAddress
+
+# Maps a device's register space. Reads start at the maximum size. When the
+# device refuses a block with an illegal address exception the readable run at
+# its start is found by bisecting the read size, and an illegal run is skipped
+# by galloping forward with single register reads and bisecting back to the
+# next readable address. A readable region costs one read per 125 registers
+# and an illegal one a few reads per doubling of its length. Registers that
+# time out or fail for any other reason are retried and then marked failed,
+# distinct from illegal.
+# The register image and a one byte per register status map are memory mapped
+# files written in place, and the scan state is saved after every read so an
+# interrupted scan resumes where it stopped. The valid ranges found are cached
+# by model and firmware, so later scans of the same model only read those.
+# The previous image is kept and a diff of the valid registers written.
+
+UNKNOWN = 0
+VALID = 1
+ILLEGAL = 2
+FAILED = 3
+
+RETRIES = 2
+
+
+def ranges(status, value, start, end):
+    # contiguous (address, count) runs of registers with the status
+    result = []
+    address = start
+    while address < end:
+        if status[address] != value:
+            address += 1
+            continue
+        first = address
+        while address < end and status[address] == value:
+            address += 1
+        result.append((first, address - first))
+    return result
+
+
+class RegisterScanner:
+
+    def __init__(self, client, unit, kind, path, end=4000, layoutsPath='layouts.json', stride=16):
+        self.client = client
+        self.stride = stride
+        self.unit = unit
+        self.kind = kind
+        self.path = path
+        self.end = end
+        self.layoutsPath = layoutsPath
+        self.statePath = path + '.state'
+        self.transactions = 0
+
+    def _open(self, resume):
+        size = self.end * 2
+        mode = 'r+b' if resume and os.path.exists(self.path) else 'w+b'
+        if mode == 'w+b' and os.path.exists(self.path):
+            # keep the last snapshot to diff against
+            shutil.copyfile(self.path, self.path + '.prev')
+        self.imageFile = open(self.path, mode)
+        self.imageFile.truncate(size)
+        self.image = mmap.mmap(self.imageFile.fileno(), size)
+        mode = 'r+b' if resume and os.path.exists(self.path + '.map') else 'w+b'
+        self.statusFile = open(self.path + '.map', mode)
+        self.statusFile.truncate(self.end)
+        self.status = mmap.mmap(self.statusFile.fileno(), self.end)
+
+    def close(self):
+        self.image.flush()
+        self.status.flush()
+        self.image.close()
+        self.status.close()
+        self.imageFile.close()
+        self.statusFile.close()
+
+    def _saveState(self, pending):
+        tmp = self.statePath + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'unit': self.unit, 'kind': self.kind, 'end': self.end, 'pending': pending}, f)
+        os.replace(tmp, self.statePath)
+
+    def _loadState(self):
+        if not os.path.exists(self.statePath):
+            return None
+        with open(self.statePath) as f:
+            state = json.load(f)
+        if state['unit'] != self.unit or state['kind'] != self.kind or state['end'] != self.end:
+            return None
+        return [tuple(p) for p in state['pending']]
+
+    def _layouts(self):
+        if not os.path.exists(self.layoutsPath):
+            return {}
+        with open(self.layoutsPath) as f:
+            return json.load(f)
+
+    def _mark(self, address, count, value):
+        self.status[address:address + count] = bytes([value]) * count
+
+    def _read(self, address, count):
+        for attempt in range(RETRIES + 1):
+            row = readRegisters(self.client, self.kind, address, count, self.unit)
+            self.transactions += 1
+            if isValid(row) or isIllegalAddress(row):
+                return row
+        return row
+
+    def scan(self, model=None, full=False):
+        # returns the valid (address, count) ranges
+        pending = self._loadState()
+        resume = pending is not None
+        self._open(resume)
+        layoutKey = f'{model}|{self.kind}' if model is not None else None
+        layouts = self._layouts()
+        if not resume:
+            if layoutKey in layouts and not full:
+                # known layout, only read its valid ranges
+                pending = [tuple(r) for r in layouts[layoutKey]]
+                self._mark(0, self.end, ILLEGAL)
+            else:
+                pending = [(0, self.end)]
+                self._mark(0, self.end, UNKNOWN)
+        started = time.time()
+        while len(pending) > 0:
+            address, count = pending[0]
+            end = address + count
+            while address < end:
+                address = self._step(address, end)
+                self._saveState([(address, end - address)] + pending[1:])
+            pending.pop(0)
+        os.remove(self.statePath)
+        valid = ranges(self.status, VALID, 0, self.end)
+        if layoutKey is not None and len(ranges(self.status, FAILED, 0, self.end)) == 0:
+            layouts[layoutKey] = valid
+            with open(self.layoutsPath, 'w') as f:
+                json.dump(layouts, f)
+        self.elapsed = time.time() - started
+        return valid
+
+    def _store(self, address, count, row):
+        struct.pack_into(f'>{count}H', self.image, address * 2, *row.registers[:count])
+        self._mark(address, count, VALID)
+
+    def _step(self, address, end):
+        # reads from address, returns the address to carry on from
+        count = min(MAX_COUNT, end - address)
+        row = self._read(address, count)
+        if isValid(row):
+            self._store(address, count, row)
+            return address + count
+        # refused, bisect for the longest readable run from address
+        low, high, best = 0, count - 1, None
+        while low < high:
+            mid = (low + high + 1) // 2
+            row = self._read(address, mid)
+            if isValid(row):
+                low, best = mid, row
+            else:
+                high = mid - 1
+        if low > 0:
+            self._store(address, low, best)
+            return address + low
+        if not isIllegalAddress(row):
+            # no answer from the device, not a gap
+            self._mark(address, 1, FAILED)
+            return address + 1
+        return self._skipIllegal(address, end)
+
+    def _skipIllegal(self, address, end):
+        # address is illegal, gallop forward with single register reads for
+        # the next readable one, then bisect back to where it starts. Readable
+        # runs shorter than stride registers inside an illegal range may be
+        # missed, stride 1 probes every address.
+        step = 1
+        last = address
+        probe = address + 1
+        while probe < end:
+            if isValid(self._read(probe, 1)):
+                break
+            last = probe
+            step = min(step * 2, self.stride)
+            probe = last + step
+        probe = min(probe, end)
+        while probe - last > 1:
+            mid = (last + probe) // 2
+            if probe < end and isValid(self._read(mid, 1)):
+                probe = mid
+            else:
+                last = mid
+        self._mark(address, probe - address, ILLEGAL)
+        return probe
+
+    def failed(self):
+        return ranges(self.status, FAILED, 0, self.end)
+
+    def diff(self):
+        # (address, previous, current) for valid registers that changed
+        if not os.path.exists(self.path + '.prev'):
+            return []
+        with open(self.path + '.prev', 'rb') as f:
+            previous = f.read()
+        changes = []
+        for address in range(min(self.end, len(previous) // 2)):
+            if self.status[address] != VALID:
+                continue
+            old = struct.unpack_from('>H', previous, address * 2)[0]
+            new = struct.unpack_from('>H', self.image, address * 2)[0]
+            if old != new:
+                changes.append((address, old, new))
+        return changes
+
+    def writeDiff(self):
+        changes = self.diff()
+        with open(self.path + '.diff', 'w') as f:
+            for address, old, new in changes:
+                f.write(f'{address} {old} {new}\n')
+        return changes
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+
+import json
+import math
+import mmap
+import os
+import struct
+import time
+
+# Latest decoded values of the gateway's devices in a shared memory file, so
+# other processes read fresh meter values without the disk or the bus. The
+# layout is fixed when the gateway starts, a JSON directory gives every field
+# its offset, so a lookup is one unpack at a known offset. The gateway
+# rewrites a device's values whenever the sniffer has decoded new registers.
+# Writes are guarded by a sequence number that is odd while a write is in
+# progress, readers retry if it was odd or changed while they read.
+#
+# header: magic, version, sequence, time written, directory length, then the
+# directory JSON and each device's slot of updated time, device sequence and
+# one double per field, NaN until the field has been seen.
+
+MAGIC = b'MGSN'
+VERSION = 1
+HEADER = struct.Struct('<4sHxxQdI')
+SLOT = struct.Struct('<dQ')
+VALUE = struct.Struct('<d')
+RETRIES = 100
+# retries after the first few wait this long, so a writer descheduled half
+# way through a write gets to finish it
+RETRY_WAIT = 0.001
+
+
+class SnapshotWriter:
+
+    def __init__(self, path, devices):
+        # devices are (name, unit, measurement, [field names])
+        self.path = path
+        directory = {}
+        offset = 0
+        for name, unit, measurement, fields in devices:
+            directory[name] = {'unit': unit, 'measurement': measurement, 'offset': offset, 'fields': fields}
+            offset += SLOT.size + VALUE.size * len(fields)
+        text = json.dumps(directory).encode('utf-8')
+        # slots start on an 8 byte boundary after the directory
+        self.base = (HEADER.size + len(text) + 7) & ~7
+        size = self.base + offset
+        self.offsets = {name: (self.base + d['offset'], {f: i for i, f in enumerate(d['fields'])}) for name, d in directory.items()}
+        # written to a new file and renamed, a reader never sees a half made layout
+        tmp = path + '.tmp'
+        with open(tmp, 'w+b') as f:
+            f.truncate(size)
+            m = mmap.mmap(f.fileno(), size)
+            HEADER.pack_into(m, 0, MAGIC, VERSION, 0, time.time(), len(text))
+            m[HEADER.size:HEADER.size + len(text)] = text
+            for name, d in directory.items():
+                slot = self.base + d['offset']
+                SLOT.pack_into(m, slot, 0, 0)
+                struct.pack_into(f'<{len(d["fields"])}d', m, slot + SLOT.size, *([math.nan] * len(d['fields'])))
+            m.close()
+        os.replace(tmp, path)
+        self.file = open(path, 'r+b')
+        self.map = mmap.mmap(self.file.fileno(), size)
+        self.sequence = 0
+
+    def update(self, name, values, updated):
+        slot, fields = self.offsets[name]
+        m = self.map
+        self.sequence += 1
+        struct.pack_into('<Q', m, 8, self.sequence * 2 - 1)
+        deviceSequence = SLOT.unpack_from(m, slot)[1] + 1
+        SLOT.pack_into(m, slot, updated, deviceSequence)
+        for field, value in values.items():
+            i = fields.get(field)
+            if i is not None:
+                VALUE.pack_into(m, slot + SLOT.size + i * VALUE.size, value)
+        struct.pack_into('<Qd', m, 8, self.sequence * 2, time.time())
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+
+class SnapshotReader:
+
+    def __init__(self, path):
+        self.path = path
+        self.map = None
+        self.inode = None
+        self._open()
+
+    def _open(self):
+        # the gateway makes a new file each time it starts
+        with open(self.path, 'rb') as f:
+            self.inode = os.fstat(f.fileno()).st_ino
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, sequence, written, length = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f'{self.path} is not a register snapshot')
+        self.directory = json.loads(self.map[HEADER.size:HEADER.size + length])
+        base = (HEADER.size + length + 7) & ~7
+        self.slots = {}
+        for name, d in self.directory.items():
+            slot = base + d['offset']
+            self.slots[name] = (slot, struct.Struct(f'<dQ{len(d["fields"])}d'), d['fields'],
+                {f: slot + SLOT.size + i * VALUE.size for i, f in enumerate(d['fields'])})
+
+    def reopen(self):
+        # after the gateway restarts
+        if os.stat(self.path).st_ino != self.inode:
+            self.map.close()
+            self._open()
+
+    def sequence(self):
+        # changes whenever any value is written
+        return struct.unpack_from('<Q', self.map, 8)[0] // 2
+
+    def _consistent(self, read):
+        m = self.map
+        for attempt in range(RETRIES):
+            if attempt > 0:
+                time.sleep(0 if attempt < 10 else RETRY_WAIT)
+            before = struct.unpack_from('<Q', m, 8)[0]
+            if before & 1:
+                continue
+            result = read(m)
+            if struct.unpack_from('<Q', m, 8)[0] == before:
+                return result
+        raise TimeoutError(f'{self.path} is being written continuously')
+
+    def value(self, name, field):
+        # one field, None until it has been seen
+        offset = self.slots[name][3][field]
+        value = self._consistent(lambda m: VALUE.unpack_from(m, offset)[0])
+        return None if math.isnan(value) else value
+
+    def get(self, name):
+        # (values, updated time, device sequence) of a device
+        slot, record, fields, offsets = self.slots[name]
+        row = self._consistent(lambda m: record.unpack_from(m, slot))
+        values = {f: v for f, v in zip(fields, row[2:]) if not math.isnan(v)}
+        return values, row[0], row[1]
+
+    def names(self):
+        return list(self.directory.keys())
+
+    def close(self):
+        self.map.close()
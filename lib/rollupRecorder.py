@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+
+import json
+import os
+
+# Streaming rollups in front of a MetricsRecorder.
+# Every numeric field of a measurement is folded into fixed size accumulators
+# for each rollup window, min, max, mean, last and the trapezoidal integral of
+# the value over time in units hours (Wh for a power field). At each window
+# boundary the window is sent as <measurement>_<suffix> with <field>_min,
+# <field>_max, <field>_mean, <field>_last and <field>_integral fields,
+# timestamped with the start of the window. Windows are aligned to UTC.
+# A window passed over between two samples less than maxGap apart is sent
+# with only its integral.
+# Partial windows are persisted in statePath, so a restart continues the
+# window it was in, and a window that ended while stopped is sent with the
+# first sample after the restart.
+
+WINDOWS = {
+    '1m': 60,
+    '15m': 900,
+    '1d': 86400,
+}
+
+MIN = 0
+MAX = 1
+SUM = 2
+COUNT = 3
+LAST = 4
+INTEGRAL = 5
+
+
+def isNumber(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+class RollupRecorder:
+
+    def __init__(self, recorder, settings, metrics, output=None):
+        # raw points go to recorder, rollups to output so that rollups are not
+        # subject to change only suppression of the raw points
+        self.recorder = recorder
+        self.output = recorder if output is None else output
+        self.metrics = metrics
+        self.windows = {}
+        for suffix in settings.get('rollup', 'windows', fallback='1m,15m,1d').split(','):
+            self.windows[suffix.strip()] = WINDOWS[suffix.strip()]
+        fields = settings.get('rollup', 'fields', fallback='')
+        self.fields = None if fields == '' else set(f.strip() for f in fields.split(','))
+        measurements = settings.get('rollup', 'measurements', fallback='')
+        self.measurements = None if measurements == '' else set(m.strip() for m in measurements.split(','))
+        # samples further apart than this are not integrated across
+        self.maxGap = settings.getfloat('rollup', 'maxGap', fallback=300)
+        self.statePath = settings.get('rollup', 'statePath', fallback='rollup.json')
+        self.persistInterval = settings.getfloat('rollup', 'persistInterval', fallback=60)
+        self.lastPersist = 0
+        self.pending = False
+        # key -> {'measurement', 'tags', 'previous': [time, values], 'windows': {suffix: [start, {field: accumulator}]}}
+        self.state = {}
+        self.load()
+
+    def __getattr__(self, name):
+        return getattr(self.recorder, name)
+
+    def load(self):
+        if not os.path.exists(self.statePath):
+            return
+        try:
+            with open(self.statePath) as f:
+                self.state = json.load(f)
+        except Exception as err:
+            print(f'Rollup state {self.statePath} not loaded {err}')
+            self.state = {}
+
+    def persist(self):
+        tmp = self.statePath + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.state, f)
+        os.replace(tmp, self.statePath)
+
+    def add(self, now, measurement, info, interval, tags):
+        self.recorder.add(now, measurement, info, interval, tags)
+        if info is None:
+            return
+        if self.measurements is not None and measurement not in self.measurements:
+            return
+        values = {}
+        for name, value in info.items():
+            if isNumber(value) and (self.fields is None or name in self.fields):
+                values[name] = value
+        if len(values) == 0:
+            return
+        key = f'{measurement}{json.dumps(tags, sort_keys=True)}'
+        series = self.state.get(key)
+        if series is None:
+            series = {'measurement': measurement, 'tags': tags, 'previous': None, 'windows': {}}
+            self.state[key] = series
+        for suffix, length in self.windows.items():
+            self._accumulate(series, suffix, length, now, values)
+        series['previous'] = [now, values]
+        if now - self.lastPersist >= self.persistInterval:
+            self.persist()
+            self.lastPersist = now
+
+    def _accumulate(self, series, suffix, length, now, values):
+        window = series['windows'].get(suffix)
+        start = now - now % length
+        previous = series['previous']
+        if previous is not None and now - previous[0] > self.maxGap:
+            previous = None
+        if window is not None and window[0] != start:
+            # window complete, integrate up to the boundary before sending it
+            end = window[0] + length
+            if previous is not None and previous[0] < end <= now:
+                self._integrate(window[1], previous, now, values, previous[0], end)
+            self._emit(series, suffix, length, window)
+            window = None
+            if previous is not None:
+                # windows the segment spans without a sample in them
+                skipped = end
+                while skipped < start:
+                    accumulators = {}
+                    self._integrate(accumulators, previous, now, values, skipped, skipped + length)
+                    self._emit(series, suffix, length, [skipped, accumulators])
+                    skipped += length
+            if previous is not None and previous[0] < start:
+                # the rest of the segment from the previous sample
+                window = [start, {}]
+                self._integrate(window[1], previous, now, values, start, now)
+                previous = None
+        if window is None:
+            window = [start, {}]
+        series['windows'][suffix] = window
+        accumulators = window[1]
+        if previous is not None:
+            self._integrate(accumulators, previous, now, values, previous[0], now)
+        for name, value in values.items():
+            accumulator = accumulators.get(name)
+            if accumulator is None:
+                accumulators[name] = [value, value, value, 1, value, 0.0]
+            elif accumulator[COUNT] == 0:
+                # only the integral so far, the first measured value
+                accumulator[:INTEGRAL] = [value, value, value, 1, value]
+            else:
+                if value < accumulator[MIN]:
+                    accumulator[MIN] = value
+                if value > accumulator[MAX]:
+                    accumulator[MAX] = value
+                accumulator[SUM] += value
+                accumulator[COUNT] += 1
+                accumulator[LAST] = value
+
+    def _integrate(self, accumulators, previous, now, values, t0, t1):
+        # trapezoid between the previous sample and now, clipped to t0..t1
+        # with the values at the clip points linearly interpolated
+        before, beforeValues = previous
+        span = now - before
+        if span <= 0:
+            return
+        for name, value in values.items():
+            if name not in beforeValues:
+                continue
+            v0 = beforeValues[name] + (value - beforeValues[name]) * (t0 - before) / span
+            v1 = beforeValues[name] + (value - beforeValues[name]) * (t1 - before) / span
+            accumulator = accumulators.get(name)
+            if accumulator is None:
+                # window started between samples, interpolated values only
+                # go into the integral, not min, max, mean or last
+                accumulator = [None, None, 0.0, 0, None, 0.0]
+                accumulators[name] = accumulator
+            accumulator[INTEGRAL] += (v0 + v1) * (t1 - t0) / 7200
+
+    def _emit(self, series, suffix, length, window):
+        start, accumulators = window
+        fields = {}
+        for name, accumulator in accumulators.items():
+            if accumulator[COUNT] > 0:
+                fields[f'{name}_min'] = accumulator[MIN]
+                fields[f'{name}_max'] = accumulator[MAX]
+                fields[f'{name}_mean'] = accumulator[SUM] / accumulator[COUNT]
+                fields[f'{name}_last'] = accumulator[LAST]
+            fields[f'{name}_integral'] = accumulator[INTEGRAL]
+        if len(fields) == 0:
+            return
+        self.output.add(start, f"{series['measurement']}_{suffix}", fields, length, series['tags'])
+        self.metrics.inc(f'rollup.{suffix}')
+        self.pending = True
+
+    def send(self):
+        self.recorder.send()
+        if self.pending and self.output is not self.recorder:
+            self.output.send()
+        self.pending = False
@@ -0,0 +1,453 @@
+#!/usr/bin/env python3
+
+import os
+import math
+import collections
+import socket
+import random
+import struct
+import threading
+import time
+import tty
+from modbusFrame import READ_HOLDING, READ_INPUT, WRITE_SINGLE, WRITE_MULTIPLE, EXCEPTION, ILLEGAL_ADDRESS, checkCrc, withCrc, readRequest
+from registerMap import fieldCode
+from registerMaps import GROWATT_INPUT, GROWATT_INFO, SDM230_INPUT
+from rtuTransport import characterTime, frameGap
+
+# Simulated Modbus RTU devices on pseudo terminals, for benchmarking without
+# hardware. RtuSlave answers reads and writes for a set of simulated devices
+# on the master side of a pty, so a client opening the slave path sees a bus of
+# Growatt inverters and SDM230 meters. Character timing follows the baud rate
+# and latency, jitter and errors can be injected. BusConversation plays a
+# controller polling a meter onto a pty, which is what the gateway's sniffer
+# listens to. TcpGateway stands in for an Ethernet to RS485 gateway, serving
+# Modbus TCP or RTU over TCP for the simulated devices on its segment.
+
+REGISTERS = 65536
+# exception code of a gateway whose target device didn't answer
+GATEWAY_NO_RESPONSE = 0x0B
+# response times kept for latency, so a long run doesn't grow without bound
+RECENT = 100000
+
+
+def openPty():
+    # returns the master fd, the slave fd, held open so the pty survives the
+    # client closing it, and the path of the slave end, all raw
+    master, slave = os.openpty()
+    tty.setraw(master)
+    tty.setraw(slave)
+    return master, slave, os.ttyname(slave)
+
+
+def frameTime(length, baudrate):
+    # the characters, 8N1 with start and stop bits, plus the gap that ends an
+    # RTU frame
+    return length * characterTime(baudrate) + frameGap(baudrate)
+
+
+class SimulatedDevice:
+
+    def __init__(self, unit, inputMap=None, holdingMap=None):
+        self.unit = unit
+        self.tables = {READ_INPUT: bytearray(REGISTERS * 2), READ_HOLDING: bytearray(REGISTERS * 2)}
+        self.maps = {READ_INPUT: inputMap, READ_HOLDING: holdingMap}
+        self.values = {READ_INPUT: {}, READ_HOLDING: {}}
+        # readable (start, end) ranges per table, None for everything
+        self.valid = {READ_INPUT: None, READ_HOLDING: None}
+        self.started = time.time()
+
+    def readable(self, function, address, count):
+        if self.valid[function] is None:
+            return True
+        return any(start <= address and address + count <= end for start, end in self.valid[function])
+
+    def set(self, function, name, value):
+        field = self.maps[function].byName[name]
+        self.values[function][name] = value
+        code = fieldCode(field)[0]
+        if field.type == 'a':
+            value = value.encode('ascii')
+        elif field.type != 'f':
+            value = int(round(value / field.scale))
+            if code in ('H', 'I'):
+                value = max(0, value)
+        struct.pack_into('>' + code, self.tables[function], field.address * 2, value)
+
+    def update(self, now):
+        pass
+
+    def read(self, function, address, count):
+        self.update(time.time())
+        return bytes(self.tables[function][address * 2:(address + count) * 2])
+
+    def write(self, address, registers):
+        struct.pack_into(f'>{len(registers)}H', self.tables[READ_HOLDING], address * 2, *registers)
+
+
+class SimulatedGrowatt(SimulatedDevice):
+
+    def __init__(self, unit, ratedPower=4200):
+        SimulatedDevice.__init__(self, unit, GROWATT_INPUT, GROWATT_INFO)
+        self.valid = {READ_INPUT: [(0, 125), (3000, 3125)], READ_HOLDING: [(0, 250), (3000, 3125)]}
+        self.ratedPower = ratedPower
+        self.energy = 1000.0
+        self.lastUpdate = time.time()
+        self.set(READ_HOLDING, 'FirmwareVersion', 'SIM1.0')
+        self.set(READ_HOLDING, 'ControlFirmwareVersion', 'SIM1.0')
+        self.set(READ_HOLDING, 'SerialNumber', f'SIM{unit:07d}')
+        self.set(READ_HOLDING, 'ModbusVersion', 1.2)
+        self.set(READ_HOLDING, 'InverterType', 'Simulated 4200')
+        self.set(READ_HOLDING, 'Latitude', 52)
+        self.set(READ_HOLDING, 'Longitude', 0)
+        self.set(READ_HOLDING, 'ExportLimitPowerRate', 100)
+        self.update(self.lastUpdate)
+
+    def update(self, now):
+        # a slow sine for the sun with some noise, and the counters that follow it
+        ppv = max(0.0, self.ratedPower * 0.6 * math.sin((now - self.started) / 600 + 0.5) + random.gauss(0, 20))
+        self.energy += ppv * (now - self.lastUpdate) / 3600000
+        self.lastUpdate = now
+        pac = ppv * 0.97
+        self.set(READ_INPUT, 'StatusCode', 1 if ppv > 0 else 0)
+        self.set(READ_INPUT, 'Ppv', ppv)
+        self.set(READ_INPUT, 'Vpv1', 300 + random.gauss(0, 1))
+        self.set(READ_INPUT, 'PV1Curr', ppv / 600)
+        self.set(READ_INPUT, 'PV1Watt', ppv / 2)
+        self.set(READ_INPUT, 'Vpv2', 300 + random.gauss(0, 1))
+        self.set(READ_INPUT, 'PV2Curr', ppv / 600)
+        self.set(READ_INPUT, 'PV2Watt', ppv / 2)
+        self.set(READ_INPUT, 'Pac', pac)
+        self.set(READ_INPUT, 'Fac', 50 + random.gauss(0, 0.02))
+        self.set(READ_INPUT, 'Vac1', 240 + random.gauss(0, 0.5))
+        self.set(READ_INPUT, 'Iac1', pac / 240)
+        self.set(READ_INPUT, 'Pac1', pac)
+        self.set(READ_INPUT, 'EnergyToday', self.energy - 1000)
+        self.set(READ_INPUT, 'EnergyTotal', self.energy)
+        self.set(READ_INPUT, 'Epv1_today', (self.energy - 1000) / 2)
+        self.set(READ_INPUT, 'Epv1_total', self.energy / 2)
+        self.set(READ_INPUT, 'Epv2_today', (self.energy - 1000) / 2)
+        self.set(READ_INPUT, 'Epv2_total', self.energy / 2)
+        self.set(READ_INPUT, 'Epv_total', self.energy)
+        self.set(READ_INPUT, 'TempInverter', 35 + ppv / 200)
+        self.set(READ_INPUT, 'TempIpm', 38 + ppv / 200)
+        self.set(READ_INPUT, 'TempBoost', 36 + ppv / 200)
+
+
+class SimulatedSdm230(SimulatedDevice):
+
+    def __init__(self, unit):
+        SimulatedDevice.__init__(self, unit, SDM230_INPUT)
+        self.imported = 5000.0
+        self.exported = 2000.0
+        self.lastUpdate = time.time()
+        self.update(self.lastUpdate)
+
+    def update(self, now):
+        power = 1500 * math.sin((now - self.started) / 300 + 0.5) + random.gauss(0, 30)
+        hours = (now - self.lastUpdate) / 3600
+        self.lastUpdate = now
+        if power > 0:
+            self.imported += power * hours / 1000
+        else:
+            self.exported -= power * hours / 1000
+        voltage = 240 + random.gauss(0, 0.5)
+        self.set(READ_INPUT, 'Voltage', voltage)
+        self.set(READ_INPUT, 'Current', abs(power) / voltage)
+        self.set(READ_INPUT, 'ActivePower', power)
+        self.set(READ_INPUT, 'ApparentPower', abs(power) * 1.02)
+        self.set(READ_INPUT, 'ReactivePower', abs(power) * 0.2)
+        self.set(READ_INPUT, 'PowerFactor', 0.98)
+        self.set(READ_INPUT, 'Frequency', 50 + random.gauss(0, 0.02))
+        self.set(READ_INPUT, 'ImportActiveEnergy', self.imported)
+        self.set(READ_INPUT, 'ExportActiveEnergy', self.exported)
+        self.set(READ_INPUT, 'TotalActiveEnergy', self.imported + self.exported)
+        self.set(READ_INPUT, 'ResetableActiveEnergy', self.imported)
+
+
+def requestLength(buffer):
+    # the length of the RTU request at the start of buffer, None if too short to tell
+    if buffer[1] in (READ_HOLDING, READ_INPUT, WRITE_SINGLE):
+        return 8
+    if buffer[1] == WRITE_MULTIPLE:
+        if len(buffer) < 7:
+            return None
+        return 9 + buffer[6]
+    # unknown function, resync
+    return 8
+
+
+def answer(device, request):
+    # a device's response to a request, unit to data without the CRC
+    unit, function = request[0], request[1]
+    address, value = struct.unpack_from('>HH', request, 2)
+    if function in (READ_HOLDING, READ_INPUT):
+        if device.maps[function] is None or not device.readable(function, address, value):
+            return bytes([unit, function | EXCEPTION, ILLEGAL_ADDRESS])
+        data = device.read(function, address, value)
+        return bytes([unit, function, len(data)]) + data
+    if function == WRITE_SINGLE:
+        device.write(address, [value])
+        return request[:6]
+    if function == WRITE_MULTIPLE:
+        device.write(address, list(struct.unpack_from(f'>{value}H', request, 7)))
+        return request[:6]
+    return bytes([unit, function | EXCEPTION, 1])
+
+
+class SlaveStats:
+
+    def __init__(self):
+        self.requests = 0
+        self.responses = 0
+        self.crcErrors = 0
+        self.injected = 0
+        self.lastResponse = 0
+        self.responseTimes = collections.deque(maxlen=RECENT)
+
+
+class RtuSlave:
+
+    def __init__(self, fd, devices, baudrate=9600, latency=0.01, jitter=0.0, errorRate=0.0):
+        self.fd = fd
+        self.devices = {d.unit: d for d in devices}
+        self.baudrate = baudrate
+        self.latency = latency
+        self.jitter = jitter
+        self.errorRate = errorRate
+        self.stats = SlaveStats()
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self._serve, name='rtuSlave', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+
+    def _serve(self):
+        buffer = bytearray()
+        while self.running:
+            try:
+                data = os.read(self.fd, 256)
+            except OSError:
+                # the client closed the port
+                time.sleep(0.1)
+                continue
+            received = time.time()
+            buffer += data
+            while len(buffer) >= 8:
+                length = requestLength(buffer)
+                if length is None or len(buffer) < length:
+                    break
+                if not checkCrc(buffer, 0, length):
+                    # out of sync, drop a byte and look again
+                    self.stats.crcErrors += 1
+                    del buffer[0]
+                    continue
+                request = bytes(buffer[:length])
+                del buffer[:length]
+                self._respond(request, received)
+
+    def _respond(self, request, received):
+        self.stats.requests += 1
+        device = self.devices.get(request[0])
+        if device is None:
+            # no such device on the bus, the client times out
+            return
+        response = withCrc(answer(device, request))
+        if self.errorRate > 0 and random.random() < self.errorRate:
+            self.stats.injected += 1
+            if random.random() < 0.5:
+                # lost reply
+                return
+            response = response[:-1] + bytes([response[-1] ^ 0xff])
+        delay = self.latency + abs(random.gauss(0, self.jitter)) if self.jitter > 0 else self.latency
+        due = received + delay + frameTime(len(response), self.baudrate)
+        time.sleep(max(0, due - time.time()))
+        os.write(self.fd, response)
+        self.stats.responses += 1
+        self.stats.lastResponse = time.time()
+        self.stats.responseTimes.append(self.stats.lastResponse)
+
+
+class TcpGateway:
+
+    # an Ethernet to RS485 gateway in front of simulated devices. framing tcp
+    # takes Modbus TCP requests and answers with the MBAP header, rtu passes
+    # RTU frames through the socket. Requests from every connection share the
+    # one RS485 segment, so they are answered in turn, each taking the time its
+    # request and response frames take on the bus. A request for a unit that
+    # isn't there gets the gateway's no response exception after timeout
+    # seconds over Modbus TCP and no reply over RTU.
+
+    def __init__(self, devices, framing='tcp', baudrate=9600, latency=0.01, timeout=0.5, host='127.0.0.1', port=0):
+        self.devices = {d.unit: d for d in devices}
+        self.framing = framing
+        self.baudrate = baudrate
+        self.latency = latency
+        self.timeout = timeout
+        self.stats = SlaveStats()
+        self.segment = threading.Lock()
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind((host, port))
+        self.listener.listen(16)
+        self.host, self.port = self.listener.getsockname()
+        self.running = False
+
+    def url(self):
+        # the port to configure in an [inverters.*] section
+        return f'{"tcp" if self.framing == "tcp" else "rtu+tcp"}://{self.host}:{self.port}'
+
+    def start(self):
+        self.running = True
+        threading.Thread(target=self._accept, name='tcpGateway', daemon=True).start()
+
+    def stop(self):
+        self.running = False
+        # close alone leaves a blocked accept() listening, shutdown wakes it
+        try:
+            self.listener.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.listener.close()
+
+    def _accept(self):
+        while self.running:
+            try:
+                connection, _ = self.listener.accept()
+            except OSError:
+                return
+            connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            serve = self._serveTcp if self.framing == 'tcp' else self._serveRtu
+            threading.Thread(target=serve, args=(connection,), name='tcpGatewayClient', daemon=True).start()
+
+    def _bus(self, request):
+        # the RTU response from the segment, None if nothing answers
+        with self.segment:
+            self.stats.requests += 1
+            started = time.time()
+            device = self.devices.get(request[0])
+            if device is None:
+                time.sleep(self.timeout)
+                return None
+            response = withCrc(answer(device, request))
+            due = started + frameTime(len(request), self.baudrate) + self.latency + frameTime(len(response), self.baudrate)
+            time.sleep(max(0, due - time.time()))
+            self.stats.responses += 1
+            self.stats.lastResponse = time.time()
+            return response
+
+    def _receive(self, connection, length):
+        data = bytearray()
+        while len(data) < length:
+            chunk = connection.recv(length - len(data))
+            if len(chunk) == 0:
+                raise ConnectionError('closed')
+            data += chunk
+        return bytes(data)
+
+    def _serveTcp(self, connection):
+        with connection:
+            try:
+                while self.running:
+                    header = self._receive(connection, 7)
+                    transaction, protocol, length, unit = struct.unpack('>HHHB', header)
+                    pdu = self._receive(connection, length - 1)
+                    response = self._bus(withCrc(bytes([unit]) + pdu))
+                    if response is None:
+                        # gateway target device failed to respond
+                        response = bytes([unit, pdu[0] | EXCEPTION, GATEWAY_NO_RESPONSE, 0, 0])
+                    # the MBAP header replaces the CRC
+                    connection.sendall(struct.pack('>HHH', transaction, protocol, len(response) - 2) + response[:-2])
+            except OSError:
+                pass
+
+    def _serveRtu(self, connection):
+        buffer = bytearray()
+        with connection:
+            try:
+                while self.running:
+                    data = connection.recv(256)
+                    if len(data) == 0:
+                        return
+                    buffer += data
+                    while len(buffer) >= 8:
+                        length = requestLength(buffer)
+                        if length is None or len(buffer) < length:
+                            break
+                        if not checkCrc(buffer, 0, length):
+                            self.stats.crcErrors += 1
+                            del buffer[0]
+                            continue
+                        request = bytes(buffer[:length])
+                        del buffer[:length]
+                        response = self._bus(request)
+                        if response is not None:
+                            connection.sendall(response)
+            except OSError:
+                pass
+
+
+class BusConversation:
+
+    # a controller polling devices, both sides of the conversation are
+    # written to the pty as a sniffer on the bus would see them
+
+    def __init__(self, fd, devices, interval=1.0, baudrate=9600, latency=0.01, errorRate=0.0):
+        self.fd = fd
+        self.devices = devices
+        self.interval = interval
+        self.baudrate = baudrate
+        self.latency = latency
+        self.errorRate = errorRate
+        self.frames = 0
+        self.responses = 0
+        # (time, unit, function, address) of the recent responses
+        self.sent = collections.deque(maxlen=RECENT)
+        self.running = False
+
+    def start(self):
+        self.running = True
+        threading.Thread(target=self._talk, name='busConversation', daemon=True).start()
+        threading.Thread(target=self._drain, name='busDrain', daemon=True).start()
+
+    def stop(self):
+        self.running = False
+
+    def _drain(self):
+        # requests the sniffer sends itself are discarded
+        while self.running:
+            try:
+                os.read(self.fd, 256)
+            except OSError:
+                time.sleep(0.1)
+
+    def _write(self, frame):
+        if self.errorRate > 0 and random.random() < self.errorRate:
+            frame = frame[:-1] + bytes([frame[-1] ^ 0xff])
+        time.sleep(frameTime(len(frame), self.baudrate))
+        try:
+            os.write(self.fd, frame)
+        except OSError:
+            return
+        self.frames += 1
+
+    def _talk(self):
+        nextPoll = time.time()
+        while self.running:
+            for device in self.devices:
+                for function, registerMap in device.maps.items():
+                    if registerMap is None:
+                        continue
+                    for block in registerMap.blocks:
+                        self._write(readRequest(device.unit, function, block.address, block.count))
+                        time.sleep(self.latency)
+                        data = device.read(function, block.address, block.count)
+                        self._write(withCrc(bytes([device.unit, function, len(data)]) + data))
+                        self.sent.append((time.time(), device.unit, function, block.address))
+                        self.responses += 1
+            nextPoll += self.interval
+            time.sleep(max(0, nextPoll - time.time()))
@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+
+import array
+import struct
+import time
+from modbusFrame import READ_HOLDING, READ_INPUT, WRITE_SINGLE, WRITE_MULTIPLE, EXCEPTION
+from instruments import instruments
+
+# Adaptive timing for an RTU master, RtuMaster in busMultiplexer.py. Rather
+# than waiting a fixed timeout for every unit, each unit's timeout is learned
+# from how long it takes to start answering, the percentile of its recent
+# response times times factor plus margin, between minTimeout and timeout.
+# Until minSamples responses have been seen, and again after a unit times
+# out, it gets longer. After failures consecutive failures a unit's circuit
+# opens and requests to it fail at once, a single probe request goes through
+# after probeInterval seconds, doubling up to maxProbeInterval while it stays
+# silent, so an inverter that has gone to sleep costs the bus almost nothing.
+# With baudrates set the master tries each speed, fastest first, at startup
+# until one of probeUnits answers, and uses the first that does, for a bus
+# whose devices have been set to a faster speed. Configured in a [timing]
+# section, eg
+#   percentile = 99
+#   factor = 1.5
+#   margin = 0.05
+#   failures = 3
+#   baudrates = 38400,19200,9600
+#   probeUnits = 3
+
+
+def characterTime(baudrate, bytesize=8, parity='N', stopbits=1):
+    # start bit, data bits, parity bit and stop bits
+    return (1 + bytesize + (0 if parity == 'N' else 1) + stopbits) / baudrate
+
+
+def frameGap(baudrate, bytesize=8, parity='N', stopbits=1):
+    # the silence that ends a frame, 3.5 characters, fixed at 1.75ms above
+    # 19200 baud as the Modbus serial line spec says
+    if baudrate > 19200:
+        return 0.00175
+    return 3.5 * characterTime(baudrate, bytesize, parity, stopbits)
+
+
+def waitUntil(deadline):
+    # sleeps to within a millisecond of deadline then spins, sleep alone can
+    # overshoot a 4ms frame gap by a good fraction of it
+    while True:
+        remaining = deadline - time.perf_counter()
+        if remaining <= 0:
+            return
+        if remaining > 0.002:
+            time.sleep(remaining - 0.001)
+
+
+class UnitTiming:
+
+    def __init__(self, window, timeout):
+        self.latencies = array.array('d', bytes(8 * window))
+        self.count = 0
+        self.timeout = timeout
+        self.learned = None
+        self.failures = 0
+        self.probeInterval = 0
+        self.retryAt = 0
+
+
+class AdaptiveTiming:
+
+    def __init__(self, settings, timeout=1, section='timing'):
+        self.maxTimeout = timeout
+        self.minTimeout = settings.getfloat(section, 'minTimeout', fallback=0.05)
+        self.percentile = settings.getfloat(section, 'percentile', fallback=99)
+        self.factor = settings.getfloat(section, 'factor', fallback=1.5)
+        self.margin = settings.getfloat(section, 'margin', fallback=0.05)
+        self.window = settings.getint(section, 'window', fallback=200)
+        self.minSamples = settings.getint(section, 'minSamples', fallback=20)
+        self.failures = settings.getint(section, 'failures', fallback=3)
+        self.probeInterval = settings.getfloat(section, 'probeInterval', fallback=5)
+        self.maxProbeInterval = settings.getfloat(section, 'maxProbeInterval', fallback=300)
+        baudrates = settings.get(section, 'baudrates', fallback='')
+        self.baudrates = sorted((int(b) for b in baudrates.split(',') if b.strip() != ''), reverse=True)
+        probeUnits = settings.get(section, 'probeUnits', fallback='')
+        self.probeUnits = [int(u) for u in probeUnits.split(',') if u.strip() != '']
+        self.units = {}
+
+    def _unit(self, unit):
+        timing = self.units.get(unit)
+        if timing is None:
+            timing = UnitTiming(self.window, self.maxTimeout)
+            self.units[unit] = timing
+        return timing
+
+    def timeout(self, unit):
+        # how long to wait for the first byte of the unit's response
+        return self._unit(unit).timeout
+
+    def allow(self, unit, now):
+        # False while the unit's circuit is open and no probe is due
+        timing = self._unit(unit)
+        if timing.failures < self.failures or now >= timing.retryAt:
+            return True
+        instruments.inc('rtu_fast_failures_total', unit=unit)
+        return False
+
+    def success(self, unit, latency):
+        timing = self._unit(unit)
+        if timing.failures >= self.failures:
+            print(f'unit {unit} answering again')
+        timing.failures = 0
+        timing.probeInterval = 0
+        timing.latencies[timing.count % self.window] = latency
+        timing.count += 1
+        if timing.count >= self.minSamples and (timing.count % 10 == 0 or timing.learned is None or timing.timeout > timing.learned):
+            recent = sorted(timing.latencies[:min(timing.count, self.window)])
+            p = recent[min(len(recent) - 1, int(len(recent) * self.percentile / 100))]
+            timing.learned = min(self.maxTimeout, max(self.minTimeout, p * self.factor + self.margin))
+            timing.timeout = timing.learned
+            instruments.gauge('rtu_timeout_seconds', timing.timeout, unit=unit)
+
+    def failure(self, unit, now, timedOut=True):
+        timing = self._unit(unit)
+        timing.failures += 1
+        if timedOut:
+            # a slow answer rather than no answer gets the longer wait next time
+            timing.timeout = min(self.maxTimeout, timing.timeout * 2)
+        if timing.failures < self.failures:
+            return
+        if timing.failures == self.failures:
+            print(f'unit {unit} not answering, probing every {self.probeInterval}s')
+            instruments.inc('rtu_circuit_open_total', unit=unit)
+        timing.probeInterval = min(self.maxProbeInterval, timing.probeInterval * 2 if timing.probeInterval > 0 else self.probeInterval)
+        timing.retryAt = now + timing.probeInterval
+
+
+class RtuClient:
+
+    # a pymodbus style client for RtuMaster, for solarmon and metermon to talk
+    # RTU with adaptive timing without the multiplexer. Responses are
+    # pymodbus response objects so the drivers don't know the difference.
+
+    def __init__(self, master):
+        self.master = master
+
+    def connect(self):
+        if self.master.serial is None:
+            self.master.connect()
+        return True
+
+    def close(self):
+        self.master.close()
+
+    def _execute(self, unit, pdu, decode):
+        from pymodbus.exceptions import ModbusIOException
+        from pymodbus.pdu import ExceptionResponse
+        self.connect()
+        response = self.master.transact(unit, pdu)
+        if response is None:
+            return ModbusIOException(f'No Response received from unit {unit}', pdu[0])
+        if response[0] & EXCEPTION:
+            return ExceptionResponse(response[0] & ~EXCEPTION, response[1])
+        return decode(response)
+
+    def _registers(self, response):
+        return list(struct.unpack_from(f'>{response[1] // 2}H', response, 2))
+
+    def read_holding_registers(self, address, count=1, unit=0, **kwargs):
+        from pymodbus.register_read_message import ReadHoldingRegistersResponse
+        return self._execute(unit, struct.pack('>BHH', READ_HOLDING, address, count),
+            lambda response: ReadHoldingRegistersResponse(self._registers(response), unit=unit))
+
+    def read_input_registers(self, address, count=1, unit=0, **kwargs):
+        from pymodbus.register_read_message import ReadInputRegistersResponse
+        return self._execute(unit, struct.pack('>BHH', READ_INPUT, address, count),
+            lambda response: ReadInputRegistersResponse(self._registers(response), unit=unit))
+
+    def write_register(self, address, value, unit=0, **kwargs):
+        from pymodbus.register_write_message import WriteSingleRegisterResponse
+        return self._execute(unit, struct.pack('>BHH', WRITE_SINGLE, address, value),
+            lambda response: WriteSingleRegisterResponse(*struct.unpack_from('>HH', response, 1), unit=unit))
+
+    def write_registers(self, address, values, unit=0, **kwargs):
+        from pymodbus.register_write_message import WriteMultipleRegistersResponse
+        pdu = struct.pack(f'>BHHB{len(values)}H', WRITE_MULTIPLE, address, len(values), len(values) * 2, *values)
+        return self._execute(unit, pdu,
+            lambda response: WriteMultipleRegistersResponse(*struct.unpack_from('>HH', response, 1), unit=unit))
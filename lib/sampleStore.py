@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+
+import array
+import bisect
+import math
+import threading
+from instruments import instruments
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Recent samples kept in memory for local consumers, the export logic or
+# someone debugging on the Pi, in a fixed amount of memory. Each measurement
+# and tag set has a ring of capacity samples, an array of times and an array
+# of doubles per numeric field, all allocated when the series or field is
+# first seen, so storing a sample writes floats in place and allocates
+# nothing. A field missing from a sample is NaN. New series and fields are
+# only kept while they fit in memoryBudget bytes, others are counted and
+# ignored. Window queries bisect the times and reduce the field's slice of the
+# ring, with NumPy over the array's memory when it is installed. Configured
+# in a [store] section, eg
+#   capacity = 3600
+#   memoryBudget = 8388608
+#   measurements = inverter,sdm230
+
+NAN = math.nan
+DOUBLE = 8
+
+
+class Series:
+
+    __slots__ = ('measurement', 'tags', 'capacity', 'times', 'fields', 'views', 'known', 'head', 'count')
+
+    def __init__(self, measurement, tags, capacity):
+        self.measurement = measurement
+        self.tags = tags
+        self.capacity = capacity
+        self.times = array.array('d', bytes(DOUBLE * capacity))
+        # field -> array of values, and a NumPy view of the same memory
+        self.fields = {}
+        self.views = {}
+        # the fields kept and those that aren't, text or over the budget
+        self.known = set()
+        # the slot the next sample goes in
+        self.head = 0
+        self.count = 0
+
+    def addField(self, name):
+        column = array.array('d', [NAN]) * self.capacity
+        self.fields[name] = column
+        if numpy is not None:
+            self.views[name] = numpy.frombuffer(column, dtype=numpy.float64)
+        return column
+
+    def segments(self):
+        # the filled slots, oldest first, as (start, end) ranges
+        if self.count < self.capacity:
+            return ((0, self.count),)
+        return ((self.head, self.capacity), (0, self.head))
+
+    def since(self, start):
+        # the ranges of slots at or after time start
+        result = []
+        for first, end in self.segments():
+            i = bisect.bisect_left(self.times, start, first, end)
+            if i < end:
+                result.append((i, end))
+        return result
+
+    def last(self):
+        return (self.head - 1) % self.capacity if self.count > 0 else None
+
+
+class Sample:
+
+    # a stored sample, read from the rings in place instead of kept as a dict
+
+    __slots__ = ('series', 'index')
+
+    def __init__(self, series, index):
+        self.series = series
+        self.index = index
+
+    @property
+    def time(self):
+        return self.series.times[self.index]
+
+    def get(self, field, default=None):
+        column = self.series.fields.get(field)
+        if column is None or math.isnan(column[self.index]):
+            return default
+        return column[self.index]
+
+    def __getitem__(self, field):
+        value = self.get(field)
+        if value is None:
+            raise KeyError(field)
+        return value
+
+    def items(self):
+        return [(name, column[self.index]) for name, column in self.series.fields.items() if not math.isnan(column[self.index])]
+
+
+class SampleStore:
+
+    def __init__(self, settings):
+        self.capacity = settings.getint('store', 'capacity', fallback=3600)
+        self.memoryBudget = settings.getint('store', 'memoryBudget', fallback=8388608)
+        measurements = settings.get('store', 'measurements', fallback='')
+        self.measurements = None if measurements == '' else set(m.strip() for m in measurements.split(','))
+        self.series = {}
+        self.bytes = 0
+        self.lock = threading.Lock()
+
+    def _key(self, measurement, tags):
+        if not tags:
+            return measurement
+        if isinstance(tags, dict):
+            tags = tags.items()
+        return (measurement, tuple(sorted(tags)))
+
+    def _reserve(self, measurement, size):
+        if self.bytes + size > self.memoryBudget:
+            instruments.inc('store_over_budget_total', measurement=measurement)
+            return False
+        self.bytes += size
+        instruments.gauge('store_bytes', self.bytes)
+        return True
+
+    def add(self, now, measurement, info, tags=()):
+        if info is None or (self.measurements is not None and measurement not in self.measurements):
+            return
+        key = self._key(measurement, tags)
+        with self.lock:
+            series = self.series.get(key)
+            if series is None:
+                if key in self.series or not self._reserve(measurement, DOUBLE * self.capacity):
+                    # remembered as None so it is only counted once
+                    self.series[key] = None
+                    return
+                series = Series(measurement, key[1] if isinstance(key, tuple) else (), self.capacity)
+                self.series[key] = series
+            i = series.head
+            series.times[i] = now
+            for name, column in series.fields.items():
+                try:
+                    column[i] = info.get(name, NAN)
+                except TypeError:
+                    # None or text where there was a number
+                    column[i] = NAN
+            if not info.keys() <= series.known:
+                # a field not seen before
+                for name, value in info.items():
+                    if name in series.known or value is None:
+                        continue
+                    series.known.add(name)
+                    if isinstance(value, (int, float)) and self._reserve(measurement, DOUBLE * self.capacity):
+                        series.addField(name)[i] = value
+            series.head = (i + 1) % series.capacity
+            if series.count < series.capacity:
+                series.count += 1
+
+    def _find(self, measurement, tags):
+        return self.series.get(self._key(measurement, tags))
+
+    def latest(self, measurement, tags=()):
+        # the last sample of a measurement, None if there isn't one
+        with self.lock:
+            series = self._find(measurement, tags)
+            if series is None or series.count == 0:
+                return None
+            return Sample(series, series.last())
+
+    def window(self, measurement, field, seconds, now=None, tags=()):
+        # (times, values) of a field over the last seconds, oldest first,
+        # copied out of the ring. Samples without the field are left out.
+        with self.lock:
+            series = self._find(measurement, tags)
+            if series is None or series.count == 0 or field not in series.fields:
+                return array.array('d'), array.array('d')
+            end = series.times[series.last()] if now is None else now
+            times = array.array('d')
+            values = array.array('d')
+            column = series.fields[field]
+            for start, stop in series.since(end - seconds):
+                times.extend(series.times[start:stop])
+                values.extend(column[start:stop])
+        keep = [i for i, v in enumerate(values) if not math.isnan(v)]
+        if len(keep) < len(values):
+            times = array.array('d', (times[i] for i in keep))
+            values = array.array('d', (values[i] for i in keep))
+        return times, values
+
+    def stats(self, measurement, field, seconds, now=None, tags=()):
+        # count, mean, min, max and last of a field over the last seconds,
+        # None if there are no values
+        with self.lock:
+            series = self._find(measurement, tags)
+            if series is None or series.count == 0 or field not in series.fields:
+                return None
+            end = series.times[series.last()] if now is None else now
+            ranges = series.since(end - seconds)
+            if numpy is not None:
+                view = series.views[field]
+                parts = [view[start:stop] for start, stop in ranges]
+                values = numpy.concatenate(parts) if len(parts) > 1 else parts[0] if len(parts) == 1 else view[0:0]
+                values = values[~numpy.isnan(values)]
+                if len(values) == 0:
+                    return None
+                return {'count': int(len(values)), 'mean': float(values.mean()), 'min': float(values.min()),
+                        'max': float(values.max()), 'last': float(values[-1])}
+            column = series.fields[field]
+            values = [v for start, stop in ranges for v in column[start:stop] if not math.isnan(v)]
+        if len(values) == 0:
+            return None
+        return {'count': len(values), 'mean': math.fsum(values) / len(values), 'min': min(values),
+                'max': max(values), 'last': values[-1]}
+
+    def mean(self, measurement, field, seconds, now=None, tags=()):
+        result = self.stats(measurement, field, seconds, now, tags)
+        return None if result is None else result['mean']
+
+    def max(self, measurement, field, seconds, now=None, tags=()):
+        result = self.stats(measurement, field, seconds, now, tags)
+        return None if result is None else result['max']
+
+    def min(self, measurement, field, seconds, now=None, tags=()):
+        result = self.stats(measurement, field, seconds, now, tags)
+        return None if result is None else result['min']
+
+    def names(self):
+        # (measurement, tags, fields) of every series kept
+        with self.lock:
+            return [(s.measurement, s.tags, list(s.fields.keys())) for s in self.series.values() if s is not None]
+
+
+class StoreRecorder:
+
+    # keeps every sample in a SampleStore on its way to the recorder
+
+    def __init__(self, recorder, store):
+        self.recorder = recorder
+        self.store = store
+
+    def __getattr__(self, name):
+        return getattr(self.recorder, name)
+
+    def add(self, now, measurement, info, interval, tags):
+        self.store.add(now, measurement, info, tags)
+        self.recorder.add(now, measurement, info, interval, tags)
+
+    def send(self):
+        self.recorder.send()
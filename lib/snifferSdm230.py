@@ -0,0 +1,40 @@
+#!/usr/bin/env python3
+
+from modbusFrame import READ_INPUT
+from registerMaps import SDM230_INPUT
+
+# SDM230 device processor for the ring buffer sniffer. Values are decoded from
+# the input register bytemap the sniffer fills from the controller's reads,
+# a whole block per call with the compiled SDM230 register map. Only fields
+# whose registers have been seen on the bus are reported.
+
+
+class SnifferSdm230:
+
+    def __init__(self, sniffer, device, logFields):
+        self.sniffer = sniffer
+        self.device = device
+        self.logFields = logFields
+        self.values = {}
+        unknown = SDM230_INPUT.unknown([f for f in logFields if f != ''])
+        if len(unknown) > 0:
+            print(f'SDM230 {device} logFields not in the register map: {unknown}')
+
+    def request(self):
+        # the controller has stopped polling the meter, ask it directly
+        for block in SDM230_INPUT.blocks:
+            self.sniffer.request(self.device, READ_INPUT, block.address, block.count)
+
+    def update(self):
+        table = self.sniffer.table(self.device, READ_INPUT)
+        if table is None:
+            return
+        decoded = {}
+        for block in SDM230_INPUT.blocks:
+            block.decode(table, block.address * 2, decoded)
+        for field in SDM230_INPUT.fields:
+            if self.sniffer.isSeen(self.device, READ_INPUT, field.address, field.width):
+                self.values[field.name] = decoded[field.name]
+
+    def read(self):
+        return dict(self.values)
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+
+import math
+from pollScheduler import nextDeadline
+
+# Poll scheduling that follows the sun and the rate each field changes at.
+# SolarSchedule decides when an inverter is next polled. Overnight it sleeps
+# until shortly before sunrise instead of timing out every offline interval.
+# Around sunrise, and while the PV voltage is below the inverter's start
+# voltage, it polls every wakeInterval so generation is picked up as soon as
+# it starts, then drops to the normal interval.
+# FieldRates splits a register map into groups read at their own rates, eg
+# power every second and totals every hour, and only reads the groups that
+# are due, planned together so due groups still share reads.
+
+
+def toSigned(value):
+    # Latitude and Longitude are held in unsigned 16 bit registers
+    return value - 0x10000 if value > 0x7fff else value
+
+
+def sunTimes(now, latitude, longitude):
+    # sunrise and sunset for the UTC day containing now, from the sunrise
+    # equation, good to a few minutes. None for polar day or night.
+    n = math.ceil(now / 86400 + 2440587.5 - 2451545.0 + 0.0008)
+    mean = n - longitude / 360
+    anomaly = math.radians((357.5291 + 0.98560028 * mean) % 360)
+    centre = 1.9148 * math.sin(anomaly) + 0.02 * math.sin(2 * anomaly) + 0.0003 * math.sin(3 * anomaly)
+    ecliptic = math.radians((math.degrees(anomaly) + centre + 180 + 102.9372) % 360)
+    transit = 2451545.0 + mean + 0.0053 * math.sin(anomaly) - 0.0069 * math.sin(2 * ecliptic)
+    declination = math.asin(math.sin(ecliptic) * math.sin(math.radians(23.4397)))
+    lat = math.radians(latitude)
+    cosHour = (math.sin(math.radians(-0.833)) - math.sin(lat) * math.sin(declination)) / (math.cos(lat) * math.cos(declination))
+    if cosHour < -1 or cosHour > 1:
+        return None
+    hour = math.degrees(math.acos(cosHour)) / 360
+    return (transit - hour - 2440587.5) * 86400, (transit + hour - 2440587.5) * 86400
+
+
+class SolarSchedule:
+
+    def __init__(self, settings, latitude, longitude, interval=1, offlineInterval=60):
+        self.latitude = settings.getfloat('solar', 'latitude', fallback=latitude)
+        self.longitude = settings.getfloat('solar', 'longitude', fallback=longitude)
+        # a location in the config overrides the inverter's
+        self.configured = settings.has_option('solar', 'latitude')
+        # seconds either side of sunrise and sunset to treat as day
+        self.margin = settings.getint('solar', 'margin', fallback=1800)
+        self.startVoltage = settings.getfloat('solar', 'startVoltage', fallback=100)
+        self.wakeInterval = settings.getint('solar', 'wakeInterval', fallback=15)
+        # the longest sleep, in case the clock or location is wrong
+        self.nightInterval = settings.getint('solar', 'nightInterval', fallback=3600)
+        self.interval = interval
+        self.offlineInterval = offlineInterval
+
+    def locate(self, latitude, longitude):
+        # the inverter's location, once it has been read
+        if not self.configured:
+            self.latitude = latitude
+            self.longitude = longitude
+
+    def nextWake(self, now):
+        # the start of the next daytime window, or None if it is day now
+        if self.latitude == 0 and self.longitude == 0:
+            # location not set, always day
+            return None
+        # UTC days either side, the local solar day can straddle them
+        for day in (-86400, 0, 86400):
+            times = sunTimes(now + day, self.latitude, self.longitude)
+            if times is None:
+                return None
+            sunrise, sunset = times
+            if now < sunrise - self.margin:
+                return sunrise - self.margin
+            if now <= sunset + self.margin:
+                return None
+        return now + self.nightInterval
+
+    def next(self, now, info, deadline):
+        if info is None:
+            wake = self.nextWake(now)
+            if wake is not None:
+                return min(wake, now + self.nightInterval)
+            if self.nextWake(now - 2 * self.margin) is not None:
+                # around sunrise the inverter is about to start
+                return now + self.wakeInterval
+            return now + self.offlineInterval
+        if 'Vpv1' in info:
+            voltage = max(info.get('Vpv1', 0), info.get('Vpv2', 0))
+            if voltage < self.startVoltage:
+                # awake but not generating, check again soon
+                return now + self.wakeInterval
+        return nextDeadline(deadline, self.interval, now)
+
+
+class FieldRates:
+
+    def __init__(self, registerMap, groups, defaultInterval=1):
+        # groups are (name, interval, [field names]), any field not in a group
+        # is read every defaultInterval
+        self.registerMap = registerMap
+        self.groups = []
+        grouped = set()
+        for name, interval, fields in groups:
+            fields = [f for f in fields if f in registerMap.byName]
+            grouped.update(fields)
+            self.groups.append([name, interval, fields, 0])
+        rest = [f.name for f in registerMap.fields if f.name not in grouped]
+        if len(rest) > 0:
+            self.groups.append(['default', defaultInterval, rest, 0])
+        self.maps = {}
+        # polls land just after their deadline, don't miss a group by a few ms
+        self.tolerance = defaultInterval / 2
+
+    @staticmethod
+    def fromSettings(settings, registerMap, defaultInterval=1):
+        # [rates] group = interval: field,field,...
+        groups = []
+        for name, value in settings.items('rates'):
+            interval, fields = value.split(':', 1)
+            groups.append((name, float(interval), [f.strip() for f in fields.split(',') if f.strip() != '']))
+        return FieldRates(registerMap, groups, defaultInterval)
+
+    def due(self, now):
+        # the register map of the groups due now, planned together
+        names = []
+        for group in self.groups:
+            if now + self.tolerance >= group[3]:
+                names.append(group[0])
+                group[3] = nextDeadline(group[3], group[1], now) if group[3] > 0 else now + group[1]
+        if len(names) == 0:
+            return None
+        key = tuple(names)
+        registerMap = self.maps.get(key)
+        if registerMap is None:
+            fields = [f for group in self.groups if group[0] in names for f in group[2]]
+            registerMap = self.registerMap.subset(fields)
+            self.maps[key] = registerMap
+        return registerMap
+
+    def reset(self):
+        # read everything on the next poll
+        for group in self.groups:
+            group[3] = 0
@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+
+import atexit
+import ctypes
+import json
+import os
+import select
+import signal
+import sys
+import threading
+import time
+from instruments import instruments
+
+# Helpers that get a restarted process back to collecting quickly.
+# waitForPath() sleeps on inotify until a serial port appears rather than
+# checking every 5s. StartupState keeps what a process learnt at run time in
+# a JSON file, the device info read from each device, so startup doesn't
+# spend serial round trips reading it again, and the time of the last export
+# evaluation and the instrument counters, so a restart doesn't start an
+# export analysis straight away or reset the counters. LazyRecorder defers
+# building the recorder, and importing InfluxDB, until the first publish.
+
+IN_ATTRIB = 0x00000004
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+# recheck anyway in case an event is missed
+RECHECK = 60
+
+
+def _inotify():
+    try:
+        libc = ctypes.CDLL('libc.so.6', use_errno=True)
+        fd = libc.inotify_init1(os.O_CLOEXEC)
+        return (libc, fd) if fd >= 0 else (None, -1)
+    except (OSError, AttributeError):
+        return None, -1
+
+
+def waitForPath(path):
+    # returns once path exists, eg a USB serial adapter being plugged in
+    if os.path.exists(path):
+        return
+    print("Waiting for ", path)
+    libc, fd = _inotify()
+    try:
+        while not os.path.exists(path):
+            if fd < 0:
+                time.sleep(1)
+                continue
+            # watch the deepest directory that exists, /dev/serial/by-id
+            # is only created when the first adapter appears
+            directory = os.path.dirname(os.path.abspath(path))
+            while not os.path.isdir(directory):
+                directory = os.path.dirname(directory)
+            watch = libc.inotify_add_watch(fd, directory.encode(), IN_CREATE | IN_MOVED_TO | IN_ATTRIB)
+            if os.path.exists(path):
+                break
+            readable, _, _ = select.select([fd], [], [], RECHECK)
+            if len(readable) > 0:
+                os.read(fd, 4096)
+            libc.inotify_rm_watch(fd, watch)
+    finally:
+        if fd >= 0:
+            os.close(fd)
+
+
+def processStartTime():
+    # when the process started, including the interpreter's own startup
+    try:
+        with open('/proc/self/stat') as f:
+            ticks = int(f.read().rsplit(')', 1)[1].split()[19])
+        with open('/proc/stat') as f:
+            for line in f:
+                if line.startswith('btime'):
+                    return int(line.split()[1]) + ticks / os.sysconf('SC_CLK_TCK')
+    except (OSError, ValueError, IndexError):
+        pass
+    return time.time()
+
+
+class StartupState:
+
+    def __init__(self, settings, name):
+        # nothing is kept without a [state] section
+        self.path = None
+        if settings.has_section('state'):
+            self.path = settings.get('state', 'path', fallback=f'{name}.state.json')
+        self.saveInterval = settings.getint('state', 'saveInterval', fallback=60)
+        self.lock = threading.Lock()
+        self.lastSave = time.time()
+        self.started = processStartTime()
+        self.reachedAt = {}
+        self.state = {'info': {}, 'devices': {}, 'counters': []}
+        if self.path is not None and os.path.exists(self.path):
+            try:
+                with open(self.path) as f:
+                    self.state.update(json.load(f))
+            except (OSError, ValueError) as err:
+                print(f'Ignoring state {self.path} {err}')
+        # counters carry on from where the last run stopped
+        for name, labels, value in self.state['counters']:
+            instruments.inc(name, value, **dict(labels))
+
+    def info(self, key):
+        return self.state['info'].get(key)
+
+    def setInfo(self, key, info):
+        with self.lock:
+            self.state['info'][key] = info
+
+    def device(self, key):
+        # the persisted runtime state of a device, updated in place
+        with self.lock:
+            return self.state['devices'].setdefault(key, {})
+
+    def reached(self, stage):
+        # records how long after startup a stage, eg the first poll, was first reached
+        if stage in self.reachedAt:
+            return
+        self.reachedAt[stage] = time.time()
+        elapsed = self.reachedAt[stage] - self.started
+        instruments.gauge('startup_seconds', elapsed, stage=stage)
+        print(f'First {stage} {elapsed:.3f}s after start')
+
+    def save(self, now=None):
+        if self.path is None:
+            return
+        now = time.time() if now is None else now
+        with self.lock:
+            with instruments.lock:
+                self.state['counters'] = [[name, list(labels), value] for (name, labels), value in instruments.counters.items()]
+            tmp = self.path + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(self.state, f)
+            os.replace(tmp, self.path)
+            self.lastSave = now
+
+    def maybeSave(self, now):
+        if now > self.lastSave + self.saveInterval:
+            self.save(now)
+
+    def saveOnExit(self):
+        # systemd stops with SIGTERM, exit normally so the state is saved
+        if self.path is None:
+            return
+        atexit.register(self.save)
+        exitOnTerm()
+
+
+def exitOnTerm():
+    # systemd stops a service with SIGTERM, exit normally so atexit handlers run
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+
+class LazyRecorder:
+
+    # builds the recorder on first use, off the poll path, so a heavy import
+    # such as influxdb doesn't delay the first poll
+
+    def __init__(self, factory):
+        self.factory = factory
+        self.recorder = None
+        self.lock = threading.Lock()
+
+    def _get(self):
+        if self.recorder is None:
+            with self.lock:
+                if self.recorder is None:
+                    self.recorder = self.factory()
+        return self.recorder
+
+    def __getattr__(self, name):
+        return getattr(self._get(), name)
+
+    def add(self, now, measurement, info, interval, tags):
+        self._get().add(now, measurement, info, interval, tags)
+
+    def send(self):
+        return self._get().send()
+
+    def discard(self):
+        # drops the points a failed send left buffered, a recorder that can't
+        # discard them is rebuilt on next use with nothing buffered
+        with self.lock:
+            recorder = self.recorder
+            if recorder is None:
+                return
+            discard = getattr(recorder, 'discard', None)
+            if discard is None:
+                self.recorder = None
+        if discard is not None:
+            discard()
@@ -2,15 +2,18 @@
 
 import time
 import os
+import sys
 sys.path.append('../lib')
 
-from os.path import exists
-
 from configparser import RawConfigParser
-from influxdb import InfluxDBClient
-from pymodbus.client.sync import ModbusSerialClient as ModbusClient
 
 from sdm230meter import SDM230Meter
+from mappedDevice import MappedSdm230
+from instruments import MetricsEndpoint, InstrumentedClient, instruments
+from busClient import ConnectionPool, isSerial, usesBus
+from httpPush import HttpSink
+from startupState import waitForPath, exitOnTerm
+from sampleStore import SampleStore
 
 settings = RawConfigParser()
 settings.read(os.path.dirname(os.path.realpath(__file__)) + '/metermon.cfg')
@@ -23,13 +26,21 @@ port = settings.get('query', 'port', fallback='/dev/ttyUSB0')
 
 db_name = settings.get('influx', 'db_name', fallback='none')
 
-while not exists(port):
-    print("Waiting for ", port);
-    time.sleep(5)
+if isSerial(port) and not usesBus(settings):
+    waitForPath(port)
 
 # Clients
 influxPending = True
-if db_name != 'none':
+sink = None
+if settings.has_section('push'):
+    # batched line protocol to InfluxDB's /write or Grafana, in place of write_points per sample
+    sink = HttpSink(settings)
+    # the queued samples are pushed at exit, when systemd stops the service too
+    exitOnTerm()
+    influxPending = False
+elif db_name != 'none':
+    # only imported when it is used
+    from influxdb import InfluxDBClient
     while influxPending:
         try:
             print('Setup InfluxDB Client... ', end='')
@@ -45,10 +56,15 @@ if db_name != 'none':
             print('Failed to connect to Influx')
             time.sleep(10)
 
-print('Setup Serial Connection... ', end='')
-client = ModbusClient(method='rtu', port=port, baudrate=9600, stopbits=1, parity='N', bytesize=8, timeout=1)
-client.connect()
+print('Setup Connection... ', end='')
+client = ConnectionPool(settings, InstrumentedClient).client(port)
 print('Dome!')
+store = None
+if settings.has_section('store'):
+    # the last few thousand samples of every meter in memory
+    store = SampleStore(settings)
+if settings.has_section('metrics'):
+    MetricsEndpoint(settings, store=store).start()
 
 print('Loading meters... ')
 print(settings.sections())
@@ -62,7 +78,10 @@ for section in settings.sections():
     name = section[7:]
     unit = int(settings.get(section, 'unit'))
     measurement = settings.get(section, 'measurement')
-    meter = SDM230Meter(client=client, name=name, unit=unit)
+    if settings.get(section, 'driver', fallback='sdm230') == 'map':
+        meter = MappedSdm230(client, name, unit)
+    else:
+        meter = SDM230Meter(client=client, name=name, unit=unit)
     meter.print_info()
     meters.append({
         'error_sleep': 0,
@@ -91,18 +110,24 @@ while True:
             # Mark that at least one inverter is online so we should continue collecting data
             online = True
 
-            points = [{
-                'time': int(now),
-                'measurement': meter['measurement'],
-                "fields": info
-            }]
+            if store is not None:
+                store.add(now, meter['measurement'], info)
             if debug == '1':
                 print(sdm230.name)
-                print(points)
-
-            if not influxPending:
+                print(info)
+
+            if sink is not None:
+                sink.addPoint(now, meter['measurement'], info)
+            elif not influxPending:
+                points = [{
+                    'time': int(now),
+                    'measurement': meter['measurement'],
+                    "fields": info
+                }]
+                started = time.perf_counter()
                 if not influx.write_points(points, time_precision='s'):
                     print("Failed to write to DB!")
+                instruments.observe('recorder_send_seconds', time.perf_counter() - started)
         except Exception as err:
             print(sdm230.name)
             print(err)
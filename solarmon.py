@@ -3,25 +3,33 @@
 import time
 import os
 import sys
-import traceback
 import json
 
 sys.path.append('./lib')
 
 from configparser import RawConfigParser
-from influxdb import InfluxDBClient
-from pymodbus.client.sync import ModbusSerialClient as ModbusClient
-from os.path import exists
 
-from growatt import Growatt
-from metricsRecorder import MetricsRecorder
 from modbusMetrics import ModbusMetrics
-from calcExportLimit import ExportLimitCalc
+from readPlanner import ReadPlanner, PlannedClient, HOLDING, readRegisters, isValid
+from pollScheduler import PollScheduler
+from exportAggregates import ExportAggregates
+from mappedDevice import MappedGrowatt
+from registerMaps import GROWATT_INPUT
+from solarSchedule import SolarSchedule, FieldRates, toSigned
+from instruments import MetricsEndpoint, InstrumentedClient
+from busClient import ConnectionPool, isSerial, usesBus
+from startupState import StartupState, waitForPath
+from registerSnapshot import SnapshotReader
+from exportController import ExportController
+from recorderChain import recorderChain
+from cycleProfiler import CycleProfiler, ProfiledClient
 
 
 
 settings = RawConfigParser()
 settings.read(os.path.dirname(os.path.realpath(__file__)) + '/solarmon.cfg')
+startup = StartupState(settings, 'solarmon')
+startup.saveOnExit()
 
 interval = settings.getint('query', 'interval', fallback=1)
 offline_interval = settings.getint('query', 'offline_interval', fallback=60)
@@ -30,21 +38,88 @@ debug = settings.get('query', 'debug', fallback=0)
 if not os.environ.get('DEBUG') == None:
     debug = os.environ.get('DEBUG')
 port = settings.get('query', 'port', fallback='/dev/ttyUSB0')
+planner = settings.getint('query', 'planner', fallback=1)
 
-while not exists(port):
-    print("Waiting for ", port);
-    time.sleep(5)
+queue_size = settings.getint('query', 'queue_size', fallback=100)
+
+# each inverter may be on its own port, a serial port or a gateway, one
+# client per port. The first section on a port may set its baudrate and timeout.
+ports = {}
+for section in settings.sections():
+    if section.startswith('inverters.'):
+        ports.setdefault(settings.get(section, 'port', fallback=port), section)
+
+for p in ports:
+    # the multiplexer owns the serial port when there is one
+    if isSerial(p) and not usesBus(settings):
+        waitForPath(p)
 
 metrics = ModbusMetrics(settings)
-recorder = MetricsRecorder(settings, metrics)
-exportCalc = ExportLimitCalc(settings)
+recorder, store = recorderChain(settings, metrics)
+exportCalc = None
+exportAggregates = None
+if settings.get('export', 'mode', fallback='incremental') == 'incremental':
+    exportAggregates = ExportAggregates(settings)
+else:
+    from calcExportLimit import ExportLimitCalc
+    exportCalc = ExportLimitCalc(settings)
+scheduler = PollScheduler(metrics, interval, offline_interval, error_interval, queue_size)
+profile = CycleProfiler(settings, 'solarmon')
+if settings.has_section('metrics'):
+    MetricsEndpoint(settings, store=store).start()
 
 
 
-print('Setup Serial Connection... ', end='')
-client = ModbusClient(method='rtu', port=port, baudrate=9600, stopbits=1, parity='N', bytesize=8, timeout=1)
-client.connect()
-print('Done!')
+# every port has its own poll thread, so gateways are polled concurrently
+# while the inverters behind each one are polled in turn
+pool = ConnectionPool(settings, InstrumentedClient)
+for p in ports:
+    print(f'Setup Connection {p}... ', end='')
+    client = pool.client(p, ports[p])
+    if profile.enabled:
+        client = ProfiledClient(client, profile)
+    if planner == 1:
+        client = PlannedClient(client, ReadPlanner.fromSettings(settings), debug)
+    ports[p] = client
+    scheduler.addPort(p, client)
+    print('Done!')
+
+def location(info):
+    # Latitude and Longitude from the device info, unknown is (0, 0)
+    if info is None or 'Latitude' not in info:
+        return 0, 0
+    return toSigned(info['Latitude']), toSigned(info['Longitude'])
+
+
+def showInfo(inverter, info):
+    if hasattr(inverter['growatt'], 'readInfo'):
+        inverter['growatt'].print_info(info)
+    else:
+        print(f"{inverter['name']} unit {inverter['unit']} location {location(info)}")
+
+
+def refreshInfo(inverter):
+    # runs on the port thread after the first sample, the cached info was shown at startup
+    growatt = inverter['growatt']
+    if hasattr(growatt, 'readInfo'):
+        info = growatt.readInfo()
+    else:
+        growatt.print_info()
+        row = readRegisters(inverter['client'], HOLDING, 241, 2, inverter['unit'])
+        info = {'Latitude': row.registers[0], 'Longitude': row.registers[1]} if isValid(row) else None
+    if info is None:
+        return
+    if startup.info(inverter['infoKey']) is None:
+        showInfo(inverter, info)
+    startup.setInfo(inverter['infoKey'], info)
+    if 'schedule' in inverter:
+        inverter['schedule'].locate(*location(info))
+    if 'controller' in inverter and hasattr(growatt, 'holding') and not settings.has_option('control', 'failsafeLimit'):
+        # fall back to the inverter's own G100 failsafe export power
+        image = growatt.holding.load([3000])
+        if 3000 in image:
+            inverter['controller'].failsafeLimit = image[3000] * growatt.ratedPower / 1000
+
 
 print('Loading inverters... ')
 inverters = []
@@ -57,74 +132,164 @@ for section in settings.sections():
     measurement = settings.get(section, 'measurement')
     limits = json.loads(settings.get(section, 'limits', fallback="[[4,500],[4.5,1000],[5,2000]]"))
     exportEvaluatePeriod = int(settings.get(section, 'exportEvaluatePeriod', fallback=900))
-    growatt = Growatt(client, name, unit)
-    growatt.print_info()
-    inverters.append({
-        'error_sleep': 0,
+    inverterPort = settings.get(section, 'port', fallback=port)
+    client = ports[inverterPort]
+    driver = settings.get(section, 'driver', fallback='growatt')
+    ratedPower = settings.getint(section, 'ratedPower', fallback=4200)
+    if driver == 'map':
+        growatt = MappedGrowatt(client, name, unit, ratedPower)
+        if settings.has_section('rates'):
+            growatt.rates = FieldRates.fromSettings(settings, GROWATT_INPUT, interval)
+    else:
+        from growatt import Growatt
+        growatt = Growatt(client, name, unit)
+    # carried over a restart, so a restart doesn't evaluate the export limit straight away
+    state = startup.device(name)
+    inverter = {
+        'name': name,
         'growatt': growatt,
+        'client': client,
+        'unit': unit,
         'measurement': measurement,
         'limits': limits,
         'exportEvaluatePeriod': exportEvaluatePeriod,
-        'lastExportEvaluate': 0
-    })
+        'lastExportEvaluate': state.get('lastExportEvaluate', 0),
+        'state': state,
+        'infoKey': f'{inverterPort}|{unit}',
+        # device info is read after the first sample, not before
+        'infoPending': True,
+        # map driven devices plan their own reads
+        'planned': planner == 1 and driver != 'map'
+    }
+    if settings.get(section, 'exportControl', fallback='table') == 'live':
+        # follows the meter's live power, the export table sets its target
+        inverter['controller'] = ExportController(settings, ratedPower, name)
+        if 'exportLimit' in state:
+            inverter['controller'].setTarget(state['exportLimit'])
+    info = startup.info(inverter['infoKey'])
+    if info is not None:
+        showInfo(inverter, info)
+    if settings.has_section('solar'):
+        inverter['schedule'] = SolarSchedule(settings, *location(info), interval, offline_interval)
+    inverters.append(inverter)
+    scheduler.addDevice(inverterPort, inverter)
 print('Done!')
 
-while True:
-    online = False
-    for inverter in inverters:
-        # If this inverter errored then we wait a bit before trying again
-        if inverter['error_sleep'] > 0:
-            inverter['error_sleep'] -= interval
-            continue
 
-        growatt = inverter['growatt']
-        try:
-            now = time.time()
-            info = growatt.read()
+def poll(inverter):
+    with profile.cycle('poll', inverter['name'], interval):
+        return pollInverter(inverter)
 
-            if info is None:
-                continue
 
-            # Mark that at least one inverter is online so we should continue collecting data
-            online = True
-            recorder.add(now, inverter['measurement'], info, interval,[])
-            tosend = True
+def pollInverter(inverter):
+    client = inverter['client']
+    try:
+        if inverter['planned']:
+            client.startPoll(inverter['unit'])
+        with profile.phase('read'):
+            info = inverter['growatt'].read()
+    finally:
+        # or later reads of the unit are served from this poll's image
+        if inverter['planned']:
+            client.endPoll(inverter['unit'])
+    if info is not None and len(info) > 0:
+        startup.reached('poll')
+        if inverter['infoPending']:
+            inverter['infoPending'] = False
+            try:
+                with profile.phase('info'):
+                    refreshInfo(inverter)
+            except Exception as err:
+                print(f"{inverter['name']} info not available {err}")
+    if info is not None and 'controller' in inverter:
+        # on the port thread, so the write goes between polls
+        try:
+            with profile.phase('control'):
+                inverter['controller'].step(time.time(), info, inverter['growatt'].setExportLimit)
+        except Exception as err:
+            metrics.inc('main.exceptions')
+            print(f"{inverter['name']} export control failed {err}")
+    return info
 
-            if tosend:
-                recorder.send()
+
+def publish(samples):
+    with profile.cycle('publish', str(len(samples)), interval):
+        with profile.phase('add'):
+            for now, inverter, info in samples:
+                recorder.add(now, inverter['measurement'], info, interval,[])
                 if debug == 1:
-                    print(growatt.name)
+                    print(inverter['name'])
                     print(info)
-
+        with profile.phase('send'):
+            recorder.send()
+        startup.reached('sample')
+        with profile.phase('report'):
             metrics.report(recorder)
+        with profile.phase('save'):
+            startup.maybeSave(time.time())
 
-            if now > inverter['lastExportEvaluate'] + inverter['exportEvaluatePeriod']:     
-                inverter['lastExportEvaluate'] = now
-                exportCalc.load("gateway", 'gatewayData')
-                endOfPeriod = (time.time())
-                startOfPeriod = (endOfPeriod - (7*24*3600))
-                exportCalculations = exportCalc.analyse(startOfPeriod, endOfPeriod)
-                print(f'export calcs {json.dumps(exportCalculations)}')
-                limitSet = False
-                for limit in inverter['limits']:                
-                    if exportCalculations['kwh'] < limit[0]:
-                        growatt.setExportLimit(limit[1])
-                        limitSet = True
-                        break;
-                if not limitSet:
-                    growatt.setExportLimit(4200)
 
+snapshot = None
+def latestReading():
+    # the meter's counters now from the gateway's shared memory snapshot,
+    # the gateway's files are only written every few minutes
+    global snapshot
+    try:
+        if snapshot is None:
+            snapshot = SnapshotReader(settings.get('snapshot', 'path', fallback='/dev/shm/modbusgw.snapshot'))
+        else:
+            snapshot.reopen()
+        values, updated, sequence = snapshot.get(settings.get('snapshot', 'device', fallback='sdm230'))
+    except (OSError, ValueError, KeyError) as err:
+        print(f'Snapshot not available {err}')
+        return
+    if sequence > 0:
+        exportAggregates.addReading(updated, values.get(exportAggregates.exportField), values.get(exportAggregates.importField))
 
 
-        except Exception as err:
-            metrics.inc('main.exceptions')
-            traceback.print_exc()
-            print(growatt.name)
-            print(err)
-            inverter['error_sleep'] = error_interval
+def evaluate(inverter):
+    with profile.cycle('evaluate', inverter['name']):
+        return evaluateInverter(inverter)
+
 
-    if online:
-        time.sleep(interval)
+def evaluateInverter(inverter):
+    inverter['state']['lastExportEvaluate'] = inverter['lastExportEvaluate']
+    with profile.phase('save'):
+        startup.save()
+    endOfPeriod = (time.time())
+    startOfPeriod = (endOfPeriod - (7*24*3600))
+    if exportAggregates is not None:
+        # only reads what the gateway wrote since the last refresh, shared by all inverters
+        with profile.phase('load'):
+            exportAggregates.refresh()
+            if settings.has_section('snapshot'):
+                latestReading()
+        with profile.phase('analyse'):
+            exportCalculations = exportAggregates.analyse(startOfPeriod, endOfPeriod)
     else:
-        # If all the inverters are not online because no power is being generated then we sleep for 1 min
-        time.sleep(offline_interval)
+        with profile.phase('load'):
+            exportCalc.load("gateway", 'gatewayData')
+        with profile.phase('analyse'):
+            exportCalculations = exportCalc.analyse(startOfPeriod, endOfPeriod)
+    if exportCalculations is None:
+        # no readings, leave the limit as it is rather than apply the first entry
+        return None
+    print(f'export calcs {json.dumps(exportCalculations)}')
+    for limit in inverter['limits']:
+        if exportCalculations['kwh'] < limit[0]:
+            return limit[1]
+    return 4200
+
+
+def control(inverter, limit):
+    with profile.cycle('control', inverter['name']):
+        if 'controller' in inverter:
+            inverter['controller'].setTarget(limit)
+        elif inverter['growatt'].setExportLimit(limit) is False:
+            # tried again at the next evaluation, the legacy driver returns
+            # None and isn't checked
+            return
+        inverter['state']['exportLimit'] = limit
+
+
+scheduler.run(poll, publish, evaluate, control)
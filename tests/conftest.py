@@ -0,0 +1,46 @@
+import os
+import sys
+import pytest
+
+# the modules import each other from lib, as the programs put it on the path
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'lib'))
+
+from rtuSimulator import answer
+from rtuTransport import RtuClient
+
+
+class LocalMaster:
+
+    # stands in for RtuMaster, simulated devices answer in process. drop(unit,
+    # pdu) returning True loses the request as a device that didn't answer.
+
+    def __init__(self, devices):
+        self.devices = {d.unit: d for d in devices}
+        self.serial = True
+        self.requests = []
+        self.drop = None
+
+    def connect(self):
+        pass
+
+    def close(self):
+        pass
+
+    def transact(self, unit, pdu):
+        self.requests.append((unit, bytes(pdu)))
+        device = self.devices.get(unit)
+        if device is None or (self.drop is not None and self.drop(unit, pdu)):
+            return None
+        # answer() takes and gives RTU frames from the unit on, the CRC isn't checked
+        return answer(device, bytes([unit]) + bytes(pdu) + bytes(2))[1:]
+
+
+@pytest.fixture
+def localBus():
+    # (client, master) for simulated devices, pymodbus style responses without a port
+    pytest.importorskip('pymodbus')
+
+    def make(*devices):
+        master = LocalMaster(devices)
+        return RtuClient(master), master
+    return make
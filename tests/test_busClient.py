@@ -0,0 +1,101 @@
+import time
+import pytest
+
+# skipped before anything from lib loads, the clients are pymodbus ones
+pytest.importorskip('pymodbus')
+
+from configparser import RawConfigParser
+from rtuSimulator import TcpGateway, SimulatedGrowatt
+from busClient import ConnectionPool, modbusClient, transport
+from instruments import instruments
+
+# the pool against local stand-ins for Ethernet to RS485 gateways
+
+
+def counter(name, port):
+    return instruments.counters.get((name, (('port', port),)), 0)
+
+
+def settings(timeout=1, backoff=0.2):
+    config = RawConfigParser()
+    config['query'] = {'timeout': str(timeout), 'reconnect_backoff': str(backoff), 'reconnect_max_backoff': '1'}
+    return config
+
+
+@pytest.fixture
+def gateways():
+    started = []
+
+    def start(framing='tcp', units=(1,), port=0, timeout=0.5):
+        gateway = TcpGateway([SimulatedGrowatt(unit) for unit in units], framing, 115200, 0, timeout, port=port)
+        gateway.start()
+        started.append(gateway)
+        return gateway
+    yield start
+    for gateway in started:
+        gateway.stop()
+
+
+def test_transport():
+    assert transport('tcp://192.168.1.50:502') == ('tcp', '192.168.1.50', 502)
+    assert transport('rtu+tcp://192.168.1.51:8899/') == ('rtu+tcp', '192.168.1.51', 8899)
+    assert transport('tcp://gateway') == ('tcp', 'gateway', 502)
+    assert transport('/dev/ttyUSB0') == ('serial', '/dev/ttyUSB0', None)
+
+
+@pytest.mark.parametrize('framing,framer', [('tcp', 'ModbusSocketFramer'), ('rtu', 'ModbusRtuFramer')])
+def test_framing_follows_url(gateways, framing, framer):
+    gateway = gateways(framing)
+    client = modbusClient(settings(), gateway.url())
+    try:
+        assert type(client.framer).__name__ == framer
+        response = client.read_holding_registers(23, count=5, unit=1)
+        assert not response.isError()
+        assert len(response.registers) == 5
+    finally:
+        client.close()
+
+
+def test_backoff_and_fast_fail(gateways):
+    gateway = gateways()
+    url = gateway.url()
+    port = gateway.port
+    gateway.stop()
+    pool = ConnectionPool(settings(backoff=0.2))
+    client = pool.client(url)
+    failures = counter('transport_connection_failures_total', url)
+    fastFailures = counter('transport_fast_failures_total', url)
+
+    assert client.read_input_registers(0, count=2, unit=1).isError()
+    assert counter('transport_connection_failures_total', url) == failures + 1
+    assert client.backoff == pytest.approx(0.4)
+
+    # backing off, failed without trying to connect
+    assert client.read_input_registers(0, count=2, unit=1).isError()
+    assert counter('transport_fast_failures_total', url) == fastFailures + 1
+    assert counter('transport_connection_failures_total', url) == failures + 1
+
+    # the gateway is back after the backoff
+    gateways(port=port)
+    time.sleep(0.25)
+    assert not client.read_input_registers(0, count=2, unit=1).isError()
+    assert client.backoff == pytest.approx(0.2)
+    pool.close()
+
+
+def test_reconnect_after_timeout(gateways):
+    # nothing answers for unit 9, over RTU the gateway sends nothing back
+    gateway = gateways('rtu', timeout=0.1)
+    url = gateway.url()
+    pool = ConnectionPool(settings(timeout=0.3))
+    client = pool.client(url)
+    connects = counter('transport_connects_total', url)
+
+    assert not client.read_input_registers(0, count=2, unit=1).isError()
+    assert client.read_input_registers(0, count=2, unit=9).isError()
+    # a late reply on the old socket can't be taken for the next answer
+    assert client.client is None
+    time.sleep(0.2)
+    assert not client.read_input_registers(0, count=2, unit=1).isError()
+    assert counter('transport_connects_total', url) == connects + 2
+    pool.close()
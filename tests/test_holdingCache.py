@@ -0,0 +1,70 @@
+import struct
+from holdingCache import HoldingCache, runs
+from modbusFrame import READ_HOLDING, WRITE_SINGLE, WRITE_MULTIPLE
+from rtuSimulator import SimulatedGrowatt
+
+
+def register(device, address):
+    return struct.unpack_from('>H', device.tables[READ_HOLDING], address * 2)[0]
+
+
+def writes(master):
+    return [pdu for unit, pdu in master.requests if pdu[0] in (WRITE_SINGLE, WRITE_MULTIPLE)]
+
+
+def test_runs_groups_adjacent_registers():
+    assert runs([12, 10, 11, 50]) == [(10, 3), (50, 1)]
+    assert runs(range(0, 130)) == [(0, 123), (123, 7)]
+
+
+def test_unchanged_values_are_not_written(localBus):
+    device = SimulatedGrowatt(1)
+    client, master = localBus(device)
+    cache = HoldingCache(client, 1)
+    assert cache.write({123: register(device, 123)})
+    assert writes(master) == []
+
+
+def test_adjacent_changes_go_in_one_write(localBus):
+    device = SimulatedGrowatt(1)
+    client, master = localBus(device)
+    cache = HoldingCache(client, 1)
+    assert cache.write({60: 1, 61: 2, 62: 3})
+    assert len(writes(master)) == 1
+    assert [register(device, a) for a in (60, 61, 62)] == [1, 2, 3]
+    assert cache.get(61) == 2
+
+
+def test_failed_run_rolls_back_earlier_runs(localBus):
+    device = SimulatedGrowatt(1)
+    client, master = localBus(device)
+    cache = HoldingCache(client, 1)
+    cache.write({60: 7, 61: 8, 90: 9})
+    # the write to 90 goes unanswered
+    master.drop = lambda unit, pdu: pdu[0] in (WRITE_SINGLE, WRITE_MULTIPLE) and struct.unpack_from('>H', pdu, 1)[0] == 90
+    assert not cache.write({60: 1, 61: 2, 90: 3})
+    assert [register(device, a) for a in (60, 61, 90)] == [7, 8, 9]
+    # what the device holds is read again before the next write
+    assert cache.get(60) is None and cache.get(90) is None
+
+    master.drop = None
+    assert cache.write({60: 1, 61: 2, 90: 3})
+    assert [register(device, a) for a in (60, 61, 90)] == [1, 2, 3]
+
+
+def test_write_that_does_not_read_back_is_rolled_back(localBus):
+    device = SimulatedGrowatt(1)
+    client, master = localBus(device)
+    cache = HoldingCache(client, 1)
+    cache.write({60: 7})
+    write = device.write
+
+    def clamped(address, registers):
+        # a device that stores something other than was written above 8
+        write(address, [r if r <= 8 else 8 for r in registers])
+    device.write = clamped
+    assert not cache.write({60: 9})
+    assert register(device, 60) == 7
+    device.write = write
+    assert cache.write({60: 9})
+    assert register(device, 60) == 9
@@ -0,0 +1,63 @@
+from readPlanner import ReadPlanner, PlannedClient, INPUT, HOLDING
+from modbusFrame import READ_INPUT
+from rtuSimulator import SimulatedGrowatt
+
+
+def growatt(valid):
+    device = SimulatedGrowatt(1)
+    device.valid[READ_INPUT] = valid
+    return device
+
+
+def test_plan_merges_small_holes():
+    planner = ReadPlanner(maxGap=4)
+    assert planner.plan([(0, 2), (4, 2), 7, (20, 3)]) == [(0, 8), (20, 3)]
+
+
+def test_plan_skips_contained_and_overlapping_ranges():
+    planner = ReadPlanner(maxGap=0)
+    assert planner.plan([(0, 10), (2, 3), (8, 4)]) == [(0, 12)]
+
+
+def test_plan_splits_at_max_count():
+    planner = ReadPlanner(maxGap=8)
+    assert planner.plan([(0, 125), (130, 10)]) == [(0, 125), (130, 10)]
+    assert planner.plan([(0, 300)]) == [(0, 125), (125, 125), (250, 50)]
+    assert ReadPlanner(maxCount=40).plan([(0, 30), (32, 20)]) == [(0, 30), (32, 20)]
+
+
+def test_refused_hole_is_not_read_through_again(localBus):
+    client, master = localBus(growatt([(0, 10), (20, 30)]))
+    planner = ReadPlanner(maxGap=20)
+    wanted = [(0, 5), (25, 5)]
+
+    image, transactions = planner.read(client, INPUT, wanted, unit=1)
+    # the merged read is refused, then the two ranges are read on their own
+    assert transactions == 3
+    assert sorted(image) == list(range(0, 5)) + list(range(25, 30))
+    assert planner.barriers == set(range(5, 25))
+
+    master.requests.clear()
+    image, transactions = planner.read(client, INPUT, wanted, unit=1)
+    assert transactions == 2
+    assert len(master.requests) == 2
+
+
+def test_planned_client_serves_later_polls_from_blocks(localBus):
+    device = growatt(None)
+    client, master = localBus(device)
+    planned = PlannedClient(client, ReadPlanner(maxGap=8))
+
+    def poll():
+        planned.startPoll(1)
+        values = [planned.read_input_registers(a, count=2, unit=1).registers for a in (0, 4, 10)]
+        planned.read_holding_registers(23, count=5, unit=1)
+        return values, planned.endPoll(1)
+
+    first, stats = poll()
+    assert stats['requested'] == 4 and stats['issued'] == 4
+    second, stats = poll()
+    # one input block and one holding block
+    assert stats['requested'] == 4 and stats['issued'] == 2
+    assert [len(r) for r in second] == [2, 2, 2]
+    assert planned.plans[1] == {INPUT: [(0, 12)], HOLDING: [(23, 5)]}
@@ -0,0 +1,78 @@
+import struct
+from registerScanner import RegisterScanner, ILLEGAL
+from readPlanner import INPUT
+from modbusFrame import READ_INPUT
+from rtuSimulator import SimulatedGrowatt
+
+# readable (address, count) input registers of the simulated device
+VALID = [(0, 10), (40, 5), (300, 140)]
+
+
+def growatt():
+    device = SimulatedGrowatt(1)
+    device.valid[READ_INPUT] = [(address, address + count) for address, count in VALID]
+    return device
+
+
+def scanner(client, tmp_path, stride=1, end=500):
+    return RegisterScanner(client, 1, INPUT, str(tmp_path / 'scan'), end=end,
+                           layoutsPath=str(tmp_path / 'layouts.json'), stride=stride)
+
+
+def test_scan_finds_readable_ranges(localBus, tmp_path):
+    client, master = localBus(growatt())
+    scan = scanner(client, tmp_path, stride=16)
+    assert scan.scan() == VALID
+    assert scan.failed() == []
+    # far fewer reads than one per register
+    assert scan.transactions < 100
+    scan.close()
+
+
+def test_skip_illegal_lands_on_next_readable(localBus, tmp_path):
+    client, master = localBus(growatt())
+    scan = scanner(client, tmp_path)
+    scan._open(False)
+    assert scan._skipIllegal(10, 500) == 40
+    assert scan._skipIllegal(45, 500) == 300
+    assert set(scan.status[10:40]) == {ILLEGAL}
+    # nothing readable before end
+    assert scan._skipIllegal(440, 500) == 500
+    scan.close()
+
+
+def test_bisect_stores_readable_start_of_refused_block(localBus, tmp_path):
+    device = growatt()
+    client, master = localBus(device)
+    scan = scanner(client, tmp_path)
+    scan._open(False)
+    assert scan._step(0, 125) == 10
+    image = struct.unpack_from('>10H', scan.image, 0)
+    assert list(image) == list(struct.unpack_from('>10H', device.tables[READ_INPUT], 0))
+    scan.close()
+
+
+def test_unanswered_register_is_failed_not_illegal(localBus, tmp_path):
+    client, master = localBus(growatt())
+
+    def covers5(unit, pdu):
+        address, count = struct.unpack_from('>HH', pdu, 1)
+        return address <= 5 < address + count
+    master.drop = covers5
+    scan = scanner(client, tmp_path)
+    assert scan.scan() == [(0, 5), (6, 4), (40, 5), (300, 140)]
+    assert scan.failed() == [(5, 1)]
+    scan.close()
+
+
+def test_known_layout_only_reads_its_ranges(localBus, tmp_path):
+    client, master = localBus(growatt())
+    first = scanner(client, tmp_path)
+    first.scan(model='sim')
+    first.close()
+    master.requests.clear()
+    second = scanner(client, tmp_path)
+    assert second.scan(model='sim') == VALID
+    # one read per 125 registers
+    assert len(master.requests) == 4
+    second.close()
@@ -0,0 +1,83 @@
+import struct
+import threading
+import pytest
+from registerSnapshot import SnapshotWriter, SnapshotReader
+
+FIELDS = ['ActivePower', 'Voltage', 'ImportActiveEnergy', 'ExportActiveEnergy']
+
+
+@pytest.fixture
+def snapshot(tmp_path):
+    path = str(tmp_path / 'snapshot')
+    writer = SnapshotWriter(path, [('sdm230', 2, 'sdm230', FIELDS), ('meter', 3, 'sdm230', ['ActivePower'])])
+    yield path, writer
+    writer.close()
+
+
+def test_values_until_seen(snapshot):
+    path, writer = snapshot
+    reader = SnapshotReader(path)
+    assert reader.get('sdm230') == ({}, 0, 0)
+    writer.update('sdm230', {'ActivePower': -350.5, 'Unknown': 1}, 1000.0)
+    assert reader.get('sdm230') == ({'ActivePower': -350.5}, 1000.0, 1)
+    assert reader.value('sdm230', 'Voltage') is None
+    assert reader.sequence() == 1
+    reader.close()
+
+
+def test_retries_while_a_write_is_in_progress(snapshot):
+    path, writer = snapshot
+    writer.update('sdm230', {'ActivePower': 1}, 1000.0)
+    reader = SnapshotReader(path)
+    # a writer stopped half way leaves the sequence odd
+    struct.pack_into('<Q', writer.map, 8, 3)
+    with pytest.raises(TimeoutError):
+        reader.get('sdm230')
+
+    # a write finishing during the read is read again
+    struct.pack_into('<Q', writer.map, 8, 2)
+    reads = []
+
+    def read(m):
+        reads.append(1)
+        if len(reads) == 1:
+            struct.pack_into('<Q', writer.map, 8, 4)
+        return len(reads)
+    assert reader._consistent(read) == 2
+    reader.close()
+
+
+def test_reads_are_never_torn(snapshot):
+    # every field is written with the same value, a read must see one update
+    path, writer = snapshot
+    reader = SnapshotReader(path)
+    stop = threading.Event()
+
+    def write():
+        n = 0
+        while not stop.is_set():
+            n += 1
+            writer.update('sdm230', {f: float(n) for f in FIELDS}, float(n))
+    thread = threading.Thread(target=write)
+    thread.start()
+    try:
+        for i in range(5000):
+            values, updated, sequence = reader.get('sdm230')
+            assert len(set(values.values()) | {updated}) <= 1 or len(values) == 0
+    finally:
+        stop.set()
+        thread.join()
+    reader.close()
+
+
+def test_reopen_after_the_gateway_restarts(snapshot):
+    path, writer = snapshot
+    writer.update('sdm230', {'ActivePower': 1}, 1000.0)
+    reader = SnapshotReader(path)
+    restarted = SnapshotWriter(path, [('sdm230', 2, 'sdm230', ['ActivePower'])])
+    restarted.update('sdm230', {'ActivePower': 2}, 2000.0)
+    reader.reopen()
+    assert reader.get('sdm230') == ({'ActivePower': 2}, 2000.0, 1)
+    assert reader.names() == ['sdm230']
+    restarted.close()
+    reader.close()
@@ -0,0 +1,52 @@
+import pytest
+from configparser import RawConfigParser
+from rollupRecorder import RollupRecorder
+
+# rollups of samples fed straight in, sent windows collected by a stand-in recorder
+
+
+class Collect:
+
+    def __init__(self):
+        self.points = []
+
+    def add(self, now, measurement, info, interval, tags):
+        self.points.append((now, measurement, info))
+
+    def send(self):
+        pass
+
+
+class Metrics:
+
+    def inc(self, name):
+        pass
+
+
+def rollup(tmp_path):
+    settings = RawConfigParser()
+    settings['rollup'] = {'windows': '1m', 'maxGap': '300', 'statePath': str(tmp_path / 'rollup.json')}
+    output = Collect()
+    return RollupRecorder(Collect(), settings, Metrics(), output), output
+
+
+def test_gap_over_windows(tmp_path):
+    recorder, output = rollup(tmp_path)
+    recorder.add(6000, 'inverter', {'Pac': 1000}, 1, [])
+    recorder.add(6030, 'inverter', {'Pac': 1000}, 1, [])
+    # 160s to the next sample, passing over the windows at 6060 and 6120
+    recorder.add(6190, 'inverter', {'Pac': 4000}, 1, [])
+    assert [point[0] for point in output.points] == [6000, 6060, 6120]
+    assert output.points[0][2]['Pac_max'] == 1000
+    assert set(output.points[1][2]) == {'Pac_integral'}
+    assert set(output.points[2][2]) == {'Pac_integral'}
+
+    recorder.add(6240, 'inverter', {'Pac': 4000}, 1, [])
+    assert output.points[-1][0] == 6180
+    fields = output.points[-1][2]
+    # interpolated at the window start, 3812.5W wasn't measured
+    assert fields['Pac_min'] == 4000
+    assert fields['Pac_mean'] == 4000
+    # 1000W for 30s, ramping to 4000W over 160s, then 4000W for 50s
+    total = sum(point[2]['Pac_integral'] for point in output.points)
+    assert total == pytest.approx((1000 * 30 + 2500 * 160 + 4000 * 50) / 3600)
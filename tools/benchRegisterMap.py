@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+
+import sys
+import struct
+import random
+import timeit
+sys.path.append('../lib')
+from registerMaps import GROWATT_INPUT, SDM230_INPUT
+from registerMap import numpy
+
+# compares decoding register blocks field by field, as the device drivers do,
+# with the compiled register map and, if NumPy is installed, batch decoding.
+# usage: benchRegisterMap.py [samples]
+
+samples = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+
+
+def perField(registerMap, blocks):
+    info = {}
+    for f in registerMap.fields:
+        registers, base = blocks[f.address]
+        i = f.address - base
+        if f.type == 'f':
+            value = struct.unpack('>f', struct.pack('>HH', registers[i], registers[i+1]))[0]
+        elif f.width == 2:
+            value = (registers[i] << 16) | registers[i+1]
+            if f.type == 's' and value >= 0x80000000:
+                value -= 0x100000000
+        else:
+            value = registers[i]
+            if f.type == 's' and value >= 0x8000:
+                value -= 0x10000
+        if f.scale != 1:
+            value = value * f.scale
+        info[f.name] = value
+    return info
+
+
+def compiled(registerMap, blocks):
+    info = {}
+    for block in registerMap.blocks:
+        block.decodeRegisters(blocks[block.address][0], info)
+    return info
+
+
+for name, registerMap in (('growatt', GROWATT_INPUT), ('sdm230', SDM230_INPUT)):
+    # the registers each block read returns, indexed by field and block address
+    blocks = {}
+    for block in registerMap.blocks:
+        registers = [random.randrange(0x4000) for _ in range(block.count)]
+        for address in range(block.address, block.address + block.count):
+            blocks[address] = (registers, block.address)
+    assert perField(registerMap, blocks) == compiled(registerMap, blocks)
+    fieldTime = timeit.timeit(lambda: perField(registerMap, blocks), number=samples)
+    mapTime = timeit.timeit(lambda: compiled(registerMap, blocks), number=samples)
+    print(f"{name:8} {len(registerMap.fields)} fields, {len(registerMap.blocks)} blocks")
+    print(f"    per field       : {fieldTime/samples*1e6:8.2f} us per sample")
+    print(f"    register map    : {mapTime/samples*1e6:8.2f} us per sample")
+    if numpy is not None:
+        block = registerMap.blocks[0]
+        data = struct.pack(f'>{block.count}H', *blocks[block.address][0]) * samples
+        batchTime = timeit.timeit(lambda: block.decodeBatch(data), number=1)
+        print(f"    numpy batch     : {batchTime/samples*1e6:8.2f} us per sample, first block only")
@@ -0,0 +1,304 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import gzip
+import json
+import time
+import shutil
+import select
+import tempfile
+import threading
+import subprocess
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+sys.path.append('../lib')
+from configparser import RawConfigParser
+from rtuSimulator import openPty, RtuSlave, BusConversation, SimulatedGrowatt, SimulatedSdm230
+
+# benchmarks the entry points against simulated devices on pseudo terminals.
+# solarmon, metermon and the gateway run as they would on the Pi, with their
+# config pointing at the simulated bus and at a local sink standing in for
+# InfluxDB and Grafana. sniffer runs the gateway's ring sniffer in process.
+# Reports polls per second, the latency from the last device response to the
+# sample arriving at the sink, CPU per sample and memory growth. Results are
+# saved to bench-<entry>.json in resultsPath, outside the repository, and
+# compared with the previous run.
+# usage: benchSimulated.py <solarmon|metermon|gateway|sniffer> [seconds]
+# The simulated bus is configured in the [simulator] section of simulator.cfg.
+
+ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+ENTRIES = {
+    'solarmon': ('solarmon.py', ROOT),
+    'metermon': ('meters/metermon.py', os.path.join(ROOT, 'meters')),
+    'gateway': ('gateway/modbusGateway.py', os.path.join(ROOT, 'gateway')),
+}
+WARMUP = 5
+
+settings = RawConfigParser()
+settings.read(os.path.dirname(os.path.realpath(__file__)) + '/simulator.cfg')
+baudrate = settings.getint('simulator', 'baudrate', fallback=9600)
+latency = settings.getfloat('simulator', 'latency', fallback=0.01)
+jitter = settings.getfloat('simulator', 'jitter', fallback=0.002)
+errorRate = settings.getfloat('simulator', 'errorRate', fallback=0.0)
+inverters = settings.getint('simulator', 'inverters', fallback=1)
+meters = settings.getint('simulator', 'meters', fallback=1)
+interval = settings.getfloat('simulator', 'interval', fallback=1)
+resultsPath = settings.get('simulator', 'resultsPath', fallback=os.path.join(tempfile.gettempdir(), 'solarmon-bench'))
+
+
+class Sink:
+
+    # accepts InfluxDB and Grafana influx line protocol writes, recording when
+    # each arrived and how many points it carried
+
+    def __init__(self):
+        self.arrivals = []
+        sink = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            # keep-alive, as the real endpoints are
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                self._reply()
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                if self.headers.get('Content-Encoding') == 'gzip':
+                    body = gzip.decompress(body)
+                if '/query' not in self.path:
+                    points = len([line for line in body.splitlines() if len(line.strip()) > 0])
+                    sink.arrivals.append((time.time(), points))
+                self._reply()
+
+            def _reply(self):
+                if '/query' in self.path:
+                    data = b'{"results":[{"statement_id":0}]}'
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'application/json')
+                    self.send_header('Content-Length', str(len(data)))
+                    self.end_headers()
+                    self.wfile.write(data)
+                else:
+                    self.send_response(204)
+                    self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.port = self.server.server_address[1]
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+
+def percentile(values, p):
+    if len(values) == 0:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def latencies(arrivals, responses):
+    # from the last device response before each write to the write arriving
+    result = []
+    i = 0
+    for arrived, points in arrivals:
+        while i < len(responses) and responses[i] <= arrived:
+            i += 1
+        if i > 0:
+            result.append(arrived - responses[i - 1])
+    return result
+
+
+def procStats(pid):
+    with open(f'/proc/{pid}/stat') as f:
+        fields = f.read().rsplit(')', 1)[1].split()
+    cpu = (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+    rss = 0
+    with open(f'/proc/{pid}/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                rss = int(line.split()[1])
+    return cpu, rss
+
+
+def writeConfig(entry, workdir, port, sink):
+    config = RawConfigParser()
+    config.optionxform = str
+    config['influx'] = {'host': '127.0.0.1', 'port': str(sink.port), 'db_name': 'bench'}
+    config['grafana'] = {
+        'metricsUrlP8S': f'http://127.0.0.1:{sink.port}/api/v1/push/influx/write',
+        'source': 'bench',
+        'debug': '0'
+    }
+    if entry == 'solarmon':
+        config['query'] = {'interval': str(int(interval)), 'offline_interval': '60', 'error_interval': '60', 'planner': '1'}
+        config['solarmon'] = {'port': port}
+        config['export'] = {'dataPath': os.path.join(workdir, 'gatewayData'), 'statePath': os.path.join(workdir, 'exportAggregates.json')}
+        for unit in range(1, inverters + 1):
+            config[f'inverters.sim{unit}'] = {'unit': str(unit), 'measurement': 'inverter', 'port': port}
+        filename = 'solarmon.cfg'
+    elif entry == 'metermon':
+        config['query'] = {'interval': str(int(interval)), 'offline_interval': '60', 'error_interval': '60', 'port': port}
+        for unit in range(inverters + 1, inverters + meters + 1):
+            config[f'meters.sim{unit}'] = {'unit': str(unit), 'measurement': 'meter'}
+        filename = 'metermon.cfg'
+    else:
+        config['json'] = {'pathPrefix': os.path.join(workdir, 'gatewayData'), 'interval': '600', 'maxFileSize': '256000', 'nfiles': '10'}
+        config['gateway'] = {'error_interval': '60', 'debug': '0', 'port': port, 'sniffer': 'ring'}
+        for unit in range(inverters + 1, inverters + meters + 1):
+            config[f'gateway.sim{unit}'] = {
+                'device': str(unit),
+                'measurement': 'sdm230',
+                'deviceType': 'sdm230',
+                'sampleInterval': '1',
+                'updateInterval': '1',
+                'logFields': 'ActivePower,ImportActiveEnergy,ExportActiveEnergy'
+            }
+        filename = 'gateway.cfg'
+    with open(os.path.join(workdir, filename), 'w') as f:
+        config.write(f)
+
+
+def devices():
+    return [SimulatedGrowatt(unit) for unit in range(1, inverters + 1)] + \
+        [SimulatedSdm230(unit) for unit in range(inverters + 1, inverters + meters + 1)]
+
+
+def runEntry(entry, seconds):
+    script, cwd = ENTRIES[entry]
+    master, slave, port = openPty()
+    simulated = devices()
+    if entry == 'gateway':
+        bus = BusConversation(master, simulated[inverters:], interval, baudrate, latency, errorRate)
+        bus.start()
+        responses = lambda: [sent[0] for sent in bus.sent]
+        polls = lambda: bus.responses
+    else:
+        bus = RtuSlave(master, simulated, baudrate, latency, jitter, errorRate)
+        bus.start()
+        responses = lambda: list(bus.stats.responseTimes)
+        polls = lambda: bus.stats.responses
+    sink = Sink()
+    workdir = tempfile.mkdtemp(prefix=f'bench-{entry}-')
+    writeConfig(entry, workdir, port, sink)
+    # the entry point reads its config from its own directory
+    shutil.copy(os.path.join(ROOT, script), workdir)
+    log = open(os.path.join(workdir, 'output.log'), 'w')
+    process = subprocess.Popen([sys.executable, os.path.join(workdir, os.path.basename(script))],
+        cwd=cwd, stdout=log, stderr=subprocess.STDOUT)
+    try:
+        time.sleep(WARMUP)
+        if process.poll() is not None:
+            print(f'{entry} exited, see {log.name}')
+            sys.exit(1)
+        cpu0, rss0 = procStats(process.pid)
+        polls0 = polls()
+        arrivals0 = len(sink.arrivals)
+        started = time.time()
+        time.sleep(seconds)
+        cpu1, rss1 = procStats(process.pid)
+        elapsed = time.time() - started
+        arrivals = sink.arrivals[arrivals0:]
+    finally:
+        process.terminate()
+        process.wait()
+        bus.stop()
+        log.close()
+    samples = sum(points for arrived, points in arrivals)
+    return {
+        'pollsPerSecond': (polls() - polls0) / elapsed,
+        'samplesPerSecond': samples / elapsed,
+        'latencyP50': percentile(latencies(arrivals, responses()), 50),
+        'latencyP95': percentile(latencies(arrivals, responses()), 95),
+        'cpuPerSample': (cpu1 - cpu0) / max(1, samples),
+        'memoryGrowth': rss1 - rss0,
+    }
+
+
+def runSniffer(seconds):
+    from modbusSniffer import ModbusSniffer
+
+    class Metrics:
+        def inc(self, name):
+            pass
+
+    master, slave, port = openPty()
+    sniffer = ModbusSniffer(settingsFor(port), Metrics())
+    sniffer.connect()
+    bus = BusConversation(master, devices(), interval, baudrate, latency, errorRate)
+    bus.start()
+    measuring = False
+    found = []
+    started = time.time()
+    while time.time() - started < seconds + WARMUP:
+        if not measuring and time.time() - started >= WARMUP:
+            # the device tables are allocated as devices are first seen
+            measuring = True
+            found = []
+            sent0 = bus.responses
+            rss0 = procStats(os.getpid())[1]
+            cpu0 = time.thread_time()
+            measured = time.time()
+        ready, _, _ = select.select([sniffer.fileno()], [], [], 0.5)
+        if len(ready) > 0 and sniffer.read():
+            found.append(time.time())
+    elapsed = time.time() - measured
+    cpu = time.thread_time() - cpu0
+    bus.stop()
+    sniffer.close()
+    responses = [sent[0] for sent in bus.sent]
+    delays = latencies([(t, 1) for t in found], responses)
+    samples = len(found)
+    return {
+        'pollsPerSecond': (bus.responses - sent0) / elapsed,
+        'samplesPerSecond': samples / elapsed,
+        'latencyP50': percentile(delays, 50),
+        'latencyP95': percentile(delays, 95),
+        'cpuPerSample': cpu / max(1, samples),
+        'memoryGrowth': procStats(os.getpid())[1] - rss0,
+    }
+
+
+def settingsFor(port):
+    config = RawConfigParser()
+    config['gateway'] = {'port': port, 'baudrate': str(baudrate)}
+    return config
+
+
+if len(sys.argv) < 2 or sys.argv[1] not in list(ENTRIES) + ['sniffer']:
+    print("Usage: benchSimulated.py <solarmon|metermon|gateway|sniffer> [seconds]")
+    sys.exit(1)
+
+entry = sys.argv[1]
+seconds = int(sys.argv[2]) if len(sys.argv) > 2 else 60
+if entry == 'sniffer':
+    results = runSniffer(seconds)
+else:
+    results = runEntry(entry, seconds)
+
+previous = None
+os.makedirs(resultsPath, exist_ok=True)
+resultsFile = os.path.join(resultsPath, f'bench-{entry}.json')
+if os.path.exists(resultsFile):
+    with open(resultsFile) as f:
+        previous = json.load(f)
+with open(resultsFile, 'w') as f:
+    json.dump(results, f)
+
+print(f'{entry} {seconds}s, {inverters} inverters, {meters} meters, {baudrate} baud, errors {errorRate}')
+units = {
+    'pollsPerSecond': (1, '/s'),
+    'samplesPerSecond': (1, '/s'),
+    'latencyP50': (1000, 'ms'),
+    'latencyP95': (1000, 'ms'),
+    'cpuPerSample': (1000, 'ms'),
+    'memoryGrowth': (1, 'kB'),
+}
+for name, value in results.items():
+    scale, unit = units[name]
+    line = f'    {name:<16}: {value * scale:10.2f} {unit}'
+    if previous is not None and previous.get(name):
+        line += f'  ({(value - previous[name]) * 100 / abs(previous[name]):+.1f}% on last run)'
+    print(line)
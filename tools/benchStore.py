@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+
+import sys
+import gc
+import time
+import collections
+sys.path.append('../lib')
+from configparser import RawConfigParser
+from modbusFrame import READ_INPUT
+from rtuSimulator import SimulatedGrowatt, SimulatedSdm230
+from sampleStore import SampleStore, numpy
+
+# benchmarks the SampleStore over days of samples. Simulated inverters and
+# meters are sampled every second of simulated time, as fast as they can be
+# stored, and every simulated 6 hours the live allocated blocks, the RSS and
+# the store's bytes are printed, which stay flat once the rings are full.
+# The same samples kept as dicts in bounded deques are shown for comparison.
+# usage: benchStore.py [days] [inverters] [meters] [capacity]
+
+days = float(sys.argv[1]) if len(sys.argv) > 1 else 3
+inverters = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+meters = int(sys.argv[3]) if len(sys.argv) > 3 else 1
+capacity = int(sys.argv[4]) if len(sys.argv) > 4 else 3600
+REPORT = 6 * 3600
+VARIANTS = 300
+
+
+def rss():
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1])
+    return 0
+
+
+def samples():
+    # a few hundred decoded samples per device to cycle through, the
+    # simulator is slower than the store
+    devices = [('inverter', SimulatedGrowatt(unit)) for unit in range(1, inverters + 1)] + \
+        [('sdm230', SimulatedSdm230(unit)) for unit in range(inverters + 1, inverters + meters + 1)]
+    result = []
+    for measurement, device in devices:
+        variants = []
+        for i in range(VARIANTS):
+            device.update(device.lastUpdate + 1)
+            variants.append(dict(device.values[READ_INPUT]))
+        result.append((measurement, [('unit', str(device.unit))], variants))
+    return result
+
+
+def run(name, add):
+    gc.collect()
+    blocks0 = sys.getallocatedblocks()
+    rss0 = rss()
+    print(f'{name}')
+    print(f'{"hours":>6} {"blocks":>9} {"rss kB":>8} {"us/add":>7}')
+    now = 1700000000.0
+    devices = samples()
+    total = int(days * 86400)
+    started = time.perf_counter()
+    added = 0
+    for second in range(1, total + 1):
+        variant = second % VARIANTS
+        for measurement, tags, variants in devices:
+            # the driver builds a new dict every poll
+            add(now + second, measurement, dict(variants[variant]), tags)
+        added += len(devices)
+        if second % REPORT == 0:
+            elapsed = time.perf_counter() - started
+            print(f'{second / 3600:>6.0f} {sys.getallocatedblocks() - blocks0:>9} {rss() - rss0:>8} {elapsed / added * 1e6:>7.2f}')
+            started = time.perf_counter()
+            added = 0
+
+
+settings = RawConfigParser()
+settings['store'] = {'capacity': str(capacity), 'memoryBudget': str(64 * 1024 * 1024)}
+store = SampleStore(settings)
+print(f'{days} days, {inverters} inverters, {meters} meters, {capacity} samples per series, numpy {numpy is not None}')
+run('SampleStore', store.add)
+print(f'store {store.bytes} bytes')
+started = time.perf_counter()
+for i in range(1000):
+    store.stats('inverter', 'Pac', 600, tags=[('unit', '1')])
+print(f'stats over 600s {(time.perf_counter() - started) * 1000:.1f} us per query')
+del store
+deques = {}
+
+
+def dequeAdd(now, measurement, info, tags):
+    key = (measurement, tuple(tags))
+    if key not in deques:
+        deques[key] = collections.deque(maxlen=capacity)
+    deques[key].append((now, info))
+
+
+run('dicts in deques', dequeAdd)
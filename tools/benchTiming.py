@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+
+import sys
+import time
+sys.path.append('../lib')
+from configparser import RawConfigParser
+from rtuSimulator import openPty, RtuSlave, SimulatedGrowatt
+from busMultiplexer import RtuMaster
+from rtuTransport import AdaptiveTiming, RtuClient
+from mappedDevice import MappedGrowatt
+
+# compares poll cycles over a simulated bus with pymodbus' fixed timeout and
+# with RtuMaster's learned timeouts and circuit breaker. Inverters 1 to
+# online answer, the next offline units don't, as inverters that have gone
+# to sleep. Prints the time of each of the last cycles and the mean.
+# usage: benchTiming.py [cycles] [online] [offline] [baudrate]
+
+cycles = int(sys.argv[1]) if len(sys.argv) > 1 else 60
+online = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+offline = int(sys.argv[3]) if len(sys.argv) > 3 else 1
+baudrate = int(sys.argv[4]) if len(sys.argv) > 4 else 9600
+TIMEOUT = 1
+
+
+def run(name, client):
+    devices = [MappedGrowatt(client, f'sim{unit}', unit) for unit in range(1, online + offline + 1)]
+    times = []
+    for cycle in range(cycles):
+        started = time.perf_counter()
+        for device in devices:
+            device.read()
+        times.append(time.perf_counter() - started)
+    last = times[len(times) // 2:]
+    print(f'{name:>10} first {times[0]:.3f}s last {" ".join(f"{t:.3f}" for t in last[-5:])} mean of last half {sum(last) / len(last):.3f}s')
+
+
+master, slave, port = openPty()
+bus = RtuSlave(master, [SimulatedGrowatt(unit) for unit in range(1, online + 1)], baudrate, latency=0.01, jitter=0.002)
+bus.start()
+print(f'{online} inverters answering, {offline} not, {baudrate} baud, {cycles} cycles')
+
+from pymodbus.client.sync import ModbusSerialClient
+client = ModbusSerialClient(method='rtu', port=port, baudrate=baudrate, stopbits=1, parity='N', bytesize=8, timeout=TIMEOUT)
+client.connect()
+run('pymodbus', client)
+client.close()
+
+settings = RawConfigParser()
+settings['timing'] = {}
+client = RtuClient(RtuMaster(port, baudrate, TIMEOUT, AdaptiveTiming(settings, TIMEOUT)))
+client.connect()
+run('adaptive', client)
+for unit, timing in sorted(client.master.timing.units.items()):
+    print(f'unit {unit} timeout {timing.timeout:.3f}s failures {timing.failures}')
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import json
+import time
+import threading
+import subprocess
+sys.path.append('../lib')
+from configparser import RawConfigParser
+from rtuSimulator import TcpGateway, SimulatedGrowatt
+from busClient import ConnectionPool
+from instruments import InstrumentedClient
+from mappedDevice import MappedGrowatt
+from pollScheduler import PollScheduler
+
+# benchmarks polling inverters behind Ethernet to RS485 gateways. Simulated
+# Growatts are spread over local TcpGateway stand-ins, each a 9600 baud
+# segment, and polled in process through the connection pool and
+# PollScheduler as solarmon polls them, one poll thread per gateway. Reports
+# samples per second against inverter count, with the rate a 1s interval
+# asks for, so it shows where a segment saturates and how adding gateways
+# scales. Each configuration runs in its own process.
+# usage: benchTransports.py [gateways] [seconds] [tcp|rtu]
+# The bus timing is configured in the [simulator] section of simulator.cfg.
+
+COUNTS = [1, 2, 4, 8, 16, 32]
+WARMUP = 3
+
+settings = RawConfigParser()
+settings.read(os.path.dirname(os.path.realpath(__file__)) + '/simulator.cfg')
+baudrate = settings.getint('simulator', 'baudrate', fallback=9600)
+latency = settings.getfloat('simulator', 'latency', fallback=0.01)
+interval = settings.getfloat('simulator', 'interval', fallback=1)
+
+
+class Counters:
+
+    # stands in for ModbusMetrics, the scheduler only counts
+
+    def __init__(self):
+        self.counts = {}
+
+    def inc(self, name, n=1):
+        self.counts[name] = self.counts.get(name, 0) + n
+
+
+def run(inverters, gateways, seconds, framing):
+    # polls for seconds and prints the result as JSON
+    segments = [[] for i in range(gateways)]
+    for unit in range(1, inverters + 1):
+        segments[(unit - 1) % gateways].append(SimulatedGrowatt(unit))
+    servers = [TcpGateway(devices, framing, baudrate, latency) for devices in segments if len(devices) > 0]
+    for server in servers:
+        server.start()
+    config = RawConfigParser()
+    config['query'] = {'timeout': '1'}
+    pool = ConnectionPool(config, InstrumentedClient)
+    scheduler = PollScheduler(Counters(), interval, 60, 60)
+    for server in servers:
+        scheduler.addPort(server.url(), pool.client(server.url()))
+        for device in server.devices.values():
+            scheduler.addDevice(server.url(), {
+                'name': f'sim{device.unit}',
+                'growatt': MappedGrowatt(pool.client(server.url()), f'sim{device.unit}', device.unit),
+                'lastExportEvaluate': time.time(),
+                'exportEvaluatePeriod': 1e9
+            })
+    samples = []
+    pollTimes = []
+
+    def poll(device):
+        started = time.perf_counter()
+        info = device['growatt'].read()
+        pollTimes.append(time.perf_counter() - started)
+        return info
+
+    def publish(batch):
+        samples.extend(now for now, device, info in batch)
+
+    threading.Thread(target=scheduler.run, args=(poll, publish, lambda d: None, lambda d, l: None), daemon=True).start()
+    time.sleep(WARMUP)
+    started = time.time()
+    first = len(samples)
+    polled = len(pollTimes)
+    time.sleep(seconds)
+    elapsed = time.time() - started
+    times = sorted(pollTimes[polled:])
+    print(json.dumps({
+        'inverters': inverters,
+        'gateways': len(servers),
+        'samplesPerSecond': (len(samples) - first) / elapsed,
+        'wanted': inverters / interval,
+        'pollSeconds': times[len(times) // 2] if len(times) > 0 else 0
+    }))
+    sys.stdout.flush()
+    os._exit(0)
+
+
+if len(sys.argv) > 1 and sys.argv[1] == 'run':
+    run(int(sys.argv[2]), int(sys.argv[3]), float(sys.argv[4]), sys.argv[5])
+
+gateways = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 10
+framing = sys.argv[3] if len(sys.argv) > 3 else 'tcp'
+print(f'{framing} framing, {baudrate} baud, {interval}s interval, {seconds}s per run')
+print(f'{"inverters":>9} {"gateways":>8} {"samples/s":>10} {"wanted/s":>9} {"poll ms":>8}')
+for gatewayCount in sorted({1, gateways}):
+    for count in COUNTS:
+        output = subprocess.run([sys.executable, os.path.realpath(__file__), 'run', str(count), str(gatewayCount), str(seconds), framing],
+            capture_output=True, text=True).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        print(f'{result["inverters"]:>9} {result["gateways"]:>8} {result["samplesPerSecond"]:>10.2f} {result["wanted"]:>9.1f} {result["pollSeconds"] * 1000:>8.1f}')
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import json
+import time
+sys.path.append('../lib')
+from configparser import RawConfigParser
+from binarySeries import BinarySeriesWriter, BinarySeriesReader
+from exportAggregates import pointsFrom, toSeconds
+
+# converts the gateway's JSON output into binary time series segments
+# usage: convertGatewayJson.py <pathPrefix> <json files...>
+
+settings = RawConfigParser()
+settings.read(os.path.dirname(os.path.realpath(__file__)) + '/../gateway/gateway.cfg')
+
+if len(sys.argv) < 3:
+    print("Usage: convertGatewayJson.py <pathPrefix> <json files...>")
+    sys.exit(1)
+
+pathPrefix = sys.argv[1]
+jsonBytes = 0
+started = time.perf_counter()
+points = {}
+for filename in sys.argv[2:]:
+    with open(filename, 'rb') as f:
+        data = f.read()
+    jsonBytes += len(data)
+    try:
+        documents = [json.loads(data)]
+    except ValueError:
+        documents = [json.loads(line) for line in data.splitlines() if len(line.strip()) > 0]
+    for document in documents:
+        for t, measurement, fields in pointsFrom(document):
+            points.setdefault(measurement or 'gateway', []).append((toSeconds(t), fields))
+jsonParse = time.perf_counter() - started
+
+binaryBytes = 0
+binaryParse = 0
+for measurement, rows in points.items():
+    rows.sort(key=lambda r: r[0])
+    fields = []
+    for t, values in rows:
+        for f, v in values.items():
+            if f not in fields and isinstance(v, (int, float)):
+                fields.append(f)
+    writer = BinarySeriesWriter(pathPrefix, measurement, fields,
+        maxFileSize=settings.getint('binary', 'maxFileSize', fallback=256000),
+        nfiles=settings.getint('binary', 'nfiles', fallback=10))
+    for t, values in rows:
+        writer.append(t, values)
+    writer.close()
+    started = time.perf_counter()
+    converted = BinarySeriesReader(pathPrefix, measurement).read()
+    binaryParse += time.perf_counter() - started
+    for path in os.listdir(os.path.dirname(os.path.abspath(pathPrefix))):
+        full = os.path.join(os.path.dirname(os.path.abspath(pathPrefix)), path)
+        if full.startswith(os.path.abspath(writer.pathPrefix)):
+            binaryBytes += os.path.getsize(full)
+    print(f"{measurement}: {len(rows)} points, {len(converted)} retained, fields {fields}")
+
+print(f"JSON   {jsonBytes} bytes parsed in {jsonParse*1000:.1f} ms")
+print(f"Binary {binaryBytes} bytes read in {binaryParse*1000:.1f} ms")
@@ -1,54 +1,55 @@
 #!/usr/bin/env python3
 
 import os
-import struct
+import sys
 from configparser import RawConfigParser
-from pymodbus.client.sync import ModbusSerialClient as ModbusClient
-from pymodbus.exceptions import ModbusIOException
+sys.path.append('../lib')
+from readPlanner import INPUT, HOLDING, readRegisters, isValid
+from registerScanner import RegisterScanner
+from registerMaps import GROWATT_INFO
+from busClient import modbusClient
 
 settings = RawConfigParser()
-settings.read(os.path.dirname(os.path.realpath(__file__)) + '../solarmon.cfg')
+settings.read(os.path.dirname(os.path.realpath(__file__)) + '/../solarmon.cfg')
 
 port = settings.get('query', 'port', fallback='/dev/ttyUSB1')
 
 print('Setup Serial Connection... ', end='')
-client = ModbusClient(method='rtu', port=port, baudrate=9600, stopbits=1, parity='N', bytesize=8, timeout=1)
-client.connect()
+# a dump is a bulk scan, through the multiplexer it gives way to monitoring
+client = modbusClient(settings, port, 'bulk_bus')
 print('Dome!')
 
 
-registerfile = open("holdingregisters.bin", "wb")
-
-for rnum in range(0,4000,20):
-    row = client.read_holding_registers(rnum, count=20, unit=1)
-    try:
-        print(rnum)
-        print(row.registers)
-        payload = b"".join(struct.pack("!H", x) for x in row.registers)
-        registerfile.write(payload)
-    except:
-        print(row)
-        payload = bytearray(40)
-        registerfile.write(payload)
-
-
-registerfile.close()
-
-registerfile = open("inputregisters.bin", "wb")
-
-for rnum in range(0,4000,20):
-    row = client.read_input_registers(rnum, count=20, unit=1)
-    try:
-        print(rnum)
-        print(row.registers)
-        payload = b"".join(struct.pack("!H", x) for x in row.registers)
-        registerfile.write(payload)
-    except:
-        print(row)
-        payload = bytearray(40)
-        registerfile.write(payload)
-
-
-registerfile.close()
-
-
+def model():
+    # inverter type and firmware, the register layout is cached against them
+    info = GROWATT_INFO.subset(['FirmwareVersion', 'InverterType'])
+    values = {}
+    for block in info.blocks:
+        row = readRegisters(client, HOLDING, block.address, block.count, 1)
+        if not isValid(row):
+            return None
+        block.decodeRegisters(row.registers, values)
+    return f"{values['InverterType']} {values['FirmwareVersion']}"
+
+
+def dump(kind, filename, name, end=4000):
+    # maps the register space by bisecting refused reads, unreadable registers are zero
+    scanner = RegisterScanner(client, 1, kind, filename, end, layoutsPath='layouts.json')
+    valid = scanner.scan(name, full)
+    changes = scanner.writeDiff()
+    for address, count in valid:
+        print(f'{address}-{address + count - 1}')
+    failed = scanner.failed()
+    if len(failed) > 0:
+        print(f'Failed to read {failed}')
+    scanner.close()
+    print(f"Dumped {kind} registers to {filename} in {scanner.transactions} transactions, "
+          f"{scanner.elapsed:.1f}s, {len(changes)} changed since the last dump")
+
+
+# usage: dumpgrowatt.py [full], full ignores the cached layout and maps every address
+full = len(sys.argv) > 1 and sys.argv[1] == 'full'
+name = model()
+print(f'Inverter {name}')
+dump(HOLDING, "holdingregisters.bin", name)
+dump(INPUT, "inputregisters.bin", name)
@@ -0,0 +1,35 @@
+#!/usr/bin/env python3
+
+import sys
+import time
+sys.path.append('../lib')
+from registerSnapshot import SnapshotReader
+
+# prints the latest values the gateway has published to its shared memory
+# snapshot, and how long a lookup takes.
+# usage: querySnapshot.py [path] [device [field]]
+
+path = sys.argv[1] if len(sys.argv) > 1 else '/dev/shm/modbusgw.snapshot'
+reader = SnapshotReader(path)
+names = sys.argv[2:3] if len(sys.argv) > 2 else reader.names()
+print(f'Sequence {reader.sequence()}')
+for name in names:
+    values, updated, sequence = reader.get(name)
+    print(f'{name} updated {time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(updated))} sequence {sequence}')
+    for field, value in values.items():
+        print(f'    {field:<24}: {value}')
+
+if len(names) > 0:
+    name = names[0]
+    field = sys.argv[3] if len(sys.argv) > 3 else reader.directory[name]['fields'][0]
+    n = 100000
+    started = time.perf_counter()
+    for i in range(n):
+        reader.value(name, field)
+    elapsed = time.perf_counter() - started
+    print(f'{name}.{field} lookup {elapsed / n * 1e6:.2f}us')
+    started = time.perf_counter()
+    for i in range(n):
+        reader.get(name)
+    elapsed = time.perf_counter() - started
+    print(f'{name} all fields {elapsed / n * 1e6:.2f}us')
@@ -4,18 +4,19 @@ import os
 import sys
 import struct
 from configparser import RawConfigParser
-from pymodbus.client.sync import ModbusSerialClient as ModbusClient
-from pymodbus.exceptions import ModbusIOException
+sys.path.append('../lib')
+from readPlanner import ReadPlanner, HOLDING, registersFrom
+from busClient import modbusClient
+from holdingCache import HoldingCache
 
 settings = RawConfigParser()
-settings.read(os.path.dirname(os.path.realpath(__file__)) + '../solarmon.cfg')
+settings.read(os.path.dirname(os.path.realpath(__file__)) + '/../solarmon.cfg')
 
 port = settings.get('query', 'port', fallback='/dev/ttyUSB1')
 unit = settings.get('inverter.main', 'unit', fallback=1)
 
 print('Setup Serial Connection... ', end='')
-client = ModbusClient(method='rtu', port=port, baudrate=9600, stopbits=1, parity='N', bytesize=8, timeout=1)
-client.connect()
+client = modbusClient(settings, port)
 print('Done!')
 
 def toAscii(registers):
@@ -67,48 +68,58 @@ def dumpAsAscii(registers):
     print(b.decode('ascii'))
 
 
+# all the holding registers reported below, read with as few transactions as possible
+infoRegisters = [
+    (23, 5), (209, 15), (3001, 15), (125, 8), 88, (9, 3), (12, 3), (133, 4), (45, 6),
+    (122, 2), (123, 2), (42, 2), 3000, 3016, (3017, 3), (3125, 4), 8, 17, 81, 124, 238, (241, 2)
+]
+planner = ReadPlanner.fromSettings(settings)
+holdingRegisters, transactions = planner.read(client, HOLDING, infoRegisters, unit=unit)
+print(f"Read {len(infoRegisters)} register ranges in {transactions} transactions")
 
+def holding(address, count=1):
+    return registersFrom(holdingRegisters, address, count)
 
 
 # get the serial number
-row = client.read_holding_registers(23, count=5, unit=unit)
-print("Old style serial number             :", toAscii(row.registers))
-row = client.read_holding_registers(209, count=15, unit=unit)
-print("Serial Number                       :", toAscii(row.registers))
-row = client.read_holding_registers(3001, count=15, unit=unit)
-print("New Serial Number                   :", toAscii(row.registers))
-
-row = client.read_holding_registers(125, count=8, unit=unit)
-print("Inverter Type                       :", toAscii(row.registers))
-
-row = client.read_holding_registers(88, unit=unit)
-modbusVersion = row.registers[0]/100
+row = holding(23, 5)
+print("Old style serial number             :", toAscii(row))
+row = holding(209, 15)
+print("Serial Number                       :", toAscii(row))
+row = holding(3001, 15)
+print("New Serial Number                   :", toAscii(row))
+
+row = holding(125, 8)
+print("Inverter Type                       :", toAscii(row))
+
+row = holding(88)
+modbusVersion = row[0]/100
 print("ModbusVersion                       :", modbusVersion)
 
-row = client.read_holding_registers(9, count=3, unit=unit)
-print("Firmware Version                    :", toAscii(row.registers))
+row = holding(9, 3)
+print("Firmware Version                    :", toAscii(row))
 
-row = client.read_holding_registers(12, count=3, unit=unit)
-print("Control Firmware Version            :", toAscii(row.registers))
+row = holding(12, 3)
+print("Control Firmware Version            :", toAscii(row))
 
-row = client.read_holding_registers(133, count=4 ,unit=unit)
-print("Bootloader Version                  :", toAscii(row.registers))
+row = holding(133, 4)
+print("Bootloader Version                  :", toAscii(row))
 
-row = client.read_holding_registers(45, count=6, unit=unit)
+row = holding(45, 6)
 print("Localtime                           : {day:02d}/{month:02d}/{year:04d} {hour:02d}:{min:02d}:{sec:02d}".format(
-    year=row.registers[0],
-    month=row.registers[1],
-    day=row.registers[2], 
-    hour=row.registers[3],
-    min=row.registers[4],
-    sec=row.registers[5]))
+    year=row[0],
+    month=row[1],
+    day=row[2], 
+    hour=row[3],
+    min=row[4],
+    sec=row[5]))
 
 #print("Control Firmware Version:", toAscii(row.registers))
 
 # export enabled ?
-row = client.read_holding_registers(122, count=2, unit=unit)
-exportControlEnabled = row.registers[0]
-exportLimitPowerRate = row.registers[1]*0.1
+row = holding(122, 2)
+exportControlEnabled = row[0]
+exportLimitPowerRate = row[1]*0.1
 if exportControlEnabled == 0:
     print("Export Control                      : Disabled") 
 if exportControlEnabled == 1:
@@ -119,123 +130,90 @@ if exportControlEnabled == 3:
     print("Export Control                      : Current Transformer") 
 print("Export Power Limit(%)               :", exportLimitPowerRate)
 
-row = client.read_holding_registers(42, count=2, unit=unit)
-g100FailSafe  = row.registers[0]
+row = holding(42, 2)
+g100FailSafe  = row[0]
 if g100FailSafe == 0:
     print("G100 Fail safe                      : Disabled") 
 if g100FailSafe == 1:
     print("G100 Fail safe                      : Enabled") 
-row = client.read_holding_registers(3000, count=1, unit=unit)
-g100FailSafeRate  = row.registers[0]*0.1
+row = holding(3000, 1)
+g100FailSafeRate  = row[0]*0.1
 print("Export Power Failsafe Limit         :", g100FailSafeRate)
 
-row = client.read_holding_registers(3016, count=1, unit=unit)
-dryContactEnable  = row.registers[0]
+row = holding(3016, 1)
+dryContactEnable  = row[0]
 if dryContactEnable == 0:
     print("DryContact                          : Disabled")
 if dryContactEnable == 1:
     print("DryContact                          : Enabled")
-row = client.read_holding_registers(3017, count=3, unit=unit)
-dryContactOnRate  = row.registers[0]*0.1
-dryContactOffRate  = row.registers[2]*0.1
+row = holding(3017, 3)
+dryContactOnRate  = row[0]*0.1
+dryContactOffRate  = row[2]*0.1
 print("DryContact On                       :", dryContactOnRate)
 print("DryContact Off                      :", dryContactOffRate)
 
 
 # seems to be read by monitors to control external access at the remote
 # end. Doesnt appear to be needed when setting values over modbus
-row = client.read_holding_registers(3125, count=4, unit=unit)
-print("Key                                 :", toAscii(row.registers))
-
-
-row = client.read_holding_registers(8, count=1, unit=unit)
-print("Normal Work PV Voltage              :", row.registers[0]*0.1)
-row = client.read_holding_registers(17, count=1, unit=unit)
-print("PV Start Voltage                    :", row.registers[0]*0.1)
-row = client.read_holding_registers(81, count=1, unit=unit)
-print("PV Voltage High Fault               :", row.registers[0]*0.1)
-row = client.read_holding_registers(124, count=1, unit=unit)
-if row.registers[0] == 0:
+row = holding(3125, 4)
+print("Key                                 :", toAscii(row))
+
+
+row = holding(8, 1)
+print("Normal Work PV Voltage              :", row[0]*0.1)
+row = holding(17, 1)
+print("PV Start Voltage                    :", row[0]*0.1)
+row = holding(81, 1)
+print("PV Voltage High Fault               :", row[0]*0.1)
+row = holding(124, 1)
+if row[0] == 0:
     print("tracker model                       : Independent ")
-if row.registers[0] == 1:
+if row[0] == 1:
     print("tracker model                       : DC Source ")
-if row.registers[0] == 2:
+if row[0] == 2:
     print("tracker model                       : Paralleltracker ")
-row = client.read_holding_registers(238, count=1, unit=unit)
-print("Fast MPPT Enable                    :", row.registers[0])
+row = holding(238, 1)
+print("Fast MPPT Enable                    :", row[0])
 
 
-row = client.read_holding_registers(241, count=2, unit=unit)
-print("Latitude                            :", row.registers[0])
-print("Longitude                           :", row.registers[0])
+row = holding(241, 2)
+print("Latitude                            :", row[0])
+print("Longitude                           :", row[1])
 
 
+def report(cache, ok):
+    # a verified write has already been read back, after a rollback what the
+    # inverter holds is read again
+    if not ok:
+        cache.load([(122, 2), 3000, 42])
+    print("Export Power Limit(%)               :", cache.get(123)*0.1)
+    print("Export Power Limit(W)               :", cache.get(123)*0.001*4200)
+    print("Export Power Failsafe Limit(W)      :", cache.get(3000)*0.001*4200)
+    print("Export Limit type")
+    print("     0=disabled, 1=rs485, 2=rs233 to:", cache.get(122))
+    print("Export Limit Fail Safe")
+    print("     1=enabled, 0=disabled          :", cache.get(42))
+
+
+# unchanged registers are not written, adjacent ones are written together and
+# all of them are verified with one read back
+cache = HoldingCache(client, unit, planner)
+cache.seed(holdingRegisters)
 if (len(sys.argv) > 1) and (sys.argv[1] == 'set'):
     if ( len(sys.argv) > 2):
         power = int(int(sys.argv[2])*1000/4200)
     else:
         power =876
     print("Set Export Power Limit")
-    row = client.write_register(123, value=power, unit=unit)
-    print("Response :", row)
-    row = client.read_holding_registers(123, count=2, unit=unit)
-    exportLimitPowerRate = row.registers[0]*0.1
-    print("Export Power Limit(%)               :", exportLimitPowerRate)
-    row = client.write_register(123, value=power, unit=unit)
-    print("Response", row)
-    row = client.read_holding_registers(123, count=2, unit=unit)
-    exportLimitPowerRate = row.registers[0]*0.001*4200
-    print("Export Power Limit(W)               :", exportLimitPowerRate)
-
-
-    row = client.write_register(3000, value=power, unit=unit)
-    print("Response", row)
-    row = client.read_holding_registers(3000, count=1, unit=unit)
-    g100FailSafeRate  = row.registers[0]*0.001*4200
-    print("Export Power Failsafe Limit(W)      :", g100FailSafeRate)
-
-    row = client.write_register(122, value=1, unit=unit)
-    print("Response", row)
-    row = client.read_holding_registers(122, count=1, unit=unit)
-    print("Export Limit type")
-    print("     0=disabled, 1=rs485, 2=rs233 to:", row.registers[0])
-
-    row = client.write_register(42, value=1, unit=unit)
-    print("Response", row)
-    row = client.read_holding_registers(42, count=1, unit=unit)
-    print("Export Limit Fail Safe")
-    print("     1=enabled, 0=disabled          :", row.registers[0])
+    ok = cache.write({122: 1, 123: power, 3000: power, 42: 1})
+    print("Response :", "verified" if ok else "failed, rolled back")
+    report(cache, ok)
 elif (len(sys.argv) > 1) and (sys.argv[1] == 'clear'):
     print("Set Export Power Limit")
-    row = client.write_register(123, value=876, unit=unit)
-    print("Response", row)
-    row = client.read_holding_registers(123, count=2, unit=unit)
-    exportLimitPowerRate = row.registers[0]*0.1
-    print("Export Power Limit(%)               :", exportLimitPowerRate)
-    row = client.write_register(123, value=875, unit=unit)
-    print("Response", row)
-    row = client.read_holding_registers(123, count=2, unit=unit)
-    exportLimitPowerRate = row.registers[0]*0.1
-    print("Export Power Limit(%)               :", exportLimitPowerRate)
-
-
-    row = client.write_register(3000, value=876, unit=unit)
-    print("Response", row)
-    row = client.read_holding_registers(3000, count=1, unit=unit)
-    g100FailSafeRate  = row.registers[0]*0.1
-    print("Export Power Failsafe Limit         :", g100FailSafeRate)
-
-    row = client.write_register(122, value=0, unit=unit)
-    print("Response", row)
-    row = client.read_holding_registers(122, count=1, unit=unit)
-    print("Export Limit type ")
-    print("   0=disabled, 1=rs485, 2=rs233 to  :", row.registers[0])
-
-    row = client.write_register(42, value=0, unit=unit)
-    print("Response", row)
-    row = client.read_holding_registers(42, count=1, unit=unit)
-    print("Export Limit Fail Safe")
-    print("   1=enabled, 0=disabled            :", row.registers[0])
+    # 876 then 875 as before the cache, so 123 is written even when it holds 875
+    ok = cache.write({123: 876}) and cache.write({122: 0, 123: 875, 3000: 876, 42: 0})
+    print("Response :", "verified" if ok else "failed, rolled back")
+    report(cache, ok)
 
 else:
     print("Checking dry run")
@@ -246,25 +224,25 @@ else:
             power = 876
         print("Would have set power limit to       :", power)
 
-    row = client.read_holding_registers(123, count=2, unit=unit)
-    exportLimitPowerRate = row.registers[0]*0.1
+    row = holding(123, 2)
+    exportLimitPowerRate = row[0]*0.1
     print("Export Power Limit(%)               :", exportLimitPowerRate)
-    row = client.read_holding_registers(123, count=2, unit=unit)
-    exportLimitPowerRate = row.registers[0]*0.001*4200
+    row = holding(123, 2)
+    exportLimitPowerRate = row[0]*0.001*4200
     print("Export Power Limit(W)               :", exportLimitPowerRate)
 
 
-    row = client.read_holding_registers(3000, count=1, unit=unit)
-    g100FailSafeRate  = row.registers[0]*0.001*4200
+    row = holding(3000, 1)
+    g100FailSafeRate  = row[0]*0.001*4200
     print("Export Power Failsafe Limit (W)     :", g100FailSafeRate)
 
-    row = client.read_holding_registers(122, count=1, unit=unit)
+    row = holding(122, 1)
     print("Export Limit type")
-    print("    0=disabled, 1=rs485, 2=rs233 to :", row.registers[0])
+    print("    0=disabled, 1=rs485, 2=rs233 to :", row[0])
 
-    row = client.read_holding_registers(42, count=1, unit=unit)
+    row = holding(42, 1)
     print("Export Limit Fail Safe  ")
-    print("    1=enabled, 0=disabled           :", row.registers[0])
+    print("    1=enabled, 0=disabled           :", row[0])
     print("Dry run, use ./setExportLimit.py set to update export limits  ")
 
 